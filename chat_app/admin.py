@@ -1,5 +1,5 @@
 from django.contrib import admin
-from chat_app.models import CustomUser, FriendRequest, ChatMsg, Group, GroupRequests, GroupChat
+from chat_app.models import CustomUser, FriendRequest, ChatMsg, Group, GroupRequests, GroupChat, HistoryPurge, Notification, ConversationSummary, Attachment
 
 # Register your models here.
 
@@ -9,5 +9,9 @@ admin.site.register(ChatMsg)
 admin.site.register(Group)
 admin.site.register(GroupRequests)
 admin.site.register(GroupChat)
+admin.site.register(HistoryPurge)
 
 
+admin.site.register(Notification)
+admin.site.register(ConversationSummary)
+admin.site.register(Attachment)
@@ -7,3 +7,12 @@ class ChatAppConfig(AppConfig):
 
     def ready(self):
         import chat_app.signals  # Register signal
+
+        # Query counts per request / WebSocket event (chat_app/instrumentation.py)
+        from django.db.backends.signals import connection_created
+        from chat_app.instrumentation import install_query_recorder
+        connection_created.connect(install_query_recorder)
+
+        # The outbound backpressure relies on daphne's internals (chat_app/outbound.py)
+        from chat_app.outbound import check_server
+        check_server()
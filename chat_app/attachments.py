@@ -0,0 +1,241 @@
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from chat_app.db import database_sync_to_async
+from chat_app.models import Attachment, ChatMsg, GroupChat
+from chat_app.images import thumbnail_bytes, ImageRejected
+from datetime import timedelta
+from urllib.parse import urlencode
+import asyncio
+import fcntl
+import glob
+import os
+import shutil
+import uuid
+
+
+'''
+File and image attachments of the chat messages.
+
+Uploads are resumable. create-upload/ registers the file (name, size, type), then the client sends it in pieces of at
+most ATTACHMENT_CHUNK_SIZE bytes to upload-chunk/<id>/?offset=<bytes received so far>. Each piece is copied from the
+request stream to its own file "uploads/<id>.<random>.chunk" in COPY_BLOCK_SIZE blocks, on a thread, so a piece is never
+held in memory whole (Django itself spools request bodies larger than FILE_UPLOAD_MAX_MEMORY_SIZE to a temporary file).
+Then, under the lock of the upload, the offset is moved forward only if it is still the one the piece was sent for, and
+the piece is appended to "uploads/<id>.part": of two requests for the same offset one gets a 409 and its piece never
+touches the part file. After an interruption, upload-status/<id>/ tells the client where to resume.
+
+With the last byte the part file is moved into the content-addressed storage (chat_app/storage.py hashes it in place,
+without a copy) and images get an ATTACHMENT_PREVIEW_SIZE preview. The client then sends {"attachment_id": <id>} with
+its message; the message events and the history carry attachment_payload(). Downloads go to the blob URL (immutable
+caching, ranges, X-Accel-Redirect, see chat_app/media.py).
+
+expire_uploads() (run by the collect_blobs command) deletes the uploads not finished, or finished and never sent,
+ATTACHMENT_UPLOAD_EXPIRY seconds after they started.
+'''
+
+
+COPY_BLOCK_SIZE = 64 * 1024
+
+INCOMPLETE_UPLOAD = 'The upload lost a chunk, send it again from offset 0'
+
+# Attachment columns read for the payloads; "attachment__<field>" when reading messages with values()
+ATTACHMENT_FIELDS = ('id', 'name', 'size', 'content_type', 'file', 'preview')
+MESSAGE_ATTACHMENT_FIELDS = tuple(f'attachment__{field}' for field in ATTACHMENT_FIELDS)
+
+
+class UploadRejected(Exception):
+    pass
+
+
+# The client's offset isn't the number of bytes received, it has to resume from "offset"
+class OffsetMismatch(Exception):
+
+    def __init__(self, offset):
+        super().__init__(f'The upload is at offset {offset}')
+        self.offset = offset
+
+
+# A file on disk handed to the storage, which moves it instead of copying it (see ContentAddressedStorage._save)
+class PartFile(File):
+
+    def temporary_file_path(self):
+        return self.name
+
+
+def part_name(attachment_id):
+    return f'uploads/{attachment_id}.part'
+
+# A new file for one chunk of the upload, appended to the part file once the chunk is accepted
+def chunk_name(attachment_id):
+    return f'uploads/{attachment_id}.{uuid.uuid4().hex}.chunk'
+
+def remove_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+# Payload of an attachment in the message events and the history, from its ATTACHMENT_FIELDS values
+def attachment_payload(attachment):
+    url = default_storage.url(attachment['file'])
+    return {
+        'id': attachment['id'],
+        'name': attachment['name'],
+        'size': attachment['size'],
+        'content_type': attachment['content_type'],
+        'url': url,
+        'download_url': f"{url}?{urlencode({'download': attachment['name']})}",
+        'preview': default_storage.url(attachment['preview']) if attachment['preview'] else None,
+    }
+
+# Payload of the attachment of a message read with MESSAGE_ATTACHMENT_FIELDS, None when it has none
+def message_attachment(message):
+    if message['attachment__id'] is None:
+        return None
+    return attachment_payload({field: message[f'attachment__{field}'] for field in ATTACHMENT_FIELDS})
+
+
+# State of an upload, returned by the upload endpoints
+def upload_state(attachment):
+    complete = attachment.completed_at is not None
+    values = {field: getattr(attachment, field) for field in ATTACHMENT_FIELDS}
+    values['file'], values['preview'] = attachment.file.name, attachment.preview.name
+    return {
+        'upload_id': attachment.id,
+        'offset': attachment.received,
+        'size': attachment.size,
+        'complete': complete,
+        'attachment': attachment_payload(values) if complete else None,
+    }
+
+
+async def create_upload(user_id, name, size, content_type):
+    name = os.path.basename((name or '').strip())[:255]
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise UploadRejected('Invalid file size')
+    if not name:
+        raise UploadRejected('Missing file name')
+    if size <= 0 or size > settings.ATTACHMENT_MAX_BYTES:
+        raise UploadRejected(f'Attachments must be between 1 byte and {settings.ATTACHMENT_MAX_BYTES // (1024 * 1024)} MB')
+
+    return await database_sync_to_async(Attachment.objects.create)(
+        uploader_id=user_id, name=name, size=size, content_type=(content_type or 'application/octet-stream')[:100],
+    )
+
+
+# Copies at most "limit" bytes of the stream to a new chunk file, returns the number of bytes written
+def write_chunk(path, stream, limit):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    written = 0
+    with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as chunk:
+        while True:
+            block = stream.read(min(COPY_BLOCK_SIZE, limit - written + 1))
+            if not block:
+                break
+            written += len(block)
+            if written > limit:
+                raise UploadRejected('The chunk is larger than the chunk size or the rest of the file')
+            chunk.write(block)
+    return written
+
+# Under the lock of the upload (an exclusive flock of its part file, held against every thread and process), moves the
+# upload to "offset" + "written" if it is still at "offset" and appends the chunk file to the part file
+def append_chunk(attachment_id, offset, chunk_path, written):
+    path = default_storage.path(part_name(attachment_id))
+    with open(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600), 'wb') as part:
+        fcntl.flock(part, fcntl.LOCK_EX)
+        if os.fstat(part.fileno()).st_size < offset:
+            # A request died between counting its chunk and appending it
+            Attachment.objects.filter(id=attachment_id, received=offset).update(received=0)
+            part.truncate(0)
+            raise UploadRejected(INCOMPLETE_UPLOAD)
+        # Another request for the same offset may have been faster
+        if not Attachment.objects.filter(id=attachment_id, received=offset).update(received=offset + written):
+            raise OffsetMismatch(Attachment.objects.filter(id=attachment_id).values_list('received', flat=True).get())
+        part.seek(offset)
+        with open(chunk_path, 'rb') as chunk:
+            shutil.copyfileobj(chunk, part, COPY_BLOCK_SIZE)
+        part.truncate(offset + written)
+    return offset + written
+
+# Appends the request body to the upload, completing it with its last byte
+async def upload_chunk(attachment, offset, stream):
+    if offset != attachment.received:
+        raise OffsetMismatch(attachment.received)
+
+    if offset < attachment.size:
+        chunk_path = default_storage.path(chunk_name(attachment.id))
+        limit = min(settings.ATTACHMENT_CHUNK_SIZE, attachment.size - offset)
+        try:
+            written = await asyncio.get_running_loop().run_in_executor(None, write_chunk, chunk_path, stream, limit)
+            attachment.received = await database_sync_to_async(append_chunk)(attachment.id, offset, chunk_path, written)
+        finally:
+            remove_file(chunk_path)
+
+    if attachment.received == attachment.size and attachment.completed_at is None:
+        await complete_upload(attachment)
+
+
+# Moves the part file into the storage and makes the preview of an image (on a thread: hashing, decoding)
+def store_upload(attachment):
+    path = default_storage.path(part_name(attachment.id))
+    if os.path.getsize(path) != attachment.size:
+        raise UploadRejected(INCOMPLETE_UPLOAD)    # a request died between counting its last chunk and appending it
+    extension = os.path.splitext(attachment.name)[1]
+    name = default_storage.save(f'attachments/upload{extension}', PartFile(None, name=path))
+
+    preview = ''
+    if attachment.content_type.startswith('image/') and attachment.size <= settings.IMAGE_MAX_UPLOAD_BYTES:
+        try:
+            with default_storage.open(name) as file:
+                preview = default_storage.save('thumbnails/preview.webp', ContentFile(thumbnail_bytes(file, settings.ATTACHMENT_PREVIEW_SIZE)))
+        except ImageRejected:
+            pass    # sent as a plain file
+    return name, preview
+
+async def complete_upload(attachment):
+    try:
+        attachment.file, attachment.preview = await asyncio.get_running_loop().run_in_executor(None, store_upload, attachment)
+    except UploadRejected:
+        attachment.received = 0
+        await database_sync_to_async(Attachment.objects.filter(id=attachment.id).update)(received=0)
+        remove_file(default_storage.path(part_name(attachment.id)))
+        raise
+    attachment.completed_at = timezone.now()
+    await database_sync_to_async(Attachment.objects.filter(id=attachment.id).update)(
+        file=attachment.file.name, preview=attachment.preview.name, completed_at=attachment.completed_at,
+    )
+
+
+# ATTACHMENT_FIELDS values of a complete attachment of the user, None when it isn't one
+async def sendable_attachment(user_id, attachment_id):
+    try:
+        attachment_id = int(attachment_id)
+    except (TypeError, ValueError):
+        return None
+    attachments = Attachment.objects.filter(id=attachment_id, uploader_id=user_id, completed_at__isnull=False).values(*ATTACHMENT_FIELDS)
+    return await database_sync_to_async(attachments.first)()
+
+
+# Deletes the uploads older than "expiry" seconds that no message references (their blobs are left to collect_blobs)
+def expire_uploads(expiry=None):
+    expiry = settings.ATTACHMENT_UPLOAD_EXPIRY if expiry is None else expiry
+    stale = Attachment.objects.filter(created_at__lt=timezone.now() - timedelta(seconds=expiry)).exclude(
+        Exists(ChatMsg.objects.filter(attachment_id=OuterRef('id')))
+    ).exclude(
+        Exists(GroupChat.objects.filter(attachment_id=OuterRef('id')))
+    )
+    ids = list(stale.values_list('id', flat=True))
+    for attachment_id in ids:
+        remove_file(default_storage.path(part_name(attachment_id)))
+        for path in glob.glob(default_storage.path(f'uploads/{attachment_id}.*.chunk')):
+            remove_file(path)    # left by a request that died
+    Attachment.objects.filter(id__in=ids).delete()
+    return len(ids)
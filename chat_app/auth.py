@@ -0,0 +1,73 @@
+from django.conf import settings
+from chat_app.db import database_sync_to_async
+from chat_app.cache import LRUCache
+from chat_app.models import CustomUser as User
+import datetime
+import time
+import jwt
+
+
+# Verified tokens (token -> payload), each entry expires with the token's "exp"
+token_cache = LRUCache(settings.TOKEN_CACHE_SIZE, settings.USER_CACHE_TTL)
+
+# Lightweight user principals (user id -> the few fields needed by the views/consumers, or None if the user doesn't exist)
+user_cache = LRUCache(settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL)
+
+# Kept in the model's field order, as expected by Model.from_db()
+PRINCIPAL_FIELDS = tuple(
+    field.attname for field in User._meta.concrete_fields
+    if field.attname in ('id', 'username', 'first_name', 'last_name', 'image', 'thumbnail', 'is_active')
+)
+
+
+def generate_jwt_token(userid, username):
+    payload = {
+        'user_id': userid,
+        'username': username,
+        'exp': datetime.datetime.now(datetime.UTC) + datetime.timedelta(days=30)
+    }
+    token = jwt.encode(payload, settings.JWT_SECRET_KEY, algorithm='HS256')
+    return token
+
+# Returns the token payload, or None if the token is invalid/expired.
+# Only an HMAC check on a miss and a dict lookup on a hit, so it's called directly on the event loop.
+def verify_jwt_token(token):
+    if not token:
+        return None
+
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
+    try:
+        payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=['HS256'])
+    except jwt.ExpiredSignatureError:   # Expired token
+        return None
+    except:     # Invalid token
+        return None
+
+    exp = payload.get('exp')
+    token_cache.set(token, payload, expires_at=time.monotonic() + (exp - time.time()) if exp else None)
+    return payload
+
+
+# Returns a CustomUser instance holding only PRINCIPAL_FIELDS (other fields are loaded on access), or None.
+# A new instance is built from the cached values on every call, so callers can't leak changes to each other.
+async def get_cached_user(user_id):
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+
+    values = user_cache.get(user_id)
+    if values is None:
+        generation = user_cache.generation
+        values = await database_sync_to_async(
+            User.objects.filter(id=user_id).values_list(*PRINCIPAL_FIELDS).first
+        )()
+        values = values or ()    # () marks a missing user
+        user_cache.set(user_id, values, generation)
+
+    if not values:
+        return None
+    return User.from_db('default', PRINCIPAL_FIELDS, values)
@@ -0,0 +1,80 @@
+from collections import OrderedDict
+from django.conf import settings
+import threading
+import time
+
+
+MISSING = object()
+
+
+# Small thread-safe LRU cache with a time-to-live per entry.
+# It's shared by the event loop and the ORM worker threads (signal receivers), so every access takes a lock.
+class LRUCache:
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0    # bumped by every invalidation (see set())
+        self._data = OrderedDict()    # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, MISSING)
+            if entry is not MISSING:
+                if entry[0] > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    # "generation" is the value of self.generation read before loading the value from the database.
+    # If anything was invalidated in the meantime the loaded value may be stale, so it isn't stored.
+    def set(self, key, value, generation=None, expires_at=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if expires_at is None:
+                expires_at = time.monotonic() + self.ttl
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                self._data.pop(key, None)
+
+    # Removes every entry for which predicate(key, value) is true (walks the whole cache, used for rare bulk invalidations)
+    def delete_where(self, predicate):
+        with self._lock:
+            self.generation += 1
+            for key in [key for key, entry in self._data.items() if predicate(key, entry[1])]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
+
+
+# Friendship and group membership checks made by the WebSocket consumers on connect.
+# The signal receivers invalidate the entries in every process through chat_app/invalidation.py.
+authz_cache = LRUCache(settings.AUTHZ_CACHE_SIZE, settings.AUTHZ_CACHE_TTL)
+
+
+def friendship_key(user_a_id, user_b_id):
+    return ('friends',) + tuple(sorted((int(user_a_id), int(user_b_id))))
+
+def membership_key(group_id, user_id):
+    return ('member', int(group_id), int(user_id))
@@ -1,33 +1,179 @@
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from chat_app.models import FriendRequest, Group, CustomUser, ChatMsg, GroupChat
-from django.db.models import Q
+from django.conf import settings
+from chat_app.db import database_sync_to_async
+from chat_app.models import FriendRequest, Group, ChatMsg, GroupChat, conversation_key, avatar_url
+from chat_app.cache import authz_cache, friendship_key, membership_key
+from chat_app.messaging import save_chat_message, save_group_message
+from chat_app.broadcast import make_event, event_frame, encode
+from chat_app.conversations import record_chat_message, record_group_message, mark_read
+from chat_app.replay import RoomReplayMixin, query_last_id
+from chat_app.outbound import OutboundQueueMixin
+from chat_app.instrumentation import QueryCountMixin
+from chat_app.metrics import ConsumerMetricsMixin, group_send_seconds
+from chat_app.pagination import keyset_page, parse_cursor
+from chat_app.purge import visible_chat_messages, visible_group_messages
+from chat_app.attachments import MESSAGE_ATTACHMENT_FIELDS, attachment_payload, message_attachment, sendable_attachment
+from functools import partial
 import json
+import time
+
+
+# Friendship / group membership checks made on connect.
+# Results are cached in "authz_cache", the signal receivers invalidate the entries when friendships or members change.
+async def are_friends(user_id, friend_id):
+    key = friendship_key(user_id, friend_id)
+    status = authz_cache.get(key)
+    if status is None:
+        generation = authz_cache.generation
+        status = await database_sync_to_async(FriendRequest.between(user_id, friend_id).filter(accepted=True).exists)()
+        authz_cache.set(key, status, generation)
+    return status  # bool
+
+async def is_groupmember(user_id, group_id):
+    key = membership_key(group_id, user_id)
+    status = authz_cache.get(key)
+    if status is None:
+        generation = authz_cache.generation
+        status = await database_sync_to_async(Group.objects.filter(id=group_id, members__id=user_id).exists)()
+        authz_cache.set(key, status, generation)
+    return status  # bool
+
+
+# The chat_message events of the messages, also used to replay missed messages from the history (see chat_app/replay.py).
+# "id" is kept next to the pre-encoded frame for the replay buffers, "attachment" is an attachment_payload().
+def chat_message_event(id, message, username, attachment=None):
+    payload = {
+        'id': id, 
+        'message': message,
+        'username': username,
+        'time_stamp': 'message_time_stamp'
+    }
+    if attachment is not None:
+        payload['attachment'] = attachment
+    event = make_event('chat_message', payload)
+    event['id'] = id
+    return event
+
+def group_message_event(id, message, username, first_name, last_name, user_id, user_img, attachment=None):
+    payload = {
+        'id': id, 
+        'message': message,
+        'username': username,
+        'name': first_name + f' {last_name}',
+        'user_id': user_id,
+        'user_img': user_img,
+        # 'time_stamp': 'message_time_stamp'
+    }
+    if attachment is not None:
+        payload['attachment'] = attachment
+    event = make_event('chat_message', payload)
+    event['id'] = id
+    return event
+
+
+# (message, attachment) of a client frame: the message as a JSON string, or {"message": ..., "attachment_id": ...}.
+# "attachment" is the ATTACHMENT_FIELDS values of a complete upload of the user (chat_app/attachments.py).
+# None when there's nothing to send, or the attachment isn't one of the user's uploads.
+async def parse_message_frame(user, frame):
+    if isinstance(frame, dict):
+        message, attachment_id = str(frame.get('message') or '').strip(), frame.get('attachment_id')
+    else:
+        message, attachment_id = str(frame).strip(), None
+
+    attachment = None
+    if attachment_id is not None:
+        attachment = await sendable_attachment(user.id, attachment_id)
+        if attachment is None:
+            return None
+    if len(message) == 0 and attachment is None:
+        return None
+    return message, attachment
+
+
+# Broadcast time of the received messages, and their count (chat_app/metrics.py)
+chat_group_send_seconds, group_group_send_seconds = group_send_seconds.labels('chat'), group_send_seconds.labels('group')
+
+
+# Saving and broadcasting a message received from a socket (UserChatConsumer/GroupChatConsumer and MultiplexConsumer).
+# "group" is the room the event is sent to, for the consumers that are in several rooms.
+async def post_chat_message(channel_layer, user, friend_id, message, attachment=None):
+    msg = await save_chat_message(user, friend_id, message, attachment and attachment['id'])
+    room = 'chat_%s' % msg.conversation
+
+    # The frame is encoded once here, the chat_message handlers only write it to their sockets
+    event = chat_message_event(msg.id, message, user.username, attachment and attachment_payload(attachment))
+    event['group'] = room
+    begin = time.perf_counter()
+    await channel_layer.group_send(room, event)
+    chat_group_send_seconds.observe(time.perf_counter() - begin)
+
+    # Last message and unread count of the conversation list (get-inbox), after the message is on its way
+    await database_sync_to_async(record_chat_message)(msg)
+
+async def post_group_message(channel_layer, user, group_id, message, attachment=None):
+    msg = await save_group_message(user, group_id, message, attachment and attachment['id'])
+    room = f'chat_group_{group_id}'
+
+    event = group_message_event(
+        msg.id, message, user.username, user.first_name, user.last_name, user.id, user.avatar_url,
+        attachment and attachment_payload(attachment),
+    )
+    event['group'] = room
+    begin = time.perf_counter()
+    await channel_layer.group_send(room, event)
+    group_group_send_seconds.observe(time.perf_counter() - begin)
+
+    await database_sync_to_async(record_group_message)(msg)
+
+
+# History after "last_id" (for a replay the replay buffer can't serve), hiding the messages being purged.
+# None when "last_id" isn't in the history. Sync, read_history() (chat_app/replay.py) runs them on the DB executor.
+def missed_chat_messages(conversation, last_id, limit):
+    messages = ChatMsg.objects.filter(conversation=conversation).values('id', 'message', 'sender__username', *MESSAGE_ATTACHMENT_FIELDS)
+    messages = visible_chat_messages(messages, conversation)
+    page, next_cursor = keyset_page(messages, limit, after_id=last_id)
+    if not page and not messages.filter(id=last_id).exists():
+        return None
+    return [
+        (message['id'], chat_message_event(message['id'], message['message'], message['sender__username'], message_attachment(message))['frame'])
+        for message in page
+    ], next_cursor
+
+def missed_group_messages(group_id, last_id, limit):
+    messages = GroupChat.objects.filter(group_id=group_id).values(
+        'id', 'message', 'sender_id', 'sender__username', 'sender__first_name', 'sender__last_name', 'sender__image', 'sender__thumbnail',
+        *MESSAGE_ATTACHMENT_FIELDS,
+    )
+    messages = visible_group_messages(messages, group_id)
+    page, next_cursor = keyset_page(messages, limit, after_id=last_id)
+    if not page and not messages.filter(id=last_id).exists():
+        return None
+    return [
+        (message['id'], group_message_event(
+            message['id'], message['message'], message['sender__username'], message['sender__first_name'],
+            message['sender__last_name'], message['sender_id'], avatar_url(message['sender__thumbnail'], message['sender__image']),
+            message_attachment(message),
+        )['frame'])
+        for message in page
+    ], next_cursor
 
 
 # Chat between two friends
-class UserChatConsumer(AsyncWebsocketConsumer):
-    
-    @database_sync_to_async
-    def are_friends(self, user_id, friend_id):
-        status = FriendRequest.objects.filter( (Q(from_user__id=user_id) & Q(to_user__id=friend_id)) | (Q(from_user__id=friend_id) & Q(to_user__id=user_id)), accepted=True ).exists()
-        return status  # bool
+class UserChatConsumer(QueryCountMixin, ConsumerMetricsMixin, OutboundQueueMixin, RoomReplayMixin, AsyncWebsocketConsumer):
     
     async def connect(self):
         self.friend_id = self.scope['url_route']['kwargs']['id']
         self.user = self.scope['user']
 
-        self.friend = await database_sync_to_async(CustomUser.objects.get)(id=self.friend_id)
-
         # Ensure user is authenticated
         if self.user.is_authenticated:
 
             # The room_name will follow the format "chat_<smaller_user_id>_<greater_user_id>".
             # For example, if user.id = 5 and friend_id = 1, the room_name will be "chat_1_5".
-            self.users_id = f'{self.user.id}_{self.friend_id}' if int(self.user.id) < int(self.friend_id) else f'{self.friend_id}_{self.user.id}'
+            self.users_id = conversation_key(self.user.id, self.friend_id)
             self.room_name = 'chat_%s' % self.users_id
 
-            areFriends = await self.are_friends(self.user.id, self.friend_id)
+            areFriends = await are_friends(self.user.id, self.friend_id)
             if areFriends:  
 
                 await self.channel_layer.group_add(
@@ -35,62 +181,53 @@ class UserChatConsumer(AsyncWebsocketConsumer):
                     self.channel_name,
                 )
                 await self.accept('token') 
+                await database_sync_to_async(mark_read)(self.user.id, friend_id=self.friend_id)
+                # Sending the messages missed since "?last_id=" (reconnection)
+                await self.start_replay(self.room_name, query_last_id(self.scope), partial(missed_chat_messages, self.users_id))
             else:
+                self.reject('not_friends')
                 await self.close()
         else:
+            self.reject('unauthenticated')
             await self.close()
 
     async def receive(self, text_data):
         text_data_json = json.loads(text_data)
-        message = text_data_json.strip()
+        parsed = await parse_message_frame(self.user, text_data_json)
 
-        if len(message) == 0:
+        if parsed is None:
             return
             
-        msg = await ChatMsg.objects.acreate(sender=self.user, receiver=self.friend, message=message)
-        username = self.user.username
-
-        await self.channel_layer.group_send(
-            self.room_name,
-            {
-                'type': 'chat_message',
-                'id': msg.id, 
-                'message': message,
-                'username': username,
-                'time_stamp': 'message_time_stamp'
-            }
-        )
+        await post_chat_message(self.channel_layer, self.user, self.friend_id, *parsed)
 
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps(event))
+        if self.record_event(self.room_name, event):
+            await self.send(text_data=event_frame(event))
 
     async def disconnect(self, close_code):
+        self.stop_replay(self.room_name)
         await self.channel_layer.group_discard(
             self.room_name, 
             self.channel_name
             )
+        # The messages received while the chat was open have been read
+        await database_sync_to_async(mark_read)(self.user.id, friend_id=self.friend_id)
 
 
 
 # For group chatting
-class GroupChatConsumer(AsyncWebsocketConsumer):
-
-    @database_sync_to_async
-    def is_groupmember(self, user_id, group_id):
-        request_status = Group.objects.filter(id=group_id, members__id=user_id).exists()
-        return request_status  # returns bool true/false
+class GroupChatConsumer(QueryCountMixin, ConsumerMetricsMixin, OutboundQueueMixin, RoomReplayMixin, AsyncWebsocketConsumer):
 
     async def connect(self):
         self.group_id = self.scope['url_route']['kwargs']['id']
         self.user = self.scope['user']
-        self.current_group = await database_sync_to_async(Group.objects.get)(id=self.group_id)
 
         # Ensure user is authenticated
         if self.user.is_authenticated:
             self.room_name = f'group_{self.group_id}'
             self.room_group_name = 'chat_%s' % self.room_name
 
-            is_member = await self.is_groupmember(self.user.id, self.group_id)
+            is_member = await is_groupmember(self.user.id, self.group_id)
 
             if is_member:
                 await self.channel_layer.group_add(
@@ -99,49 +236,44 @@ class GroupChatConsumer(AsyncWebsocketConsumer):
                 )
 
                 await self.accept('token')
+                await database_sync_to_async(mark_read)(self.user.id, group_id=self.group_id)
+                # Sending the messages missed since "?last_id=" (reconnection)
+                await self.start_replay(self.room_group_name, query_last_id(self.scope), partial(missed_group_messages, self.group_id))
             else:
+                self.reject('not_member')
                 await self.close()
         else:
+            self.reject('unauthenticated')
             await self.close()
 
     
     async def receive(self, text_data):
         text_data_json = json.loads(text_data)
-        message = text_data_json.strip()
+        parsed = await parse_message_frame(self.user, text_data_json)
 
-        if len(message) == 0:
+        if parsed is None:
             return
 
-        msg = await GroupChat.objects.acreate(group=self.current_group, sender=self.user, message=message)
-
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'id': msg.id, 
-                'message': message,
-                'username': self.user.username,
-                'name': self.user.first_name + f' {self.user.last_name}',
-                'user_id': self.user.id,
-                'user_img': self.user.image.url,
-                # 'time_stamp': 'message_time_stamp'
-            }
-        )
+        await post_group_message(self.channel_layer, self.user, self.group_id, *parsed)
 
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps(event))
+        if self.record_event(self.room_group_name, event):
+            await self.send(text_data=event_frame(event))
 
 
     async def disconnect(self, close_code):
+        self.stop_replay(self.room_group_name)
         await self.channel_layer.group_discard(
             self.room_group_name, 
             self.channel_name
             )
+        # The messages received while the chat was open have been read
+        await database_sync_to_async(mark_read)(self.user.id, group_id=self.group_id)
 
 
 
 # For realtime notifications        
-class NotificationConsumer(AsyncWebsocketConsumer):
+class NotificationConsumer(QueryCountMixin, ConsumerMetricsMixin, OutboundQueueMixin, AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope['user']
         self.group_name = f"notifications_{self.user.id}"
@@ -153,13 +285,15 @@ class NotificationConsumer(AsyncWebsocketConsumer):
                 self.channel_name
             )
             await self.accept('token')
+        else:
+            self.reject('unauthenticated')
 
     # Since this is a notification consumer, no data is being received from the client (frontend).
     async def receive(self, text_data):
         pass
 
     async def send_notification(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.send(text_data=event_frame(event))
 
     async def disconnect(self, close_code):
         await self.channel_layer.group_discard(
@@ -167,3 +301,126 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
+
+
+
+# One socket for the notifications and any number of chats (ws/multiplex/).
+#
+# Client frames (JSON):
+#   {"action": "subscribe", "stream": "user" | "group", "id": <friend id | group id>, "last_id": <optional, see replay.py>}
+#   {"action": "unsubscribe", "stream": ..., "id": ...}
+#   {"action": "send", "stream": ..., "id": ..., "message": "...", "attachment_id": <optional, see attachments.py>}
+# Server frames: {"stream": "<user|group>:<id>" | "notifications" | "control", "payload": <the frame of the single-stream sockets>}.
+# "control" payloads answer the client frames: {"type": "subscribed" | "unsubscribed" | "error", "stream": ..., "error": ...}.
+# Subscriptions are authorized with the same (cached) friendship and membership checks as the single-stream sockets.
+class MultiplexConsumer(QueryCountMixin, ConsumerMetricsMixin, OutboundQueueMixin, RoomReplayMixin, AsyncWebsocketConsumer):
+
+    async def connect(self):
+        self.user = self.scope['user']
+        self.streams = {}    # channel layer group -> (stream name, "user" | "group" | None, id)
+
+        if not self.user.is_authenticated:
+            self.reject('unauthenticated')
+            await self.close()
+            return
+
+        # The notification stream is always on
+        notifications_group = f"notifications_{self.user.id}"
+        await self.channel_layer.group_add(notifications_group, self.channel_name)
+        self.streams[notifications_group] = ('notifications', None, None)
+        await self.accept('token')
+
+    async def receive(self, text_data):
+        try:
+            frame = json.loads(text_data)
+            action, kind, id = frame['action'], frame['stream'], int(frame['id'])
+        except (ValueError, KeyError, TypeError):
+            return await self.send_control('error', None, error='invalid frame')
+
+        if kind not in ('user', 'group'):
+            return await self.send_control('error', None, error='unknown stream')
+
+        name = f'{kind}:{id}'
+        room = 'chat_%s' % conversation_key(self.user.id, id) if kind == 'user' else f'chat_group_{id}'
+
+        if action == 'subscribe':
+            await self.subscribe(room, name, kind, id, parse_cursor(frame.get('last_id')))
+
+        elif action == 'unsubscribe':
+            if room in self.streams:
+                await self.unsubscribe(room)
+            await self.send_control('unsubscribed', name)
+
+        elif action == 'send':
+            if room not in self.streams:
+                return await self.send_control('error', name, error='not subscribed')
+            parsed = await parse_message_frame(self.user, frame)
+            if parsed is None:
+                return
+            if kind == 'user':
+                await post_chat_message(self.channel_layer, self.user, id, *parsed)
+            else:
+                await post_group_message(self.channel_layer, self.user, id, *parsed)
+
+        else:
+            await self.send_control('error', name, error='unknown action')
+
+    async def subscribe(self, room, name, kind, id, last_id):
+        if room in self.streams:
+            return await self.send_control('subscribed', name)
+        if len(self.streams) - 1 >= settings.MULTIPLEX_MAX_STREAMS:    # not counting the notifications
+            self.reject('too_many_streams')
+            return await self.send_control('error', name, error='too many streams')
+
+        if kind == 'user':
+            allowed = await are_friends(self.user.id, id)
+        else:
+            allowed = await is_groupmember(self.user.id, id)
+        if not allowed:
+            self.reject('not_friends' if kind == 'user' else 'not_member')
+            return await self.send_control('error', name, error='forbidden')
+
+        await self.channel_layer.group_add(room, self.channel_name)
+        self.streams[room] = (name, kind, id)
+        await self.mark_read(kind, id)
+        await self.send_control('subscribed', name)
+
+        missed_messages = partial(missed_chat_messages, conversation_key(self.user.id, id)) if kind == 'user' else partial(missed_group_messages, id)
+        await self.start_replay(room, last_id, missed_messages)
+
+    async def unsubscribe(self, room):
+        _, kind, id = self.streams.pop(room)
+        self.stop_replay(room)
+        await self.channel_layer.group_discard(room, self.channel_name)
+        if kind is not None:
+            await self.mark_read(kind, id)
+
+    async def mark_read(self, kind, id):
+        if kind == 'user':
+            await database_sync_to_async(mark_read)(self.user.id, friend_id=id)
+        else:
+            await database_sync_to_async(mark_read)(self.user.id, group_id=id)
+
+    # The frames are already encoded, they're wrapped without decoding them
+    async def send_stream(self, name, frame):
+        await self.send(text_data=f'{{"stream": "{name}", "payload": {frame}}}')
+
+    async def send_control(self, type, name, **fields):
+        await self.send_stream('control', encode({'type': type, 'stream': name, **fields}))
+
+    async def send_replay_frame(self, room, frame):
+        await self.send_stream(self.streams[room][0], frame)
+
+    async def chat_message(self, event):
+        stream = self.streams.get(event.get('group'))
+        if stream is None:    # unsubscribed in the meantime
+            return
+        if self.record_event(event['group'], event):
+            await self.send_stream(stream[0], event_frame(event))
+
+    async def send_notification(self, event):
+        await self.send_stream('notifications', event_frame(event))
+
+    async def disconnect(self, close_code):
+        for room in list(getattr(self, 'streams', {})):
+            await self.unsubscribe(room)
@@ -0,0 +1,77 @@
+from django.db.models import Case, When, F, Q, Value
+from django.utils import timezone
+from chat_app.models import ConversationSummary, conversation_key
+
+
+'''
+Conversation list (inbox) of the users.
+
+Every user has a ConversationSummary row per friend and per group, created when the friendship is accepted or the
+user joins the group (signals.py) and deleted when it ends. The consumers update the rows of a conversation with one
+UPDATE per received message: last message, time and sender, and one more unread message for everybody but the sender.
+The get-inbox endpoint reads a page of the user's rows ordered by recency, without touching the messages tables.
+'''
+
+
+PREVIEW_LENGTH = 200
+
+
+# Creating / deleting the rows (called by the signal receivers)
+
+def open_chat(user_a_id, user_b_id):
+    conversation = conversation_key(user_a_id, user_b_id)
+    ConversationSummary.objects.bulk_create([
+        ConversationSummary(user_id=user_a_id, friend_id=user_b_id, conversation=conversation),
+        ConversationSummary(user_id=user_b_id, friend_id=user_a_id, conversation=conversation),
+    ], ignore_conflicts=True)
+
+def close_chat(user_a_id, user_b_id):
+    ConversationSummary.objects.filter(conversation=conversation_key(user_a_id, user_b_id)).delete()
+
+def open_group(group_id, user_ids):
+    ConversationSummary.objects.bulk_create(
+        [ConversationSummary(user_id=user_id, group_id=group_id) for user_id in user_ids], ignore_conflicts=True,
+    )
+
+def close_group(group_id, user_ids=None):
+    summaries = ConversationSummary.objects.filter(group_id=group_id)
+    if user_ids is not None:
+        summaries = summaries.filter(user_id__in=user_ids)
+    summaries.delete()
+
+
+# Recording a received message in the rows of its conversation (called by the consumers)
+
+def record_chat_message(msg):
+    record_message(ConversationSummary.objects.filter(conversation=msg.conversation), msg)
+
+def record_group_message(msg):
+    record_message(ConversationSummary.objects.filter(group_id=msg.group_id), msg)
+
+def record_message(summaries, msg):
+    # Messages saved concurrently may be recorded out of order, the "last_*" fields only move forward
+    newer = Q(last_message_id__isnull=True) | Q(last_message_id__lt=msg.id)
+    latest = {
+        'last_message': Value(msg.message[:PREVIEW_LENGTH]),
+        'last_message_id': Value(msg.id),
+        'last_sender': Value(msg.sender_id),
+        'last_activity': Value(msg.time_stamp or timezone.now()),
+    }
+    summaries.update(
+        **{
+            field: Case(When(newer, then=value), default=F(field), output_field=ConversationSummary._meta.get_field(field))
+            for field, value in latest.items()
+        },
+        # The sender has read the conversation
+        unread_count=Case(When(user_id=msg.sender_id, then=Value(0)), default=F('unread_count') + 1),
+    )
+
+
+# Resetting the unread count when the user opens or leaves the conversation
+def mark_read(user_id, friend_id=None, group_id=None):
+    summaries = ConversationSummary.objects.filter(user_id=user_id, unread_count__gt=0)
+    if friend_id is not None:
+        summaries = summaries.filter(friend_id=friend_id)
+    else:
+        summaries = summaries.filter(group_id=group_id)
+    summaries.update(unread_count=0)
@@ -0,0 +1,99 @@
+from django.conf import settings
+from django.db import close_old_connections
+from asgiref.sync import SyncToAsync
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+
+'''
+Thread pool that runs the ORM work of the async views, consumers and middleware.
+
+asgiref's default (thread_sensitive) sync_to_async sends every call of the process to one thread, so concurrent
+requests and sockets wait for each other's queries. Calls made through "database_sync_to_async" below run on
+DB_EXECUTOR_THREADS threads instead, each thread with its own database connection (Django connections are per thread).
+
+The async queryset methods (aiterator(), acount(), afirst()...) are thread-sensitive sync_to_async calls as well, so
+the reads of the views and consumers are written as sync helpers (one per request where possible) called through
+database_sync_to_async, rather than with the async ORM.
+
+Each call must be self-contained, a transaction can't span two calls since they may run on different threads.
+Code running inside a transaction that awaits the database (the signal receivers) keeps using the thread-sensitive
+sync_to_async, which runs on the thread holding the transaction.
+'''
+
+
+class DBExecutor(ThreadPoolExecutor):
+
+    def __init__(self, max_workers):
+        super().__init__(max_workers=max_workers, thread_name_prefix='db')
+        self._stats_lock = threading.Lock()
+        self.queued = 0          # calls waiting for a free thread
+        self.running = 0
+        self.completed = 0
+        self.wait_total = 0.0    # seconds spent waiting for a thread, all calls
+        self.wait_max = 0.0
+
+    def submit(self, fn, /, *args, **kwargs):
+        submitted = time.perf_counter()
+        with self._stats_lock:
+            self.queued += 1
+
+        def run():
+            waited = time.perf_counter() - submitted
+            with self._stats_lock:
+                self.queued -= 1
+                self.running += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._stats_lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        return super().submit(run)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'threads': self._max_workers,
+                'queued': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'wait_avg_ms': self.wait_total / self.completed * 1000 if self.completed else 0,
+                'wait_max_ms': self.wait_max * 1000,
+            }
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = DBExecutor(settings.DB_EXECUTOR_THREADS)
+    return _executor
+
+
+# Same as channels' DatabaseSyncToAsync (connections that are too old or broken are closed around every call),
+# run on the DB executor
+class DatabaseSyncToAsync(SyncToAsync):
+
+    def __init__(self, func):
+        super().__init__(func, thread_sensitive=False, executor=get_executor())
+
+    def thread_handler(self, loop, *args, **kwargs):
+        close_old_connections()
+        try:
+            return super().thread_handler(loop, *args, **kwargs)
+        finally:
+            close_old_connections()
+
+
+# Drop-in replacement of sync_to_async / channels.db.database_sync_to_async for ORM calls
+def database_sync_to_async(func):
+    return DatabaseSyncToAsync(func)
@@ -0,0 +1,93 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password, verify_password
+from chat_app.db import database_sync_to_async
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import multiprocessing
+import threading
+import weakref
+
+
+'''
+Password hashing and checking (PBKDF2, hundreds of milliseconds of CPU) for login and signup, run in a pool of
+PASSWORD_HASHING_PROCESSES worker processes so it neither holds the GIL nor a DB executor thread.
+
+At most PASSWORD_HASHING_CONCURRENCY hashes are submitted to the pool at a time. A request waiting longer than
+PASSWORD_HASHING_TIMEOUT seconds for its turn gets HashingBusy, the views answer 503 instead of piling up.
+'''
+
+
+class HashingBusy(Exception):
+    pass
+
+
+# Worker processes: plain Django, set up once per process.
+# They import this module before django.setup() runs, so it must not import models at the top.
+
+def _init_worker():
+    import django
+    django.setup()
+
+def _hash(password):
+    return make_password(password)
+
+def _verify(password, encoded):
+    # (is_correct, must_update)
+    return verify_password(password, encoded)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_slots = weakref.WeakKeyDictionary()    # event loop -> semaphore
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(
+                    max_workers=settings.PASSWORD_HASHING_PROCESSES,
+                    mp_context=multiprocessing.get_context('spawn'),    # no fork of a process running threads and an event loop
+                    initializer=_init_worker,
+                )
+    return _pool
+
+
+async def _run(func, *args):
+    loop = asyncio.get_running_loop()
+    slots = _slots.get(loop)
+    if slots is None:
+        slots = _slots[loop] = asyncio.Semaphore(settings.PASSWORD_HASHING_CONCURRENCY)
+
+    try:
+        await asyncio.wait_for(slots.acquire(), settings.PASSWORD_HASHING_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HashingBusy()
+    try:
+        return await loop.run_in_executor(get_pool(), func, *args)
+    finally:
+        slots.release()
+
+
+async def hash_password(password):
+    return await _run(_hash, password)
+
+
+# Same checks as django.contrib.auth's ModelBackend.authenticate, returns the user or None.
+# The password is re-hashed when the hasher or its work factor changed.
+async def authenticate_user(username, password):
+    User = get_user_model()
+    user = await database_sync_to_async(User.objects.filter(username=username).first)()
+    if user is None:
+        await _run(_hash, password)    # same work as for an existing user, like ModelBackend (no timing difference)
+        return None
+
+    is_correct, must_update = await _run(_verify, password, user.password)
+    if not is_correct or not user.is_active:
+        return None
+
+    if must_update:
+        user.password = await hash_password(password)
+        await database_sync_to_async(user.save)(update_fields=['password'])
+    return user
@@ -0,0 +1,70 @@
+from django.conf import settings
+from django.core.files.base import ContentFile
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps, UnidentifiedImageError
+import asyncio
+import io
+import os
+import threading
+
+
+'''
+Profile and group pictures.
+
+Uploads are checked (IMAGE_MAX_UPLOAD_BYTES, IMAGE_MAX_PIXELS, decodable image) and turned into a square
+THUMBNAIL_SIZE px WebP thumbnail, stored in the model's "thumbnail" field next to the original. Every payload sends
+the thumbnail URL (model.avatar_url / models.avatar_url()), the original stays available for the profile pages.
+
+Decoding and resizing run on a small thread pool (Pillow releases the GIL while it works), not on the event loop.
+'''
+
+
+class ImageRejected(Exception):
+    pass
+
+
+# Image.open refuses images over twice this many pixels before decoding them, thumbnail_bytes() checks the limit itself
+Image.MAX_IMAGE_PIXELS = settings.IMAGE_MAX_PIXELS
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(settings.IMAGE_THREADS, thread_name_prefix='images')
+    return _executor
+
+
+# Returns the WebP thumbnail bytes of the image file, raises ImageRejected for files that aren't acceptable images
+def thumbnail_bytes(file, size=None):
+    size = size or settings.THUMBNAIL_SIZE
+    if file.size is not None and file.size > settings.IMAGE_MAX_UPLOAD_BYTES:
+        raise ImageRejected(f'The image is larger than {settings.IMAGE_MAX_UPLOAD_BYTES // (1024 * 1024)} MB')
+
+    try:
+        file.seek(0)
+        with Image.open(file) as image:
+            if image.width * image.height > settings.IMAGE_MAX_PIXELS:
+                raise ImageRejected('The image has too many pixels')
+            image.draft('RGB', (size * 2, size * 2))    # JPEG: decoding at a reduced scale when it's much larger
+            image = ImageOps.exif_transpose(image)
+            image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+            thumbnail = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError) as error:
+        raise ImageRejected('The file is not a valid image') from error
+    finally:
+        file.seek(0)
+
+    output = io.BytesIO()
+    thumbnail.save(output, 'WEBP', quality=settings.THUMBNAIL_QUALITY, method=4)
+    return output.getvalue()
+
+# Thumbnail file of an uploaded picture, to assign to the model's "thumbnail" field
+async def make_thumbnail(file):
+    data = await asyncio.get_running_loop().run_in_executor(get_executor(), thumbnail_bytes, file)
+    name = os.path.splitext(os.path.basename(file.name))[0]
+    return ContentFile(data, name=f'{name}.webp')
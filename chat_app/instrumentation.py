@@ -0,0 +1,144 @@
+from django.conf import settings
+from chat_app.metrics import Counter as MetricCounter, Histogram
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+import logging
+import re
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Query counts and DB time per HTTP request and per WebSocket event.
+
+QueryCountMiddleware (chat_app/middleware.py) runs every request, and QueryCountMixin the WebSocket messages of a
+consumer (INSTRUMENTED_MESSAGES), in instrument(). The channel layer events aren't instrumented: a group fan-out
+delivers one to every member's socket, and they only write the frame that was encoded once (chat_app/broadcast.py). A database execute wrapper installed on every connection (install_query_recorder, see apps.py) adds the
+queries run meanwhile to the current QueryStats: count, time, and fingerprint (the SQL with literals and IN lists
+collapsed). The ORM threads see the current QueryStats too, sync_to_async and database_sync_to_async run the calls in a
+copy of the caller's context.
+
+At the end of a request / event:
+  - an INFO log line (when INFO is enabled), the numbers are also in the record's "query_stats" attribute for
+    structured log handlers
+  - a WARNING per fingerprint run QUERY_REPEAT_THRESHOLD times or more (an N+1 pattern)
+  - the endpoint's histograms of query counts and DB time are updated (the chat_endpoint_* metrics, per-thread cells
+    without a lock, see chat_app/metrics.py)
+  - QueryCountMiddleware adds X-DB-Queries / X-DB-Time-Ms / X-DB-Repeated headers when DEBUG is on
+'''
+
+
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+TIME_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 1000)
+
+INSTRUMENTED_MESSAGES = ('websocket.connect', 'websocket.receive', 'websocket.disconnect')
+
+endpoint_queries = Histogram('chat_endpoint_queries', 'Queries per HTTP request / WebSocket event', ['endpoint'], buckets=QUERY_BUCKETS)
+endpoint_db_ms = Histogram('chat_endpoint_db_milliseconds', 'DB time per HTTP request / WebSocket event', ['endpoint'], buckets=TIME_BUCKETS_MS)
+endpoint_repeated = MetricCounter('chat_endpoint_repeated_queries', 'HTTP requests / WebSocket events with repeated queries (N+1)', ['endpoint'])
+
+current_stats = ContextVar('query_stats', default=None)
+
+_in_list = re.compile(r'\(\s*%s(?:\s*,\s*%s)+\s*\)')
+_literal = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+_transaction = re.compile(r'^\s*(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE)\b', re.IGNORECASE)
+
+
+# SQL of a query with its literals and IN lists collapsed, the same for every run of a query pattern.
+# None for the transaction statements, which repeat in every transaction.
+@lru_cache(maxsize=2048)
+def fingerprint(sql):
+    if _transaction.match(sql):
+        return None
+    return _literal.sub('?', _in_list.sub('(...)', sql))
+
+
+class QueryStats:
+
+    def __init__(self, endpoint=None):
+        self.endpoint = endpoint
+        self.queries = 0
+        self.time = 0.0    # seconds
+        self.fingerprints = Counter()
+        self._lock = threading.Lock()    # queries of one request may run on several ORM threads
+
+    def add(self, sql, duration):
+        key = fingerprint(sql)
+        with self._lock:
+            self.queries += 1
+            self.time += duration
+            if key is not None:
+                self.fingerprints[key] += 1
+
+    # [(fingerprint, count)] of the queries run "threshold" times or more
+    def repeated(self, threshold=None):
+        threshold = threshold or settings.QUERY_REPEAT_THRESHOLD
+        with self._lock:
+            return [(key, count) for key, count in self.fingerprints.most_common() if count >= threshold]
+
+    def as_dict(self):
+        return {
+            'endpoint': self.endpoint,
+            'queries': self.queries,
+            'db_ms': round(self.time * 1000, 3),
+            'repeated': dict(self.repeated()),
+        }
+
+
+# Execute wrapper of the connections, a no-op outside instrument()
+def record_query(execute, sql, params, many, context):
+    stats = current_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    begin = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.add(sql, time.perf_counter() - begin)
+
+# connection_created receiver
+def install_query_recorder(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def report(stats):
+    repeated = stats.repeated()
+    endpoint_queries.labels(stats.endpoint).observe(stats.queries)
+    endpoint_db_ms.labels(stats.endpoint).observe(stats.time * 1000)
+    if repeated:
+        endpoint_repeated.labels(stats.endpoint).inc()
+
+    if not repeated and not logger.isEnabledFor(logging.INFO):
+        return
+    data = stats.as_dict()
+    logger.info('%s: %d queries, %.1f ms', stats.endpoint, stats.queries, stats.time * 1000, extra={'query_stats': data})
+    for key, count in data['repeated'].items():
+        logger.warning('Repeated query in %s (%d times): %s', stats.endpoint, count, key, extra={'query_stats': data})
+
+
+# Records the queries run inside the block. The endpoint may be set on the yielded QueryStats until the block ends.
+@contextmanager
+def instrument(endpoint=None):
+    stats = QueryStats(endpoint)
+    token = current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        current_stats.reset(token)
+        report(stats)
+
+
+# Mixin of the consumers, instrumenting the WebSocket messages they handle ("<Consumer>.<message type>")
+class QueryCountMixin:
+
+    async def dispatch(self, message):
+        if message['type'] not in INSTRUMENTED_MESSAGES:
+            return await super().dispatch(message)
+        with instrument(f"{type(self).__name__}.{message['type']}"):
+            await super().dispatch(message)
@@ -0,0 +1,115 @@
+from django.db import transaction
+from channels.layers import get_channel_layer
+from chat_app.cache import authz_cache
+from chat_app.auth import user_cache, token_cache
+from chat_app.layers import layer_is_shared
+from chat_app.outbox import enqueue
+import asyncio
+import json
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Invalidation of the in-process caches (chat_app/cache.py, chat_app/auth.py) in every worker process.
+
+The signal receivers call the invalidate_* functions below. The entries are dropped in this process at once and once
+more when the transaction commits, so a check running between the two can't keep the old value cached. With a channel
+layer shared by several processes (CHANNEL_LAYER=sqlite), the invalidation is also written to the outbox
+(chat_app/outbox.py) in the transaction of the change: after the commit the publisher sends it to INVALIDATION_GROUP,
+which every process joins with its listener (started by CacheInvalidationMiddleware in asgi.py), and the other
+processes drop the same entries. Invalidations travel by name, with JSON arguments (INVALIDATIONS).
+'''
+
+
+INVALIDATION_GROUP = 'cache_invalidation'
+HANDLER = 'cache_invalidate'
+
+
+def drop_authz(*keys):
+    authz_cache.delete(*(tuple(key) for key in keys))    # JSON turns the key tuples into lists
+
+def drop_group_members(group_id):
+    authz_cache.delete_where(lambda key, value: key[0] == 'member' and key[1] == group_id)
+
+def drop_user_groups(user_id):
+    authz_cache.delete_where(lambda key, value: key[0] == 'member' and key[2] == user_id)
+
+# Cached user principal and verified tokens of a changed or deleted user
+def drop_user(user_id):
+    user_cache.delete(user_id)
+    token_cache.delete_where(lambda token, payload: payload.get('user_id') == user_id)
+
+
+INVALIDATIONS = {
+    'authz': drop_authz,
+    'group_members': drop_group_members,
+    'user_groups': drop_user_groups,
+    'user': drop_user,
+}
+
+
+def invalidate(name, *args):
+    INVALIDATIONS[name](*args)
+    transaction.on_commit(lambda: INVALIDATIONS[name](*args))
+    if layer_is_shared():
+        enqueue([(INVALIDATION_GROUP, {'type': HANDLER, 'frame': json.dumps([name, args])})])
+
+def invalidate_authz(*keys):
+    invalidate('authz', *keys)
+
+def invalidate_group_members(group_id):
+    invalidate('group_members', group_id)
+
+def invalidate_user_groups(user_id):
+    invalidate('user_groups', user_id)
+
+def invalidate_user(user_id):
+    invalidate('user', user_id)
+
+
+# Applies the invalidations sent by the processes (this one included) until cancelled
+async def listen(layer):
+    channel = await layer.new_channel()
+    refresh = asyncio.get_running_loop().create_task(keep_membership(layer, channel))
+    try:
+        while True:
+            message = await layer.receive(channel)
+            try:
+                name, args = json.loads(message['frame'])
+                INVALIDATIONS[name](*args)
+            except Exception:
+                logger.exception('Invalid cache invalidation %r', message)
+    finally:
+        refresh.cancel()
+
+# Joins INVALIDATION_GROUP again before the membership expires (group_expiry of the layer)
+async def keep_membership(layer, channel):
+    while True:
+        await layer.group_add(INVALIDATION_GROUP, channel)
+        await asyncio.sleep(getattr(layer, 'group_expiry', 86400) / 2)
+
+
+listener = None
+
+# Starts this process's listener on the running event loop (once), when other processes share the layer
+def start_listener():
+    global listener
+    loop = asyncio.get_running_loop()
+    if (listener is None or listener.done() or listener.get_loop() is not loop) and layer_is_shared():
+        listener = loop.create_task(listen(get_channel_layer()))
+    return listener
+
+
+# ASGI middleware starting the listener with the first connection/request handled by the process
+class CacheInvalidationMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'lifespan':
+            start_listener()
+        return await self.app(scope, receive, send)
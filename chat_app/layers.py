@@ -0,0 +1,400 @@
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer, InMemoryChannelLayer, get_channel_layer
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import base64
+import json
+import logging
+import sqlite3
+import time
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+'''
+Channel layer that delivers messages between several worker processes on the same host through a shared
+WAL-mode SQLite file, without any external broker.
+
+- Every process polls one "inbox" row range for its specific channels ("specific.<client id>!<channel id>")
+  and hands the messages to local asyncio queues, like the Redis layer's receive buffer.
+- Messages to a channel of the same process skip the database entirely.
+- Group membership, message/group expiry and per-channel capacity follow the InMemory/Redis layers.
+
+Settings example:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'chat_app.layers.SQLiteChannelLayer',
+            'CONFIG': {'path': BASE_DIR / 'channels.sqlite3'},
+        },
+    }
+'''
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel TEXT NOT NULL,
+    inbox TEXT NOT NULL,
+    expires REAL NOT NULL,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_inbox ON messages (inbox, id);
+CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel);
+CREATE INDEX IF NOT EXISTS messages_expires ON messages (expires);
+
+CREATE TABLE IF NOT EXISTS groups (
+    name TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (name, channel)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS groups_channel ON groups (channel);
+'''
+
+
+# Messages are dicts of JSON types plus bytes (the ASGI message format), bytes are stored as base64
+def _default(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    raise TypeError(f'Object of type {type(value).__name__} is not channel layer serializable')
+
+def _object_hook(value):
+    if len(value) == 1 and '__bytes__' in value:
+        return base64.b64decode(value['__bytes__'])
+    return value
+
+def serialize(message):
+    return json.dumps(message, default=_default, separators=(',', ':'))
+
+def deserialize(body):
+    return json.loads(body, object_hook=_object_hook)
+
+
+class SQLiteChannelLayer(BaseChannelLayer):
+
+    extensions = ['groups', 'flush']
+
+    def __init__(
+        self,
+        path='channels.sqlite3',
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        poll_interval=0.002,        # delay between inbox polls right after a message was received
+        max_poll_interval=0.02,     # delay between inbox polls when idle
+        cleanup_interval=1,
+        batch_size=500,
+        **kwargs,
+    ):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.path = str(path)
+        self.group_expiry = group_expiry
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.cleanup_interval = cleanup_interval
+        self.batch_size = batch_size
+
+        self.client_id = uuid.uuid4().hex[:12]
+        self._inboxes = set()     # inboxes (non-local channel names) polled by this process
+        self._queues = {}         # local channel name -> asyncio.Queue of (expires, message)
+        self._poller = None
+        self._loop = None
+        self._conn = None
+        # sqlite3 connections are used from a single thread, so every database call goes through this executor
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-channel-layer')
+
+    # Database access (runs in the layer's thread)
+
+    def _connection(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _db_send(self, rows, capacities):
+        # rows: [(channel, inbox, expires, body)], capacities: {channel: capacity}
+        # Returns the channels that were full (their messages are not stored)
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            channels = list(capacities)
+            counts = {}
+            for i in range(0, len(channels), 500):
+                chunk = channels[i:i + 500]
+                counts.update(conn.execute(
+                    'SELECT channel, COUNT(*) FROM messages WHERE channel IN (%s) GROUP BY channel' % ','.join('?' * len(chunk)),
+                    chunk,
+                ).fetchall())
+            full = {channel for channel, capacity in capacities.items() if counts.get(channel, 0) >= capacity}
+            conn.executemany(
+                'INSERT INTO messages (channel, inbox, expires, body) VALUES (?, ?, ?, ?)',
+                [row for row in rows if row[0] not in full],
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return full
+
+    def _db_fetch(self, inboxes):
+        # Takes (and deletes) the next batch of messages of this process's inboxes.
+        # Nobody else reads these inboxes, so the rows are read outside of a write transaction (WAL readers never block)
+        # and the write lock is only taken when there is something to delete.
+        conn = self._connection()
+        placeholders = ','.join('?' * len(inboxes))
+        rows = conn.execute(
+            'SELECT id, channel, expires, body FROM messages WHERE inbox IN (%s) ORDER BY id LIMIT ?' % placeholders,
+            (*inboxes, self.batch_size),
+        ).fetchall()
+        if rows:
+            # Writers are serialized, so no message with a smaller id can show up after this read
+            conn.execute('DELETE FROM messages WHERE inbox IN (%s) AND id <= ?' % placeholders, (*inboxes, rows[-1][0]))
+        return [(channel, expires, body) for _, channel, expires, body in rows]
+
+    def _db_fetch_one(self, channel):
+        # Takes (and deletes) the oldest message of a normal channel, which several processes may be receiving from
+        conn = self._connection()
+        if conn.execute('SELECT 1 FROM messages WHERE inbox = ? LIMIT 1', (channel,)).fetchone() is None:
+            return None
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT id, expires, body FROM messages WHERE inbox = ? ORDER BY id LIMIT 1', (channel,)).fetchone()
+            if row:
+                conn.execute('DELETE FROM messages WHERE id = ?', (row[0],))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return row
+
+    def _db_group_memberships(self, groups):
+        # [(group, channel)] of many groups, read in one transaction
+        conn = self._connection()
+        now = time.time()
+        memberships = []
+        conn.execute('BEGIN')
+        try:
+            for i in range(0, len(groups), 500):
+                chunk = groups[i:i + 500]
+                memberships.extend(conn.execute(
+                    'SELECT name, channel FROM groups WHERE name IN (%s) AND expires > ?' % ','.join('?' * len(chunk)),
+                    (*chunk, now),
+                ).fetchall())
+        finally:
+            conn.execute('COMMIT')
+        return memberships
+
+    def _db_execute(self, sql, params=()):
+        self._connection().execute(sql, params)
+
+    def _db_cleanup(self, local_expired_channels):
+        # Channels with expired messages are considered dead and removed from all groups (same as the other layers)
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            dead = {row[0] for row in conn.execute('SELECT DISTINCT channel FROM messages WHERE expires < ?', (now,))}
+            dead.update(local_expired_channels)
+            conn.executemany('DELETE FROM groups WHERE channel = ?', [(channel,) for channel in dead])
+            conn.execute('DELETE FROM messages WHERE expires < ?', (now,))
+            conn.execute('DELETE FROM groups WHERE expires < ?', (now,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _db_flush(self):
+        conn = self._connection()
+        conn.execute('DELETE FROM messages')
+        conn.execute('DELETE FROM groups')
+
+    # Local delivery
+
+    def _is_local(self, channel):
+        return '!' in channel and self.non_local_name(channel) in self._inboxes
+
+    def _queue(self, channel):
+        queue = self._queues.get(channel)
+        if queue is None:
+            queue = self._queues[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        return queue
+
+    def _deliver(self, channel, expires, message):
+        try:
+            self._queue(channel).put_nowait((expires, message))
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def _ensure_poller(self):
+        loop = asyncio.get_running_loop()
+        if self._poller is None or self._poller.done() or self._loop is not loop:
+            # A new event loop (e.g. a new test) starts from a clean local state
+            if self._loop is not None and self._loop is not loop:
+                self._queues = {}
+            self._loop = loop
+            self._poller = loop.create_task(self._poll())
+
+    async def _poll(self):
+        delay = self.poll_interval
+        next_cleanup = time.monotonic() + self.cleanup_interval
+        while True:
+            try:
+                rows = await self._run(self._db_fetch, tuple(self._inboxes))
+                now = time.time()
+                for channel, expires, body in rows:
+                    if expires >= now:
+                        self._deliver(channel, expires, deserialize(body))
+
+                if time.monotonic() >= next_cleanup:
+                    await self._run(self._db_cleanup, self._clean_local_expired())
+                    next_cleanup = time.monotonic() + self.cleanup_interval
+            except sqlite3.Error:
+                # e.g. the database stayed locked longer than the timeout, try again on the next poll
+                logger.exception('SQLite channel layer poll failed')
+                rows = []
+
+            if len(rows) >= self.batch_size:
+                continue
+            delay = self.poll_interval if rows else min(delay * 2, self.max_poll_interval)
+            await asyncio.sleep(delay)
+
+    # Drops expired messages from the local queues, returns the channels they belonged to
+    def _clean_local_expired(self):
+        now = time.time()
+        expired = []
+        for channel, queue in list(self._queues.items()):
+            if not queue.empty() and queue._queue[0][0] < now:
+                while not queue.empty() and queue._queue[0][0] < now:
+                    queue.get_nowait()
+                expired.append(channel)
+                if queue.empty():
+                    self._queues.pop(channel, None)
+        return expired
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        assert '__asgi_channel__' not in message
+
+        expires = time.time() + self.expiry
+        if self._is_local(channel):
+            if not self._deliver(channel, expires, deserialize(serialize(message))):    # copied, like the other layers do
+                raise ChannelFull(channel)
+            return
+
+        full = await self._run(
+            self._db_send,
+            [(channel, self.non_local_name(channel), expires, serialize(message))],
+            {channel: self.get_capacity(channel)},
+        )
+        if full:
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+
+        if '!' in channel:
+            inbox = self.non_local_name(channel)
+            assert inbox.endswith(f'{self.client_id}!'), 'Specific channels can only be received by the process that created them'
+            self._inboxes.add(inbox)
+            self._ensure_poller()
+            queue = self._queue(channel)
+            while True:
+                try:
+                    expires, message = await queue.get()
+                except asyncio.CancelledError:
+                    # The consumer is closing, forget its queue unless messages are still pending
+                    if queue.empty() and self._queues.get(channel) is queue:
+                        self._queues.pop(channel, None)
+                    raise
+                if expires >= time.time():
+                    return message
+
+        # Normal channels can be shared by several processes, each receive takes one message from the database
+        delay = self.poll_interval
+        while True:
+            row = await self._run(self._db_fetch_one, channel)
+            if row is None:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_poll_interval)
+            elif row[1] >= time.time():
+                return deserialize(row[2])
+
+    async def new_channel(self, prefix='specific.'):
+        self._inboxes.add(f'{prefix}{self.client_id}!')
+        return f'{prefix}{self.client_id}!{uuid.uuid4().hex}'
+
+    async def flush(self):
+        self._queues = {}
+        await self._run(self._db_flush)
+
+    async def close(self):
+        if self._poller is not None:
+            self._poller.cancel()
+            self._poller = None
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        await self._run(
+            self._db_execute,
+            'INSERT OR REPLACE INTO groups (name, channel, expires) VALUES (?, ?, ?)',
+            (group, channel, time.time() + self.group_expiry),
+        )
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), 'Invalid channel name'
+        assert self.valid_group_name(group), 'Invalid group name'
+        await self._run(self._db_execute, 'DELETE FROM groups WHERE name = ? AND channel = ?', (group, channel))
+
+    async def group_send(self, group, message):
+        await self.group_send_many([(group, message)])
+
+    # Sends [(group, message)] with one membership lookup and one insert transaction for all the groups
+    # (see chat_app.broadcast.group_send_many)
+    async def group_send_many(self, messages):
+        for group, message in messages:
+            assert isinstance(message, dict), 'Message is not a dict'
+            assert self.valid_group_name(group), 'Invalid group name'
+
+        groups = tuple({group for group, _ in messages})
+        memberships = await self._run(self._db_group_memberships, groups)
+        if not memberships:
+            return
+        channels_by_group = {}
+        for group, channel in memberships:
+            channels_by_group.setdefault(group, []).append(channel)
+
+        expires = time.time() + self.expiry
+        rows = []
+        capacities = {}
+        for group, message in messages:
+            body = serialize(message)
+            for channel in channels_by_group.get(group, ()):
+                if self._is_local(channel):
+                    self._deliver(channel, expires, deserialize(body))    # a full channel just misses the message
+                else:
+                    rows.append((channel, self.non_local_name(channel), expires, body))
+                    capacities[channel] = self.get_capacity(channel)
+
+        if rows:
+            await self._run(self._db_send, rows, capacities)
+
+
+# Whether the channel layer delivers messages between processes (InMemoryChannelLayer only reaches its own process)
+def layer_is_shared(layer=None):
+    return not isinstance(layer or get_channel_layer(), InMemoryChannelLayer)
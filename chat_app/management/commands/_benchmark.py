@@ -0,0 +1,26 @@
+from contextlib import contextmanager
+from django.db import connection
+import os
+import shutil
+import tempfile
+
+
+# Runs a benchmark against a throwaway, fully migrated SQLite file instead of the project's database
+@contextmanager
+def benchmark_database():
+    directory = tempfile.mkdtemp()
+    connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(directory, 'benchmark.sqlite3')
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+# Value at the given percentile (0-100) of a list of numbers
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
@@ -0,0 +1,98 @@
+from django.core.management.base import BaseCommand
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.handlers.asgi import ASGIHandler, ASGIRequest
+from django.http import JsonResponse
+from django.test import AsyncRequestFactory
+from django.test.utils import override_settings
+from asgiref.sync import sync_to_async
+from chat_app.models import CustomUser
+from chat_app.auth import generate_jwt_token
+from chat_app import views
+from chat_app.management.commands._benchmark import benchmark_database
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+
+BLOCK_SIZE = 64 * 1024    # body bytes per ASGI "http.request" message, like a server reading the socket
+
+
+# An upload in one request whose body is read whole (request.body), then saved
+async def body_upload(request):
+    name = await sync_to_async(default_storage.save)('attachments/upload.bin', ContentFile(request.body))
+    return JsonResponse({'name': name})
+
+
+class Command(BaseCommand):
+    help = "Measures the Python memory peak and throughput of concurrent large attachment uploads"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--uploads', type=int, default=4, help="Concurrent uploads")
+        parser.add_argument('--size-mb', type=int, default=100, help="Size of every upload")
+
+    def handle(self, *args, **options):
+        media_root = tempfile.mkdtemp()
+        try:
+            with benchmark_database(), override_settings(MEDIA_ROOT=media_root, DATA_UPLOAD_MAX_MEMORY_SIZE=None):
+                user = CustomUser.objects.create(username='bench@x.com')
+                token = generate_jwt_token(user.id, user.username)
+                size = options['size_mb'] * 1024 * 1024
+
+                self.stdout.write(f"{options['uploads']} concurrent uploads of {options['size_mb']} MB")
+                self.stdout.write(f"{'upload':>8} {'seconds':>8} {'MB/s':>7} {'peak MB':>8}")
+                for name, upload in (('body', self.body_upload), ('chunked', self.chunked_upload)):
+                    tracemalloc.start()
+                    begin = time.perf_counter()
+                    asyncio.run(self.run(upload, token, size, options['uploads']))
+                    elapsed = time.perf_counter() - begin
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    self.stdout.write(
+                        f"{name:>8} {elapsed:>8.2f} {options['uploads'] * size / elapsed / 1024 / 1024:>7.1f} {peak / 1024 / 1024:>8.1f}"
+                    )
+        finally:
+            shutil.rmtree(media_root, ignore_errors=True)
+
+    async def run(self, upload, token, size, uploads):
+        await asyncio.gather(*(upload(token, size) for _ in range(uploads)))
+
+    # A request whose body arrives in BLOCK_SIZE messages, read by Django's ASGI handler (spooled to a temporary file
+    # over FILE_UPLOAD_MAX_MEMORY_SIZE)
+    async def request(self, path, block, length):
+        sent = 0
+
+        async def receive():
+            nonlocal sent
+            body = block[:min(BLOCK_SIZE, length - sent)]
+            sent += len(body)
+            await asyncio.sleep(0)    # other uploads' messages arrive in between
+            return {'type': 'http.request', 'body': body, 'more_body': sent < length}
+
+        scope = {
+            'type': 'http', 'method': 'POST', 'path': path.split('?')[0], 'query_string': path.partition('?')[2].encode(),
+            'headers': [(b'content-type', b'application/octet-stream'), (b'content-length', str(length).encode())],
+        }
+        body_file = await ASGIHandler().read_body(receive)
+        return ASGIRequest(scope, body_file), body_file
+
+    async def body_upload(self, token, size):
+        request, body_file = await self.request('/', os.urandom(BLOCK_SIZE), size)
+        with body_file:
+            await body_upload(request)
+
+    async def chunked_upload(self, token, size):
+        block = os.urandom(BLOCK_SIZE)
+        request = AsyncRequestFactory().post('/', {'tk': token, 'name': 'upload.bin', 'size': size})
+        state = json.loads((await views.create_upload(request)).content)
+
+        offset = 0
+        while offset < size:
+            request, body_file = await self.request(f"/?tk={token}&offset={offset}", block, min(state['chunk_size'], size - offset))
+            with body_file:
+                response = await views.upload_chunk(request, state['upload_id'])
+            offset = json.loads(response.content)['offset']
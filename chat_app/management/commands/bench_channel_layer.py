@@ -0,0 +1,85 @@
+from django.core.management.base import BaseCommand
+from channels.exceptions import ChannelFull
+from chat_app.layers import SQLiteChannelLayer
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+
+
+# One benchmark worker process: sends its share of the messages and receives everything addressed to it
+def run_worker(path, index, workers, messages, mode, channels, ready, start, results):
+
+    async def main():
+        layer = SQLiteChannelLayer(path=path, capacity=100000)
+        channel = await layer.new_channel()
+        await layer.group_add('bench', channel)
+        channels[index] = channel
+        ready.wait()
+        start.wait()
+
+        if mode == 'group':
+            expected = messages * workers     # every worker receives every broadcast
+        else:
+            expected = messages               # round robin: every worker receives as many as it sends
+
+        async def send_all():
+            for i in range(messages):
+                message = {'type': 'bench.message', 'n': i, 'text': 'x' * 64}
+                while True:
+                    try:
+                        if mode == 'group':
+                            await layer.group_send('bench', message)
+                        else:
+                            await layer.send(channels[(index + i + 1) % workers], message)
+                        break
+                    except ChannelFull:
+                        await asyncio.sleep(0.001)
+
+        async def receive_all():
+            for _ in range(expected):
+                await layer.receive(channel)
+
+        begin = time.perf_counter()
+        await asyncio.gather(send_all(), receive_all())
+        results[index] = time.perf_counter() - begin
+        await layer.close()
+
+    asyncio.run(main())
+
+
+class Command(BaseCommand):
+    help = "Measures SQLiteChannelLayer messages per second against the number of worker processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+        parser.add_argument('--messages', type=int, default=2000, help="Messages sent by each worker")
+        parser.add_argument('--mode', choices=['send', 'group'], default='send', help="Point to point sends or group broadcasts")
+
+    def handle(self, *args, **options):
+        context = multiprocessing.get_context('fork')
+        self.stdout.write(f"{'workers':>8} {'delivered':>10} {'seconds':>8} {'msg/s':>10}")
+
+        for workers in options['workers']:
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'channels.sqlite3')
+                with context.Manager() as manager:
+                    channels = manager.list([None] * workers)
+                    results = manager.list([None] * workers)
+                    ready = context.Barrier(workers + 1)
+                    start = context.Barrier(workers + 1)
+                    processes = [
+                        context.Process(target=run_worker, args=(path, i, workers, options['messages'], options['mode'], channels, ready, start, results))
+                        for i in range(workers)
+                    ]
+                    for process in processes:
+                        process.start()
+                    ready.wait()    # every channel is created and known
+                    start.wait()
+                    for process in processes:
+                        process.join()
+
+                    elapsed = max(results)
+                    delivered = options['messages'] * workers * (workers if options['mode'] == 'group' else 1)
+                    self.stdout.write(f"{workers:>8} {delivered:>10} {elapsed:>8.2f} {delivered / elapsed:>10.0f}")
@@ -0,0 +1,76 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from asgiref.sync import sync_to_async
+from chat_app.models import CustomUser, ChatMsg, FriendRequest, conversation_key
+from chat_app.pagination import keyset_page
+from chat_app.db import database_sync_to_async, get_executor
+from chat_app.management.commands._benchmark import benchmark_database, percentile
+import asyncio
+import random
+import time
+
+
+# A page of chat history, as read by the history endpoint
+def read_history(user_id, friend_id, limit):
+    if FriendRequest.between(user_id, friend_id).filter(accepted=True).exists():
+        return keyset_page(ChatMsg.objects.filter(conversation=conversation_key(user_id, friend_id)), limit)
+
+
+class Command(BaseCommand):
+    help = "Compares chat history reads through the thread-sensitive sync_to_async and through the DB executor"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32, 64], help="Concurrent readers")
+        parser.add_argument('--requests', type=int, default=2000, help="Reads made at every concurrency level")
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--messages', type=int, default=20000)
+        parser.add_argument('--io-latency', type=float, default=0, help="Milliseconds added to every query, like the round trip to a database server")
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            CustomUser.objects.bulk_create([CustomUser(username=f'bench{i}') for i in range(options['users'])])
+            user_ids = list(CustomUser.objects.values_list('id', flat=True))
+            pairs = [(a, b) for a in user_ids for b in user_ids if a < b]
+            FriendRequest.objects.bulk_create([
+                FriendRequest(from_user_id=a, to_user_id=b, user_low_id=a, user_high_id=b, accepted=True) for a, b in pairs    # a < b
+            ])
+            messages = []
+            for i in range(options['messages']):
+                sender, receiver = random.choice(pairs)
+                messages.append(ChatMsg(sender_id=sender, receiver_id=receiver, message=f'message {i}', conversation=conversation_key(sender, receiver)))
+            ChatMsg.objects.bulk_create(messages, batch_size=1000)
+
+            self.stdout.write(f"{'executor':>15} {'readers':>8} {'reads/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+            for concurrency in options['concurrency']:
+                for name, wrapper in (('thread_sensitive', sync_to_async), ('db_executor', database_sync_to_async)):
+                    elapsed, latencies = asyncio.run(self.run(wrapper, pairs, concurrency, options['requests'], options['io_latency'] / 1000))
+                    self.stdout.write(
+                        f"{name:>15} {concurrency:>8} {len(latencies) / elapsed:>8.0f} "
+                        f"{percentile(latencies, 50) * 1000:>8.2f} {percentile(latencies, 99) * 1000:>8.2f}"
+                    )
+            self.stdout.write(f"db executor: {get_executor().stats()}")
+
+    async def run(self, wrapper, pairs, concurrency, requests, io_latency):
+        latencies = []
+
+        def delay(execute, sql, params, many, context):
+            time.sleep(io_latency)
+            return execute(sql, params, many, context)
+
+        def read_history_with_latency(*args):
+            with connection.execute_wrapper(delay):
+                return read_history(*args)
+
+        read = wrapper(read_history_with_latency if io_latency else read_history)
+        remaining = iter(range(requests))
+
+        async def reader():
+            for _ in remaining:
+                user_id, friend_id = random.choice(pairs)
+                begin = time.perf_counter()
+                await read(user_id, friend_id, 50)
+                latencies.append(time.perf_counter() - begin)
+
+        begin = time.perf_counter()
+        await asyncio.gather(*(reader() for _ in range(concurrency)))
+        return time.perf_counter() - begin, latencies
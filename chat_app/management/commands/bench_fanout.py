@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+from channels.layers import InMemoryChannelLayer
+from chat_app.broadcast import make_event, event_frame, encode
+import asyncio
+import time
+
+
+# The old chat_message handler, encoding the event for every recipient
+def per_recipient_frame(event):
+    return encode(event)
+
+
+class Command(BaseCommand):
+    help = "Compares encoding a broadcast once per recipient with sending a pre-encoded frame"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 5000], help="Group sizes")
+        parser.add_argument('--messages', type=int, default=5, help="Broadcasts sent to each group")
+
+    def handle(self, *args, **options):
+        # "total" includes the channel layer's own delivery, "handlers" only the work of the consumers' handlers
+        self.stdout.write(f"{'members':>8} {'mode':>14} {'total s':>8} {'handlers s':>10} {'frames/s':>10}")
+        for size in options['sizes']:
+            for mode in ('per_recipient', 'pre_encoded'):
+                total, handlers = asyncio.run(self.run(size, options['messages'], mode))
+                frames = size * options['messages']
+                self.stdout.write(f"{size:>8} {mode:>14} {total:>8.3f} {handlers:>10.4f} {frames / handlers:>10.0f}")
+
+    async def run(self, size, messages, mode):
+        layer = InMemoryChannelLayer(capacity=messages + 1)
+        channels = [await layer.new_channel() for _ in range(size)]
+        for channel in channels:
+            await layer.group_add('bench', channel)
+
+        payload = {
+            'id': 1,
+            'message': 'x' * 200,
+            'username': 'bench_user',
+            'name': 'Bench User',
+            'user_id': 1,
+            'user_img': '/media/profile_pics/default.png',
+        }
+
+        handlers = 0
+        begin = time.perf_counter()
+        for i in range(messages):
+            send_begin = time.perf_counter()
+            if mode == 'pre_encoded':
+                event = make_event('chat_message', {**payload, 'id': i})
+            else:
+                event = {'type': 'chat_message', **payload, 'id': i}
+            handlers += time.perf_counter() - send_begin    # the encoding done by the sender
+            await layer.group_send('bench', event)
+
+            events = [await layer.receive(channel) for channel in channels]
+
+            # What every consumer's chat_message handler does with the event
+            handler_begin = time.perf_counter()
+            for event in events:
+                frame = event_frame(event) if mode == 'pre_encoded' else per_recipient_frame(event)
+            handlers += time.perf_counter() - handler_begin
+        return time.perf_counter() - begin, handlers
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from channels.layers import InMemoryChannelLayer
+from asgiref.sync import async_to_sync
+from chat_app.models import CustomUser, Group
+from chat_app.layers import SQLiteChannelLayer
+from chat_app.outbox import OutboxPublisher
+from chat_app.management.commands._benchmark import benchmark_database
+import os
+import tempfile
+import time
+
+
+class Command(BaseCommand):
+    help = "Measures the latency of adding, removing and deleting the members of a large group, and of publishing their notifications"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=1000)
+        parser.add_argument('--layer', choices=['memory', 'sqlite'], default='memory')
+
+    def handle(self, *args, **options):
+        with benchmark_database(), tempfile.TemporaryDirectory() as directory:
+            CustomUser.objects.bulk_create([CustomUser(username=f'bench{i}') for i in range(options['members'])])
+            users = list(CustomUser.objects.order_by('id'))
+            layer, subscriber = self.layers(options['layer'], os.path.join(directory, 'channels.sqlite3'))
+
+            # Every member has an open notification socket
+            for user in users:
+                async_to_sync(subscriber.group_add)(f'notifications_{user.id}', async_to_sync(subscriber.new_channel)())
+
+            # The write is what the admin's request waits for, the notifications are sent by the outbox publisher
+            publisher = OutboxPublisher(layer=layer)
+            group = Group.objects.create(name='bench', admin=users[0])
+            self.stdout.write(f"{'change':>8} {'write ms':>9} {'publish ms':>11} {'events':>7}")
+            for name, change in (
+                ('add', lambda: group.members.add(*users)),
+                ('remove', lambda: group.members.remove(*users[len(users) // 2:])),
+                ('delete', lambda: group.delete()),
+            ):
+                begin = time.perf_counter()
+                change()
+                written = time.perf_counter() - begin
+
+                published = publisher.published
+                begin = time.perf_counter()
+                async_to_sync(publisher.run)(once=True)
+                publishing = time.perf_counter() - begin
+
+                self.stdout.write(f"{name:>8} {written * 1000:>9.1f} {publishing * 1000:>11.1f} {publisher.published - published:>7}")
+
+    # The layer used by the publisher, and the layer the members' channels belong to
+    # (with SQLite, another layer instance, so the messages go through the database like between two workers)
+    def layers(self, name, path):
+        if name == 'sqlite':
+            return SQLiteChannelLayer(path=path), SQLiteChannelLayer(path=path)
+        layer = InMemoryChannelLayer()
+        return layer, layer
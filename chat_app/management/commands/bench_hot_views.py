@@ -0,0 +1,83 @@
+from django.core.management.base import BaseCommand
+from django.test import AsyncRequestFactory
+from chat_app.models import CustomUser, FriendRequest, Group, GroupRequests, ChatMsg, GroupChat, conversation_key
+from chat_app.auth import generate_jwt_token
+from chat_app import views
+from chat_app.management.commands._benchmark import benchmark_database, percentile
+import asyncio
+import time
+
+
+class Command(BaseCommand):
+    help = "Measures the endpoints called on every page load under concurrent requests"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16, 64])
+        parser.add_argument('--requests', type=int, default=500, help="Requests made to every endpoint at every concurrency level")
+        parser.add_argument('--friends', type=int, default=200)
+        parser.add_argument('--groups', type=int, default=50)
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            user, friend, group = self.seed(options['friends'], options['groups'])
+            token = generate_jwt_token(user.id, user.username)
+
+            endpoints = [
+                ('get_connections', views.get_connections, {}),
+                ('get_notifications', views.get_notifications, {}),
+                ('get_chats (user)', views.get_chats, {'type': 'user', 'id': friend.id}),
+                ('get_chats (group)', views.get_chats, {'type': 'group', 'id': group.id}),
+                ('get_account_details', views.get_account_details, {}),
+            ]
+            factory = AsyncRequestFactory()
+
+            self.stdout.write(f"{'endpoint':>20} {'clients':>8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+            for name, view, data in endpoints:
+                for concurrency in options['concurrency']:
+                    elapsed, latencies = asyncio.run(self.run(factory, view, {**data, 'tk': token}, concurrency, options['requests']))
+                    self.stdout.write(
+                        f"{name:>20} {concurrency:>8} {len(latencies) / elapsed:>8.0f} "
+                        f"{percentile(latencies, 50) * 1000:>8.2f} {percentile(latencies, 99) * 1000:>8.2f}"
+                    )
+
+    # One user with "friends" friends (half of them also sent a pending request to a group of the user), "groups" groups,
+    # pending friend requests and a few hundred messages in one conversation and one group
+    def seed(self, friends, groups):
+        CustomUser.objects.bulk_create([CustomUser(username=f'bench{i}', first_name=f'Bench {i}') for i in range(friends * 2 + 1)])
+        users = list(CustomUser.objects.order_by('id'))
+        user, others = users[0], users[1:]
+
+        # bulk_create() skips save(), the canonical pair is set here
+        FriendRequest.objects.bulk_create(
+            [FriendRequest(from_user=user, to_user=other, user_low_id=min(user.id, other.id), user_high_id=max(user.id, other.id), accepted=True) for other in others[:friends]]
+            + [FriendRequest(from_user=other, to_user=user, user_low_id=min(user.id, other.id), user_high_id=max(user.id, other.id)) for other in others[friends:]]
+        )
+
+        Group.objects.bulk_create([Group(name=f'group {i}', admin=user) for i in range(groups)])
+        group_list = list(Group.objects.order_by('id'))
+        Group.members.through.objects.bulk_create([Group.members.through(group=group, customuser=user) for group in group_list])
+        GroupRequests.objects.bulk_create([GroupRequests(group=group_list[i % groups], requested_user=other) for i, other in enumerate(others[:friends // 2])])
+
+        friend, group = others[0], group_list[0]
+        ChatMsg.objects.bulk_create([
+            ChatMsg(sender=user if i % 2 else friend, receiver=friend if i % 2 else user, message=f'message {i}', conversation=conversation_key(user.id, friend.id))
+            for i in range(500)
+        ])
+        GroupChat.objects.bulk_create([GroupChat(group=group, sender=user, message=f'message {i}') for i in range(500)])
+        return user, friend, group
+
+    async def run(self, factory, view, data, concurrency, requests):
+        latencies = []
+        remaining = iter(range(requests))
+
+        async def client():
+            for _ in remaining:
+                request = factory.post('/', data)
+                begin = time.perf_counter()
+                response = await view(request)
+                latencies.append(time.perf_counter() - begin)
+                assert response.status_code == 200
+
+        begin = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        return time.perf_counter() - begin, latencies
@@ -0,0 +1,83 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth import authenticate
+from django.contrib.auth.hashers import make_password
+from django.http import JsonResponse
+from django.test import AsyncRequestFactory
+from asgiref.sync import sync_to_async
+from chat_app.models import CustomUser, FriendRequest, ChatMsg, conversation_key
+from chat_app.auth import generate_jwt_token
+from chat_app.hashing import get_pool
+from chat_app import views
+from chat_app.management.commands._benchmark import benchmark_database, percentile
+import asyncio
+import time
+
+
+# The login view before the process pool: authenticate() on the thread-sensitive sync_to_async thread
+async def thread_login(request):
+    user = await sync_to_async(authenticate)(username=request.POST.get('email'), password=request.POST.get('password'))
+    if user is not None:
+        return JsonResponse({'token': generate_jwt_token(user.id, user.username), 'authenticated': True})
+    return JsonResponse({'authenticated': False})
+
+
+class Command(BaseCommand):
+    help = "Measures login throughput, and the latency of chat history reads during a login storm"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--logins', type=int, default=40, help="Logins in the storm")
+        parser.add_argument('--login-clients', type=int, default=8, help="Concurrent logins")
+        parser.add_argument('--readers', type=int, default=8, help="Concurrent chat history readers during the storm")
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            password = make_password('benchmark-password')
+            CustomUser.objects.bulk_create([CustomUser(username=f'bench{i}@x.com', password=password) for i in range(options['logins'])])
+            user, friend = CustomUser.objects.order_by('id')[:2]
+            request = FriendRequest.objects.create(from_user=user, to_user=friend, accepted=True)
+            ChatMsg.objects.bulk_create([
+                ChatMsg(sender=user, receiver=friend, message=f'message {i}', conversation=conversation_key(user.id, friend.id)) for i in range(200)
+            ])
+            token = generate_jwt_token(user.id, user.username)
+
+            get_pool().submit(int).result()    # starting the worker processes before measuring
+
+            self.stdout.write(f"{'login':>8} {'logins/s':>9} {'login p99 ms':>13} {'reads':>6} {'read p50 ms':>12} {'read p99 ms':>12}")
+            for name, login_view in (('thread', thread_login), ('process', views.login)):
+                result = asyncio.run(self.run(login_view, token, friend.id, options))
+                self.stdout.write(
+                    f"{name:>8} {result['logins'] / result['storm']:>9.1f} {percentile(result['login_latencies'], 99) * 1000:>13.1f} "
+                    f"{len(result['read_latencies']):>6} {percentile(result['read_latencies'], 50) * 1000:>12.1f} "
+                    f"{percentile(result['read_latencies'], 99) * 1000:>12.1f}"
+                )
+
+    async def run(self, login_view, token, friend_id, options):
+        factory = AsyncRequestFactory()
+        login_latencies = []
+        read_latencies = []
+        remaining = iter(range(options['logins']))
+        storm_over = asyncio.Event()
+
+        async def login_client():
+            for i in remaining:
+                request = factory.post('/', {'email': f'bench{i}@x.com', 'password': 'benchmark-password'})
+                begin = time.perf_counter()
+                response = await login_view(request)
+                login_latencies.append(time.perf_counter() - begin)
+                assert b'"authenticated": true' in response.content
+
+        async def reader():
+            while not storm_over.is_set():
+                request = factory.post('/', {'type': 'user', 'id': friend_id, 'tk': token})
+                begin = time.perf_counter()
+                await views.get_chats(request)
+                read_latencies.append(time.perf_counter() - begin)
+
+        readers = [asyncio.ensure_future(reader()) for _ in range(options['readers'])]
+        begin = time.perf_counter()
+        await asyncio.gather(*(login_client() for _ in range(options['login_clients'])))
+        storm = time.perf_counter() - begin
+        storm_over.set()
+        await asyncio.gather(*readers)
+
+        return {'logins': options['logins'], 'storm': storm, 'login_latencies': login_latencies, 'read_latencies': read_latencies}
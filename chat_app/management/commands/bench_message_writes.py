@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from chat_app.models import CustomUser, Group, GroupChat
+from chat_app.messaging import save_group_message, flush_pending_messages
+from chat_app.management.commands._benchmark import benchmark_database, percentile
+import asyncio
+import time
+
+
+class Command(BaseCommand):
+    help = "Compares per-message inserts with the write-behind pipeline for concurrent group chat senders"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--senders', type=int, default=50, help="Concurrent senders (sockets)")
+        parser.add_argument('--messages', type=int, default=100, help="Messages sent by each sender")
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            users = [CustomUser.objects.create_user(username=f'bench{i}') for i in range(options['senders'])]
+            group = Group.objects.create(name='bench', admin=users[0])
+            group.members.add(*users)
+
+            self.stdout.write(f"{'mode':>13} {'messages':>9} {'seconds':>8} {'msg/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+            for mode in ('direct', 'write_behind'):
+                with override_settings(MESSAGE_WRITE_MODE=mode):
+                    elapsed, latencies = asyncio.run(self.run(users, group.id, options['messages']))
+                total = len(latencies)
+                self.stdout.write(
+                    f"{mode:>13} {total:>9} {elapsed:>8.2f} {total / elapsed:>8.0f} "
+                    f"{percentile(latencies, 50) * 1000:>8.2f} {percentile(latencies, 99) * 1000:>8.2f}"
+                )
+            self.stdout.write(f"rows stored: {GroupChat.objects.count()}")
+
+    async def run(self, users, group_id, messages):
+        latencies = []
+
+        async def sender(user):
+            for i in range(messages):
+                begin = time.perf_counter()
+                await save_group_message(user, group_id, f'message {i}')
+                latencies.append(time.perf_counter() - begin)
+
+        begin = time.perf_counter()
+        await asyncio.gather(*(sender(user) for user in users))
+        await flush_pending_messages()    # the messages only count once they are stored
+        return time.perf_counter() - begin, latencies
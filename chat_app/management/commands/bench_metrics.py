@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand
+from chat_app.metrics import Counter, Histogram, Registry, default_registry
+from chat_app.management.commands._benchmark import benchmark_database
+import time
+
+
+# Seconds per call of "func", the best of "rounds" rounds of "calls" calls
+def per_call(func, calls, rounds=3):
+    best = None
+    for _ in range(rounds):
+        begin = time.perf_counter()
+        for _ in range(calls):
+            func()
+        elapsed = time.perf_counter() - begin
+        best = elapsed if best is None else min(best, elapsed)
+    return best / calls
+
+
+class Command(BaseCommand):
+    help = "Measures the CPU cost of the metrics (chat_app/metrics.py) at a given chat message rate"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rate', type=int, default=10000, help="Chat messages per second")
+        parser.add_argument('--calls', type=int, default=1_000_000)
+        parser.add_argument('--scrape-interval', type=float, default=15, help="Seconds between two scrapes")
+
+    def handle(self, *args, **options):
+        registry = Registry()    # kept out of the scrape endpoint
+        counter = Counter('bench_total', '', ['kind'], registry=registry).labels('chat')
+        sent = Histogram('bench_send_seconds', '', ['kind'], registry=registry).labels('chat')
+        calls = options['calls']
+
+        # What post_chat_message adds to every message (the frames sent are counted by the outbound queues anyway)
+        def message():
+            begin = time.perf_counter()
+            sent.observe(time.perf_counter() - begin)
+
+        costs = {
+            'counter inc': per_call(counter.inc, calls),
+            'histogram observe': per_call(lambda: sent.observe(0.003), calls),
+            'perf_counter': per_call(time.perf_counter, calls),
+            'no-op call': per_call(lambda: None, calls),
+            'message': per_call(message, calls),
+        }
+        with benchmark_database():
+            costs['scrape'] = per_call(default_registry.exposition, 100)
+
+        self.stdout.write(f"{'operation':>22} {'ns':>10}")
+        for name, cost in costs.items():
+            self.stdout.write(f"{name:>22} {cost * 1e9:>10.0f}")
+
+        # The loop and lambda overhead is part of the measured message cost, the estimate is on the high side
+        message_cpu = costs['message'] * options['rate']
+        scrape_cpu = costs['scrape'] / options['scrape_interval']
+        total = (message_cpu + scrape_cpu) * 100
+        self.stdout.write(
+            f"{options['rate']} messages/s: {message_cpu * 100:.3f}% of a CPU, scrapes: {scrape_cpu * 100:.4f}%, "
+            f"total {total:.3f}% ({'under' if total < 1 else 'OVER'} the 1% target)"
+        )
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.core.files.storage import default_storage
+from django.conf import settings
+from chat_app.storage import collect_blobs
+from chat_app.attachments import expire_uploads
+
+
+class Command(BaseCommand):
+    help = "Deletes the expired attachment uploads, then the stored blobs nothing references anymore"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace', type=int, default=settings.BLOB_GC_GRACE, help="Seconds an unreferenced blob is kept")
+        parser.add_argument('--dry-run', action='store_true', help="Lists the blobs without deleting them (nor the uploads)")
+
+    def handle(self, *args, **options):
+        if not options['dry_run']:
+            self.stdout.write(f"{expire_uploads()} expired attachment uploads deleted")
+
+        deleted = collect_blobs(default_storage, options['grace'], options['dry_run'])
+        for name in deleted:
+            self.stdout.write(name)
+        self.stdout.write(f"{len(deleted)} blobs {'to delete' if options['dry_run'] else 'deleted'}")
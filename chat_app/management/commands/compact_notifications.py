@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from chat_app.models import Notification
+from chat_app.notifications import compact
+
+
+class Command(BaseCommand):
+    help = "Deletes old read notifications and keeps the newest notifications of every user (pending requests are kept)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention-days', type=int, default=settings.NOTIFICATION_RETENTION_DAYS)
+        parser.add_argument('--max-per-user', type=int, default=settings.NOTIFICATION_MAX_PER_USER)
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Notifications deleted per transaction")
+
+    def handle(self, *args, **options):
+        before = Notification.objects.count()
+        deleted = compact(options['retention_days'], options['max_per_user'], options['chunk_size'])
+        self.stdout.write(f"{deleted} notifications deleted, {before - deleted} left")
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.exceptions import SuspiciousFileOperation
+from chat_app.models import CustomUser, Group
+from chat_app.images import thumbnail_bytes, ImageRejected
+import os
+
+
+class Command(BaseCommand):
+    help = "Creates the thumbnails of the profile and group pictures uploaded before thumbnails existed"
+
+    def handle(self, *args, **options):
+        for model, field in ((CustomUser, 'image'), (Group, 'group_image')):
+            # Rows sharing a picture (the default one) share its thumbnail
+            sources = model.objects.filter(thumbnail='').exclude(**{field: ''}).values_list(field, flat=True).distinct()
+            for source in list(sources):
+                try:
+                    with default_storage.open(source.lstrip('/')) as file:
+                        data = thumbnail_bytes(file)
+                except (ImageRejected, OSError, SuspiciousFileOperation) as error:
+                    self.stderr.write(f"{model.__name__} {source}: skipped ({error})")
+                    continue
+
+                name = default_storage.save(f"thumbnails/{os.path.splitext(os.path.basename(source))[0]}.webp", ContentFile(data))
+                updated = model.objects.filter(thumbnail='', **{field: source}).update(thumbnail=name)
+                self.stdout.write(f"{model.__name__} {source}: {name} ({len(data)} bytes, {updated} rows)")
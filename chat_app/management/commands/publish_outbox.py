@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from chat_app.layers import layer_is_shared
+from chat_app.outbox import OutboxPublisher
+import asyncio
+
+
+class Command(BaseCommand):
+    help = "Sends the pending notification events of the outbox through the channel layer"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Exit when the outbox is empty instead of polling it")
+
+    def handle(self, *args, **options):
+        if not layer_is_shared():
+            # The events would go to this process's own memory, no consumer would ever receive them
+            raise CommandError("The channel layer isn't shared by the processes (set CHANNEL_LAYER=sqlite), "
+                               "the worker processes publish the outbox themselves")
+        publisher = OutboxPublisher()
+        asyncio.run(publisher.run(once=options['once']))
+        self.stdout.write(f"{publisher.published} events sent, {publisher.coalesced} duplicates dropped")
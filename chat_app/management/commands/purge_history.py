@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from chat_app.models import HistoryPurge
+from chat_app.purge import next_job, run_job
+import time
+
+
+class Command(BaseCommand):
+    help = "Deletes the chat history queued by unfriending and group removals, in small chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Exit when the queue is empty instead of waiting for new jobs")
+        parser.add_argument('--chunk-size', type=int, default=settings.PURGE_CHUNK_SIZE)
+        parser.add_argument('--delay', type=float, default=settings.PURGE_CHUNK_DELAY, help="Seconds to sleep between chunks")
+        parser.add_argument('--poll-interval', type=float, default=5, help="Seconds between checks of an empty queue")
+        parser.add_argument('--status', action='store_true', help="Only print the queue")
+        parser.add_argument('--retry-failed', action='store_true', help="Queue the purges that gave up again")
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        if options['status']:
+            return self.print_status()
+        if options['retry_failed']:
+            retried = HistoryPurge.objects.filter(finished_at__isnull=True, failed=True).update(failed=False, attempts=0)
+            self.stdout.write(f"{retried} failed purges queued again")
+
+        while True:
+            job = next_job()
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['poll_interval'])
+                continue
+
+            self.stdout.write(f"purge {job.id}: {self.describe(job)}, messages sent up to {job.cutoff_at}")
+            done = run_job(job, options['chunk_size'], options['delay'], progress=self.progress)
+            if done:
+                self.stdout.write(f"purge {job.id}: done, {job.deleted} messages deleted")
+            else:
+                self.stderr.write(f"purge {job.id}: failed after {job.deleted} messages, will be retried")
+
+    def describe(self, job):
+        if job.kind == HistoryPurge.CHAT:
+            return f"conversation {job.conversation}"
+        return f"group {job.group_id}, sender {job.sender_id}"
+
+    def progress(self, job):
+        if self.verbosity > 1:
+            self.stdout.write(f"purge {job.id}: {job.deleted} messages deleted")
+
+    def print_status(self):
+        pending = HistoryPurge.objects.filter(finished_at__isnull=True)
+        self.stdout.write(f"pending: {pending.filter(failed=False).count()}, failed: {pending.filter(failed=True).count()}")
+        for job in pending.order_by('id'):
+            state = 'failed' if job.failed else 'pending'
+            self.stdout.write(f"  {job.id} {state:>7} {self.describe(job)}: {job.deleted} deleted, {job.attempts} attempts {job.last_error}")
@@ -0,0 +1,123 @@
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse, Http404
+from django.utils.http import http_date, content_disposition_header
+from chat_app.storage import is_blob, blob_hash, TMP_DIR
+import asyncio
+import mimetypes
+import os
+import re
+
+
+'''
+Serving the uploaded files (MEDIA_URL).
+
+Blobs (chat_app/storage.py) never change, they're sent with "Cache-Control: immutable" and a year of max-age, so a
+client fetches an avatar once and never asks again. The other files (uploaded before the content-addressed storage)
+must be revalidated: "no-cache" and an ETag, answered with an empty 304 while they didn't change.
+
+Single byte ranges ("Range: bytes=a-b") are answered with 206. The file is read in MEDIA_CHUNK_SIZE chunks on a thread
+and streamed: Django's ASGI handler would load a whole file into memory to send a FileResponse (a sync iterator).
+Behind nginx, MEDIA_ACCEL_REDIRECT ("/protected-media/", an internal location aliased to MEDIA_ROOT) hands the body
+over with X-Accel-Redirect, nginx then sends it with sendfile() and handles the ranges itself.
+'''
+
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+_range = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+# (start, end) of a single "Range: bytes=" header, None to send the whole file, False when it can't be satisfied
+def parse_range(header, size):
+    match = _range.match(header.strip()) if header else None
+    if match is None:
+        return None    # no range, or several ranges: the whole file
+    first, last = match.groups()
+    if not first:
+        if not last or int(last) == 0:
+            return False
+        return max(size - int(last), 0), size - 1    # suffix: the last n bytes
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        return False
+    return start, end
+
+
+async def read_range(path, start, length):
+    loop = asyncio.get_running_loop()
+    file = await loop.run_in_executor(None, open, path, 'rb')
+    try:
+        await loop.run_in_executor(None, file.seek, start)
+        while length > 0:
+            chunk = await loop.run_in_executor(None, file.read, min(settings.MEDIA_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+async def serve_media(request, path):
+    if request.method not in ('GET', 'HEAD') or path.startswith(TMP_DIR + '/'):
+        raise Http404
+    try:
+        full_path = default_storage.path(path)
+        stat = await asyncio.get_running_loop().run_in_executor(None, os.stat, full_path)
+    except (SuspiciousFileOperation, FileNotFoundError, NotADirectoryError):
+        raise Http404
+    if not os.path.isfile(full_path):
+        raise Http404
+
+    if is_blob(path):
+        etag, cache_control = f'"{blob_hash(path)}"', IMMUTABLE
+    else:
+        etag, cache_control = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"', REVALIDATE
+    headers = {
+        'ETag': etag,
+        'Cache-Control': cache_control,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Accept-Ranges': 'bytes',
+    }
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and (if_none_match.strip() == '*' or etag in (tag.strip() for tag in if_none_match.split(','))):
+        response = HttpResponseNotModified()
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    content_type, encoding = mimetypes.guess_type(path)
+    headers['Content-Type'] = content_type if content_type and not encoding else 'application/octet-stream'
+    # "?download=<name>": saved under its original name (attachments, see chat_app/attachments.py)
+    download = request.GET.get('download')
+    if download:
+        headers['Content-Disposition'] = content_disposition_header(True, download)
+
+    if settings.MEDIA_ACCEL_REDIRECT:
+        response = HttpResponse(headers=headers)
+        response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_REDIRECT.rstrip('/') + '/' + path
+        return response
+
+    size = stat.st_size
+    # "If-Range" with another version than ours: the whole (new) file
+    if_range = request.headers.get('If-Range')
+    byte_range = parse_range(request.headers.get('Range'), size) if not if_range or if_range == etag else None
+    if byte_range is False:
+        headers['Content-Range'] = f'bytes */{size}'
+        return HttpResponse(status=416, headers=headers)
+
+    start, end, status = 0, size - 1, 200
+    if byte_range is not None:
+        start, end = byte_range
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        status = 206
+    headers['Content-Length'] = str(end - start + 1)
+
+    if request.method == 'HEAD':
+        return HttpResponse(status=status, headers=headers)
+    return StreamingHttpResponse(read_range(full_path, start, end - start + 1), status=status, headers=headers)
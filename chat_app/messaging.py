@@ -0,0 +1,210 @@
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+from chat_app.db import database_sync_to_async
+from chat_app.models import ChatMsg, GroupChat, MessageSequence, conversation_key
+import asyncio
+import atexit
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Persistence of the chat messages received by the consumers.
+
+MESSAGE_WRITE_MODE = 'direct'        one INSERT per message before it's broadcast (default)
+MESSAGE_WRITE_MODE = 'write_behind'  the message gets its id immediately and is broadcast at once, the rows are then
+                                     inserted in bulk_create batches of MESSAGE_BATCH_SIZE, at least every
+                                     MESSAGE_FLUSH_INTERVAL seconds, and flushed when the process exits.
+
+A write_behind batch that fails an integrity check (a group deleted before the flush, an id collision) is inserted
+again one row at a time: the rows that can't be inserted are logged and dropped, the others are kept. Any other failure
+(e.g. the database is locked) is retried MESSAGE_FLUSH_RETRIES times, then the batch is logged and dropped, so one bad
+batch can't hold up the messages sent after it. At most MESSAGE_QUEUE_MAX messages wait in a queue, the senders wait
+for the flusher beyond that.
+
+In write_behind mode, ids are reserved in blocks from MessageSequence, so every worker process must use the same mode.
+'''
+
+
+def write_behind_enabled():
+    return settings.MESSAGE_WRITE_MODE == 'write_behind'
+
+
+# Reserves "count" ids for the model's table and returns the first one.
+# The sequence never goes below the table's current max id, so rows inserted in direct mode are skipped.
+def reserve_ids(model, count):
+    name = model._meta.db_table
+    max_id = Coalesce(Subquery(model.objects.order_by('-id').values('id')[:1]), Value(0))
+
+    with transaction.atomic():
+        # UPDATE first so the write lock is taken before the sequence is read
+        updated = MessageSequence.objects.filter(name=name).update(last_value=Greatest(F('last_value'), max_id) + count)
+        if not updated:
+            try:
+                with transaction.atomic():
+                    MessageSequence.objects.create(name=name, last_value=0)
+            except IntegrityError:    # created concurrently by another process
+                pass
+            MessageSequence.objects.filter(name=name).update(last_value=Greatest(F('last_value'), max_id) + count)
+        last_value = MessageSequence.objects.values_list('last_value', flat=True).get(name=name)
+
+    return last_value - count + 1
+
+
+# Hands out message ids from blocks of MESSAGE_ID_BLOCK_SIZE reserved ids
+class IdAllocator:
+
+    def __init__(self, model):
+        self.model = model
+        self._next = 1
+        self._end = 0    # last id of the current block
+        self._lock = None
+
+    async def next_id(self):
+        if self._next > self._end:
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            async with self._lock:
+                if self._next > self._end:
+                    block_size = settings.MESSAGE_ID_BLOCK_SIZE
+                    start = await database_sync_to_async(reserve_ids)(self.model, block_size)
+                    self._next, self._end = start, start + block_size - 1
+        id = self._next
+        self._next += 1
+        return id
+
+
+# Buffer of messages waiting to be inserted, flushed by a background task on size or time thresholds
+class WriteBehindQueue:
+
+    def __init__(self, model):
+        self.model = model
+        self.allocator = IdAllocator(model)
+        self._pending = []
+        self._task = None
+        self._batch_full = None
+        self._flushed = None    # set after every flush attempt, then replaced
+        self._failures = 0      # failed flushes of the batch at the head of the queue
+
+    def _start_flusher(self):
+        if self._task is None or self._task.done():
+            self._batch_full = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._flusher())
+
+    async def add(self, obj):
+        # Backpressure: the sender waits while the queue is full (the database is slow or failing)
+        while len(self._pending) >= settings.MESSAGE_QUEUE_MAX:
+            self._start_flusher()
+            self._batch_full.set()
+            if self._flushed is None:
+                self._flushed = asyncio.Event()
+            await self._flushed.wait()
+
+        obj.id = await self.allocator.next_id()
+        self._pending.append(obj)
+
+        self._start_flusher()
+        if len(self._pending) >= settings.MESSAGE_BATCH_SIZE:
+            self._batch_full.set()
+        return obj
+
+    async def _flusher(self):
+        while self._pending:
+            if len(self._pending) < settings.MESSAGE_BATCH_SIZE:
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), settings.MESSAGE_FLUSH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            self._batch_full.clear()
+
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Write-behind flush of %s failed, retrying', self.model.__name__)
+                await asyncio.sleep(1)
+            finally:
+                flushed, self._flushed = self._flushed, None
+                if flushed is not None:
+                    flushed.set()
+
+    async def flush(self):
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            await database_sync_to_async(self._insert)(batch)
+        except Exception:
+            self._failures += 1
+            if self._failures < settings.MESSAGE_FLUSH_RETRIES:
+                self._pending[:0] = batch    # keeping the messages (in order) for the next attempt
+            else:
+                self._failures = 0
+                logger.error(
+                    'Dropping %d %s messages (ids %d-%d) after %d failed flushes',
+                    len(batch), self.model.__name__, batch[0].id, batch[-1].id, settings.MESSAGE_FLUSH_RETRIES,
+                )
+            raise
+        self._failures = 0
+
+    def _insert(self, batch):
+        # One transaction per batch (group commit)
+        try:
+            with transaction.atomic():
+                self.model.objects.bulk_create(batch, batch_size=500)
+            return
+        except IntegrityError:
+            logger.warning('Write-behind batch of %d %s messages failed an integrity check, inserting them one by one', len(batch), self.model.__name__)
+
+        for obj in batch:
+            try:
+                with transaction.atomic():
+                    self.model.objects.bulk_create([obj])
+            except IntegrityError as error:
+                logger.error('Dropping %s message %d that cannot be inserted: %s', self.model.__name__, obj.id, error)
+
+    # Synchronous flush, used when the process exits (the event loop may already be gone)
+    def flush_sync(self):
+        batch, self._pending = self._pending, []
+        if batch:
+            self._insert(batch)
+
+
+chat_queue = WriteBehindQueue(ChatMsg)
+group_chat_queue = WriteBehindQueue(GroupChat)
+
+
+async def flush_pending_messages():
+    await chat_queue.flush()
+    await group_chat_queue.flush()
+
+@atexit.register
+def flush_pending_messages_on_exit():
+    for queue in (chat_queue, group_chat_queue):
+        try:
+            queue.flush_sync()
+        except Exception:
+            logger.exception('Could not flush the pending %s messages on exit', queue.model.__name__)
+
+
+# Saves a message between two friends, returns the ChatMsg (with its id)
+async def save_chat_message(sender, receiver_id, message, attachment_id=None):
+    msg = ChatMsg(
+        sender=sender, receiver_id=receiver_id, message=message, conversation=conversation_key(sender.id, receiver_id),
+        attachment_id=attachment_id,
+    )
+    if write_behind_enabled():
+        return await chat_queue.add(msg)
+    await database_sync_to_async(msg.save)()
+    return msg
+
+# Saves a group message, returns the GroupChat (with its id)
+async def save_group_message(sender, group_id, message, attachment_id=None):
+    msg = GroupChat(sender=sender, group_id=group_id, message=message, attachment_id=attachment_id)
+    if write_behind_enabled():
+        return await group_chat_queue.add(msg)
+    await database_sync_to_async(msg.save)()
+    return msg
@@ -0,0 +1,329 @@
+from bisect import bisect_left
+from django.conf import settings
+from functools import wraps
+import math
+import threading
+import time
+
+
+'''
+Metrics of this process, in the Prometheus text format on the metrics endpoint (views.metrics).
+
+The counters, gauges and histograms are updated on the hot paths (every chat message), so an update takes no lock:
+every thread adds to its own cells (threading.local) and a scrape sums the cells of all the threads. A thread takes a
+lock only the first time it updates a time series. The numbers other modules already keep (DB executor, caches,
+outbox, outbound queues and frames sent) cost nothing more on the hot paths, they're read at scrape time by the
+collectors (add_collector()). The query histograms of chat_app/instrumentation.py (chat_endpoint_*) are metrics of this
+module, observed once per HTTP request and WebSocket message, never per channel layer event.
+
+A chat message costs one histogram observation (chat_group_send_seconds, its _count is the number of messages) and two
+perf_counter() calls, see the bench_metrics command.
+
+The values are per process: with several workers, every worker must be scraped (each scrape reaches one of them).
+'''
+
+
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)    # seconds
+
+
+# The per-thread cells of one time series (slots: fewer lookups on every update)
+class _Series:
+    __slots__ = ('_size', '_local', '_cells', '_lock')
+
+    def __init__(self, size):
+        self._size = size
+        self._local = threading.local()
+        self._cells = []
+        self._lock = threading.Lock()
+
+    def _new_cell(self):
+        cell = self._local.cell = [0] * self._size
+        with self._lock:
+            self._cells.append(cell)
+        return cell
+
+    # Sum of the threads' cells (the cells of finished threads are kept, their counts are part of the total)
+    def totals(self):
+        with self._lock:
+            cells = list(self._cells)
+        return [sum(values) for values in zip(*cells)] if cells else [0] * self._size
+
+
+class CounterSeries(_Series):
+    __slots__ = ()
+
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, amount=1):
+        try:
+            self._local.cell[0] += amount
+        except AttributeError:
+            self._new_cell()[0] += amount
+
+    def samples(self):
+        return [('_total', {}, self.totals()[0])]
+
+
+class GaugeSeries(CounterSeries):
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def samples(self):
+        return [('', {}, self.totals()[0])]
+
+
+class HistogramSeries(_Series):
+    __slots__ = ('_buckets',)
+
+    def __init__(self, buckets):
+        super().__init__(len(buckets) + 2)    # the buckets, +Inf, the sum
+        self._buckets = buckets
+
+    def observe(self, value):
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            cell = self._new_cell()
+        cell[bisect_left(self._buckets, value)] += 1
+        cell[-1] += value
+
+    def samples(self):
+        totals = self.totals()
+        samples, count = [], 0
+        for bound, bucket_count in zip(self._buckets + (math.inf,), totals[:-1]):
+            count += bucket_count
+            samples.append(('_bucket', {'le': format_value(bound)}, count))
+        return samples + [('_sum', {}, totals[-1]), ('_count', {}, count)]
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+        (registry or default_registry).register(self)
+
+    # Time series of the label values. Hot paths keep the returned series instead of calling labels() every time.
+    def labels(self, *values):
+        series = self._series.get(values)
+        if series is None:
+            with self._lock:
+                series = self._series.get(values)
+                if series is None:
+                    series = self._series[values] = self._new_series()
+        return series
+
+    def collect(self):
+        with self._lock:
+            series = list(self._series.items())
+        samples = []
+        for values, one in series:
+            labels = dict(zip(self.labelnames, values))
+            for suffix, extra, value in one.samples():
+                samples.append((suffix, {**labels, **extra}, value))
+        return [(self.name, self.type, self.documentation, samples)]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_series(self):
+        return CounterSeries()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _new_series(self):
+        return GaugeSeries()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_series(self):
+        return HistogramSeries(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    # "collector()" returns [(name, type, documentation, [(suffix, labels, value)])], read at every scrape
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def exposition(self):
+        lines = []
+        for source in [metric.collect for metric in self.metrics] + self.collectors:
+            for name, type, documentation, samples in source():
+                lines.append(f'# HELP {name} {escape_help(documentation)}')
+                lines.append(f'# TYPE {name} {type}')
+                for suffix, labels, value in samples:
+                    lines.append(f'{name}{suffix}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+default_registry = Registry()
+
+def add_collector(collector):
+    default_registry.add_collector(collector)
+
+
+def escape_help(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + '}'
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# The realtime side: the consumers, JWTAuthMiddleware (chat_app/middleware.py) and the signal receivers
+
+ws_connections = Gauge('chat_ws_connections', 'Open WebSocket connections', ['consumer'])
+ws_connects = Counter('chat_ws_connects', 'Accepted WebSocket connections', ['consumer'])
+ws_rejections = Counter('chat_ws_rejections', 'Rejected WebSocket connections and stream subscriptions', ['consumer', 'reason'])
+ws_auth = Counter('chat_ws_auth', 'WebSocket handshakes by authentication result', ['result'])
+ws_auth_seconds = Histogram('chat_ws_auth_seconds', 'Token check and user lookup time of the WebSocket handshakes')
+group_send_seconds = Histogram('chat_group_send_seconds', 'Time to hand the received chat messages to the channel layer (group_send)', ['kind'])
+signal_receiver_seconds = Histogram('chat_signal_receiver_seconds', 'Run time of the signal receivers', ['receiver'])
+signal_receiver_errors = Counter('chat_signal_receiver_errors', 'Signal receivers that raised', ['receiver'])
+
+
+# Mixin of the consumers: open and accepted connections, and rejections (reject() is called before close())
+class ConsumerMetricsMixin:
+
+    metrics_connected = False
+
+    async def accept(self, subprotocol=None, headers=None):
+        await super().accept(subprotocol, headers)
+        name = type(self).__name__
+        ws_connects.labels(name).inc()
+        ws_connections.labels(name).inc()
+        self.metrics_connected = True
+
+    async def websocket_disconnect(self, message):
+        if self.metrics_connected:
+            self.metrics_connected = False
+            ws_connections.labels(type(self).__name__).dec()
+        await super().websocket_disconnect(message)
+
+    def reject(self, reason):
+        ws_rejections.labels(type(self).__name__, reason).inc()
+
+
+# Decorator of the signal receivers, under @receiver: calls, time and failures per receiver
+def instrumented_receiver(func):
+    calls, failures = signal_receiver_seconds.labels(func.__name__), signal_receiver_errors.labels(func.__name__)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        begin = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            failures.inc()
+            raise
+        finally:
+            calls.observe(time.perf_counter() - begin)
+    return wrapper
+
+
+outbox_count = None    # (count, time.monotonic() of the count)
+
+# Events in the outbox, counted at most once per METRICS_OUTBOX_COUNT_TTL seconds: a backed-up outbox makes the count a
+# long scan, which every scrape would repeat
+def outbox_pending():
+    global outbox_count
+    from chat_app.models import OutboxEvent
+    now = time.monotonic()
+    if outbox_count is None or now - outbox_count[1] >= settings.METRICS_OUTBOX_COUNT_TTL:
+        outbox_count = (OutboxEvent.objects.count(), now)
+    return outbox_count[0]
+
+
+# The numbers kept by the other modules, read at every scrape (in an ORM thread: the outbox count may be a query)
+def collect_runtime():
+    from chat_app import db, outbox
+    from chat_app.auth import token_cache, user_cache
+    from chat_app.cache import authz_cache
+    from chat_app.outbound import outbound_stats, frames_sent
+
+    families = []
+
+    if db._executor is not None:
+        stats = db._executor.stats()
+        families += [
+            ('chat_db_executor_threads', 'gauge', 'Threads of the DB executor', [('', {}, stats['threads'])]),
+            ('chat_db_executor_queued', 'gauge', 'ORM calls waiting for a DB executor thread', [('', {}, stats['queued'])]),
+            ('chat_db_executor_running', 'gauge', 'ORM calls running on the DB executor', [('', {}, stats['running'])]),
+            ('chat_db_executor_calls', 'counter', 'ORM calls completed by the DB executor', [('_total', {}, stats['completed'])]),
+            ('chat_db_executor_wait_max_seconds', 'gauge', 'Longest wait for a DB executor thread', [('', {}, stats['wait_max_ms'] / 1000)]),
+        ]
+
+    caches = {'authz': authz_cache.stats(), 'token': token_cache.stats(), 'user': user_cache.stats()}
+    families += [
+        ('chat_cache_hits', 'counter', 'Cache hits', [('_total', {'cache': name}, stats['hits']) for name, stats in caches.items()]),
+        ('chat_cache_misses', 'counter', 'Cache misses', [('_total', {'cache': name}, stats['misses']) for name, stats in caches.items()]),
+        ('chat_cache_entries', 'gauge', 'Cache entries', [('', {'cache': name}, stats['size']) for name, stats in caches.items()]),
+    ]
+
+    families.append(('chat_outbox_pending', 'gauge', f'Events in the outbox (counted every {settings.METRICS_OUTBOX_COUNT_TTL}s)', [('', {}, outbox_pending())]))
+    if outbox.publisher is not None:
+        families += [
+            ('chat_outbox_published', 'counter', 'Outbox messages sent by this process', [('_total', {}, outbox.publisher.published)]),
+            ('chat_outbox_coalesced', 'counter', 'Duplicate outbox events merged by this process', [('_total', {}, outbox.publisher.coalesced)]),
+        ]
+
+    outbound = outbound_stats(top=0)
+    families += [
+        ('chat_outbound_queued', 'gauge', 'Frames queued for the WebSockets', [('', {}, outbound['queued'])]),
+        ('chat_outbound_max_depth', 'gauge', 'Deepest outbound queue', [('', {}, outbound['max_depth'])]),
+        ('chat_outbound_congested', 'gauge', 'Congested WebSockets', [('', {}, outbound['congested'])]),
+        ('chat_outbound_evicted', 'counter', 'Slow WebSocket clients closed', [('_total', {}, outbound['evicted'])]),
+        ('chat_ws_frames_sent', 'counter', 'Frames written to the WebSockets', [
+            ('_total', {'consumer': consumer}, count) for consumer, count in frames_sent().items()
+        ]),
+    ]
+    return families
+
+add_collector(collect_runtime)
@@ -0,0 +1,42 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:40
+
+from django.db import migrations, models
+from django.db.models import CharField, Value
+from django.db.models.functions import Cast, Concat, Greatest, Least
+
+
+# Filling the conversation key ("<smaller_user_id>_<greater_user_id>") of the existing messages in a single UPDATE
+def backfill_conversation(apps, schema_editor):
+    ChatMsg = apps.get_model('chat_app', 'ChatMsg')
+    ChatMsg.objects.update(
+        conversation=Concat(
+            Cast(Least('sender_id', 'receiver_id'), CharField()),
+            Value('_'),
+            Cast(Greatest('sender_id', 'receiver_id'), CharField()),
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmsg',
+            name='conversation',
+            field=models.CharField(default='', max_length=50),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_conversation, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chatmsg',
+            index=models.Index(fields=['conversation', 'time_stamp', 'id'], name='chatmsg_conversation_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='groupchat',
+            index=models.Index(fields=['group', 'time_stamp', 'id'], name='groupchat_group_idx'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:05
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Creating one Friendship row per pair of users from the existing friend requests.
+# If a pair has several requests, the accepted one (then the oldest one) wins.
+def backfill_friendships(apps, schema_editor):
+    FriendRequest = apps.get_model('chat_app', 'FriendRequest')
+    Friendship = apps.get_model('chat_app', 'Friendship')
+
+    friendships = {}
+    for req in FriendRequest.objects.order_by('-accepted', 'id').iterator():
+        pair = tuple(sorted((req.from_user_id, req.to_user_id)))
+        if pair not in friendships:
+            friendships[pair] = Friendship(user_low_id=pair[0], user_high_id=pair[1], request_id=req.id, accepted=req.accepted)
+
+    Friendship.objects.bulk_create(friendships.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0002_chatmsg_conversation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Friendship',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('accepted', models.BooleanField(default=False)),
+                ('request', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='friendship', to='chat_app.friendrequest')),
+                ('user_high', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='friendships_high', to=settings.AUTH_USER_MODEL)),
+                ('user_low', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='friendships_low', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user_low', 'user_high'), name='unique_friendship_pair')],
+            },
+        ),
+        migrations.RunPython(backfill_friendships, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0003_friendship'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageSequence',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('last_value', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
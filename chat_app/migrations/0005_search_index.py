@@ -0,0 +1,32 @@
+# Generated by Django 5.1.4 on 2026-10-18 20:10
+
+from django.db import migrations
+
+
+# FTS5 tables used by chat_app/search.py (rowid = user/group id), filled from the existing users and groups.
+# Only created on SQLite, other databases use the icontains fallback.
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute("CREATE VIRTUAL TABLE chat_app_user_search USING fts5(username, name, prefix='2 3')")
+    schema_editor.execute("CREATE VIRTUAL TABLE chat_app_group_search USING fts5(name, prefix='2 3')")
+    schema_editor.execute("INSERT INTO chat_app_user_search (rowid, username, name) SELECT id, username, first_name FROM chat_app_customuser")
+    schema_editor.execute("INSERT INTO chat_app_group_search (rowid, name) SELECT id, name FROM chat_app_group")
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute("DROP TABLE IF EXISTS chat_app_user_search")
+    schema_editor.execute("DROP TABLE IF EXISTS chat_app_group_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0004_messagesequence'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:00
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0005_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistoryPurge',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('chat', 'Chat'), ('group', 'Group')], max_length=10)),
+                ('conversation', models.CharField(blank=True, max_length=50)),
+                ('group_id', models.IntegerField(blank=True, null=True)),
+                ('sender_id', models.IntegerField(blank=True, null=True)),
+                ('cutoff_id', models.BigIntegerField()),
+                ('deleted', models.PositiveIntegerField(default=0)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('failed', models.BooleanField(default=False)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['conversation'], name='historypurge_conversation_idx'), models.Index(fields=['group_id'], name='historypurge_group_idx'), models.Index(fields=['finished_at', 'next_attempt_at'], name='historypurge_queue_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0006_historypurge'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group', models.CharField(max_length=200)),
+                ('handler', models.CharField(max_length=50)),
+                ('frame', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('claimed_by', models.CharField(blank=True, max_length=100)),
+                ('claimed_until', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['claimed_until', 'id'], name='outboxevent_claim_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+
+
+# Moving the pending friend/group requests into the inbox, with the payload their notification would have had
+def backfill_pending_requests(apps, schema_editor):
+    FriendRequest = apps.get_model('chat_app', 'FriendRequest')
+    GroupRequests = apps.get_model('chat_app', 'GroupRequests')
+    Notification = apps.get_model('chat_app', 'Notification')
+
+    notifications = []
+    for req in FriendRequest.objects.filter(accepted=False).select_related('from_user').order_by('id').iterator():
+        from_user = req.from_user
+        notifications.append(Notification(user_id=req.to_user_id, kind='received_friend_request', key=f'friend_request:{req.id}', payload={
+            'msg': f'You have received friend request from {from_user.username}',
+            'id': from_user.id,
+            'name': from_user.first_name,
+            'email': from_user.username,
+            'image': default_storage.url(from_user.image.name),
+            'received_friend_request': True,
+        }))
+
+    for req in GroupRequests.objects.filter(accepted=False).select_related('group', 'requested_user').order_by('id').iterator():
+        group = req.group
+        notifications.append(Notification(user_id=group.admin_id, kind='received_group_request', key=f'group_request:{req.id}', payload={
+            'group_id': group.id,
+            'group_name': group.name,
+            'group_image': default_storage.url(group.group_image.name),
+            'group_req_id': req.id,
+            'username': req.requested_user.username,
+            'user_id': req.requested_user_id,
+            'received_group_request': True,
+        }))
+
+    Notification.objects.bulk_create(notifications, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0007_outboxevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=50)),
+                ('key', models.CharField(blank=True, max_length=100)),
+                ('payload', models.JSONField()),
+                ('is_read', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'id'], name='notification_user_idx'), models.Index(fields=['user', 'is_read'], name='notification_unread_idx'), models.Index(fields=['key'], name='notification_key_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_pending_requests, migrations.RunPython.noop),
+    ]
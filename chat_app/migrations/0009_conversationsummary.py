@@ -0,0 +1,70 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:07
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+# Creating the conversation list rows of the existing friendships and group members, with their last message
+# (unread counts start at 0)
+def backfill_summaries(apps, schema_editor):
+    Friendship = apps.get_model('chat_app', 'Friendship')
+    Group = apps.get_model('chat_app', 'Group')
+    ChatMsg = apps.get_model('chat_app', 'ChatMsg')
+    GroupChat = apps.get_model('chat_app', 'GroupChat')
+    ConversationSummary = apps.get_model('chat_app', 'ConversationSummary')
+
+    def last_messages(model, field):
+        ids = model.objects.values(field).annotate(last_id=Max('id')).values_list('last_id', flat=True)
+        return {getattr(msg, field): msg for msg in model.objects.filter(id__in=list(ids)).iterator()}
+
+    def summary(msg, **fields):
+        if msg is not None:
+            fields.update(last_message=msg.message[:200], last_message_id=msg.id, last_sender_id=msg.sender_id, last_activity=msg.time_stamp)
+        return ConversationSummary(**fields)
+
+    summaries = []
+    chats = last_messages(ChatMsg, 'conversation')
+    for friendship in Friendship.objects.filter(accepted=True).iterator():
+        conversation = f'{friendship.user_low_id}_{friendship.user_high_id}'
+        msg = chats.get(conversation)
+        summaries.append(summary(msg, user_id=friendship.user_low_id, friend_id=friendship.user_high_id, conversation=conversation))
+        summaries.append(summary(msg, user_id=friendship.user_high_id, friend_id=friendship.user_low_id, conversation=conversation))
+
+    groups = last_messages(GroupChat, 'group_id')
+    for membership in Group.members.through.objects.iterator():
+        summaries.append(summary(groups.get(membership.group_id), user_id=membership.customuser_id, group_id=membership.group_id))
+
+    ConversationSummary.objects.bulk_create(summaries, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0008_notification'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('conversation', models.CharField(blank=True, max_length=50)),
+                ('last_message', models.CharField(blank=True, max_length=200)),
+                ('last_message_id', models.BigIntegerField(blank=True, null=True)),
+                ('last_activity', models.DateTimeField(default=django.utils.timezone.now)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('friend', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('group', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='summaries', to='chat_app.group')),
+                ('last_sender', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversations', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'last_activity', 'id'], name='conversation_recency_idx'), models.Index(fields=['conversation'], name='conversation_key_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'friend'), name='unique_friend_conversation'), models.UniqueConstraint(fields=('user', 'group'), name='unique_group_conversation')],
+            },
+        ),
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop),
+    ]
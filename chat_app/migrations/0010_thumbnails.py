@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0009_conversationsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='thumbnail',
+            field=models.ImageField(blank=True, upload_to='thumbnails'),
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='thumbnail',
+            field=models.ImageField(blank=True, upload_to='thumbnails'),
+        ),
+    ]
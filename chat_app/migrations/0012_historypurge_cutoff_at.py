@@ -0,0 +1,46 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:40
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F
+
+
+# The pending purges hide the messages sent up to their creation
+def backfill_cutoff_at(apps, schema_editor):
+    HistoryPurge = apps.get_model('chat_app', 'HistoryPurge')
+    HistoryPurge.objects.update(cutoff_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0011_attachment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historypurge',
+            name='cutoff_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(backfill_cutoff_at, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='historypurge',
+            name='cutoff_at',
+            field=models.DateTimeField(),
+        ),
+        migrations.RemoveField(
+            model_name='historypurge',
+            name='cutoff_id',
+        ),
+        migrations.AlterField(
+            model_name='chatmsg',
+            name='time_stamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='groupchat',
+            name='time_stamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
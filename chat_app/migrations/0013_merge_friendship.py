@@ -0,0 +1,59 @@
+# Generated by Django 5.1.4 on 2026-10-18 20:05
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+# The friend requests take the pair of their Friendship row. The requests without one (extra requests between the same
+# two users, made before Friendship existed) were never visible and are deleted.
+def copy_friendship_pairs(apps, schema_editor):
+    FriendRequest = apps.get_model('chat_app', 'FriendRequest')
+    Friendship = apps.get_model('chat_app', 'Friendship')
+
+    friendship = Friendship.objects.filter(request_id=OuterRef('id'))
+    FriendRequest.objects.update(
+        user_low_id=Subquery(friendship.values('user_low_id')[:1]),
+        user_high_id=Subquery(friendship.values('user_high_id')[:1]),
+    )
+    FriendRequest.objects.filter(user_low__isnull=True).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0012_historypurge_cutoff_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='friendrequest',
+            name='user_low',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='friendrequest',
+            name='user_high',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(copy_friendship_pairs, migrations.RunPython.noop),
+        migrations.DeleteModel(
+            name='Friendship',
+        ),
+        migrations.AlterField(
+            model_name='friendrequest',
+            name='user_low',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='friendships_low', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='friendrequest',
+            name='user_high',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='friendships_high', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='friendrequest',
+            constraint=models.UniqueConstraint(fields=('user_low', 'user_high'), name='unique_friend_request_pair'),
+        ),
+    ]
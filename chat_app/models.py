@@ -1,25 +1,77 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.core.files.storage import default_storage
+from django.utils import timezone
 
 # Create your models here.
 
+# Canonical key of a conversation between two users: "<smaller_user_id>_<greater_user_id>".
+# The same scheme is used by the chat room names ("chat_<key>").
+def conversation_key(user_a_id, user_b_id):
+    user_a_id, user_b_id = int(user_a_id), int(user_b_id)
+    return f'{user_a_id}_{user_b_id}' if user_a_id < user_b_id else f'{user_b_id}_{user_a_id}'
+
+# URL sent to the clients for a profile/group picture: its thumbnail (chat_app/images.py), or the original while it has none.
+# Takes the field values, so it also works with values()/values_list() rows.
+def avatar_url(thumbnail, image):
+    return default_storage.url(thumbnail or image)
+
+
 class CustomUser(AbstractUser):
     image = models.ImageField(upload_to='profile_pictures', default='/profile_pictures/default_profile.jpg')  
+    thumbnail = models.ImageField(upload_to='thumbnails', blank=True)    # THUMBNAIL_SIZE WebP of "image"
 
+    @property
+    def avatar_url(self):
+        return avatar_url(self.thumbnail.name, self.image.name)
 
+
+# One row per pair of users: the request, and the friendship once accepted.
+# The canonical (user_low, user_high) pair is unique, so a friend request is one INSERT that fails when the two users already
+# have a request/friendship between them, and every friendship check is a point lookup.
 class FriendRequest(models.Model):
     from_user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="req_sender")
     to_user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="req_receiver")
+    user_low = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="friendships_low")     # smaller user id
+    user_high = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="friendships_high")   # greater user id
     accepted = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     is_read = models.BooleanField(default=False)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_low', 'user_high'], name='unique_friend_request_pair'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self.user_low_id:
+            self.user_low_id, self.user_high_id = sorted((int(self.from_user_id), int(self.to_user_id)))
+        super().save(*args, **kwargs)
+
+    # FriendRequest row (queryset) between two users, in any order
+    @classmethod
+    def between(cls, user_a_id, user_b_id):
+        user_low_id, user_high_id = sorted((int(user_a_id), int(user_b_id)))
+        return cls.objects.filter(user_low_id=user_low_id, user_high_id=user_high_id)
+
 
 class ChatMsg(models.Model):
     sender = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="msg_sender")
     receiver = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="msg_receiver")
     message = models.TextField()
-    time_stamp = models.DateTimeField(auto_now_add=True)
+    time_stamp = models.DateTimeField(default=timezone.now)    # when it was sent (write-behind messages are inserted later)
+    conversation = models.CharField(max_length=50)    # conversation_key(sender, receiver), denormalized for indexed history lookups
+    attachment = models.ForeignKey('Attachment', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['conversation', 'time_stamp', 'id'], name='chatmsg_conversation_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self.conversation:
+            self.conversation = conversation_key(self.sender_id, self.receiver_id)
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return str(self.sender)
@@ -28,10 +80,15 @@ class ChatMsg(models.Model):
 class Group(models.Model):
     name = models.CharField(max_length=500)
     group_image = models.ImageField(upload_to='profile_pictures', default='/profile_pictures/default_profile.jpg')
+    thumbnail = models.ImageField(upload_to='thumbnails', blank=True)    # THUMBNAIL_SIZE WebP of "group_image"
     admin = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="group_admin")
     members = models.ManyToManyField(CustomUser, related_name="group_members")
     created_at = models.DateTimeField(auto_now_add=True)
 
+    @property
+    def avatar_url(self):
+        return avatar_url(self.thumbnail.name, self.group_image.name)
+
     def __str__(self):
         return self.name
 
@@ -47,5 +104,120 @@ class GroupChat(models.Model):
     group = models.ForeignKey(Group, on_delete=models.CASCADE)
     sender = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     message = models.TextField()
-    time_stamp = models.DateTimeField(auto_now_add=True) 
+    time_stamp = models.DateTimeField(default=timezone.now)    # when it was sent (write-behind messages are inserted later)
+    attachment = models.ForeignKey('Attachment', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['group', 'time_stamp', 'id'], name='groupchat_group_idx'),
+        ]
+
+
+# File sent in a chat message, uploaded in chunks before the message is sent (chat_app/attachments.py)
+class Attachment(models.Model):
+    uploader = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="attachments")
+    name = models.CharField(max_length=255)    # original file name
+    content_type = models.CharField(max_length=100)
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)    # bytes uploaded so far
+    file = models.FileField(upload_to='attachments', blank=True)    # set once the upload is complete
+    preview = models.ImageField(upload_to='thumbnails', blank=True)    # ATTACHMENT_PREVIEW_SIZE WebP of an image
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.name
+
+
+# Highest message id handed out per table by the write-behind pipeline (chat_app/messaging.py).
+# Each process reserves blocks of ids from here, so messages get their ids before they are inserted.
+class MessageSequence(models.Model):
+    name = models.CharField(max_length=100, primary_key=True)    # table name
+    last_value = models.BigIntegerField(default=0)
+
+
+# Chat history waiting to be deleted by the purge_history worker (chat_app/purge.py).
+# Until it's done, the messages sent up to "cutoff_at" are hidden from the history endpoints. The cutoff is a time, not
+# an id: in write_behind mode every process hands out ids from its own block, so ids aren't in sending order.
+class HistoryPurge(models.Model):
+    CHAT = 'chat'      # all messages of "conversation"
+    GROUP = 'group'    # messages sent by "sender_id" in the group "group_id"
+    KIND_CHOICES = [(CHAT, 'Chat'), (GROUP, 'Group')]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    conversation = models.CharField(max_length=50, blank=True)
+    group_id = models.IntegerField(null=True, blank=True)     # plain ids, the job outlives the group/user rows
+    sender_id = models.IntegerField(null=True, blank=True)
+    cutoff_at = models.DateTimeField()      # messages sent later (re-friending, re-joining) are kept
+    deleted = models.PositiveIntegerField(default=0)    # progress: messages deleted so far
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    failed = models.BooleanField(default=False)    # gave up after PURGE_MAX_ATTEMPTS, the messages stay hidden
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['conversation'], name='historypurge_conversation_idx'),
+            models.Index(fields=['group_id'], name='historypurge_group_idx'),
+            models.Index(fields=['finished_at', 'next_attempt_at'], name='historypurge_queue_idx'),
+        ]
+
+
+# WebSocket events written by the signal receivers in the same transaction as the change they announce,
+# and sent through the channel layer by the outbox publisher (chat_app/outbox.py) once committed.
+class OutboxEvent(models.Model):
+    group = models.CharField(max_length=200)      # channel layer group ("notifications_<user id>", "chat_group_<group id>", ...)
+    handler = models.CharField(max_length=50)     # consumer method (send_notification / chat_message)
+    frame = models.TextField()                    # pre-encoded WebSocket frame (chat_app/broadcast.py)
+    created_at = models.DateTimeField(auto_now_add=True)
+    claimed_by = models.CharField(max_length=100, blank=True)     # publisher sending it
+    claimed_until = models.DateTimeField(null=True, blank=True)   # claim expiry, an unconfirmed event is sent again after it
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['claimed_until', 'id'], name='outboxevent_claim_idx'),
+        ]
+
+
+# Per-user notification inbox (chat_app/notifications.py), written with the notifications sent by the signal receivers.
+# Pending friend/group requests are inbox rows too ("key" names the request), deleted once the request is resolved.
+class Notification(models.Model):
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="notifications")
+    kind = models.CharField(max_length=50)       # received_friend_request, added_to_group, group_deleted, ...
+    key = models.CharField(max_length=100, blank=True)    # "friend_request:<id>" / "group_request:<id>" for pending requests
+    payload = models.JSONField()                 # the notification as sent to the WebSocket
+    is_read = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'id'], name='notification_user_idx'),
+            models.Index(fields=['user', 'is_read'], name='notification_unread_idx'),
+            models.Index(fields=['key'], name='notification_key_idx'),
+        ]
+
+
+# Conversation list of a user (chat_app/conversations.py): one row per friend and per group, with the last message
+# and the number of unread messages, updated by the consumers when a message is received.
+class ConversationSummary(models.Model):
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="conversations")
+    friend = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=True, blank=True, related_name="+")
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, null=True, blank=True, related_name="summaries")
+    conversation = models.CharField(max_length=50, blank=True)    # conversation_key(user, friend) of a friend chat
+    last_message = models.CharField(max_length=200, blank=True)    # preview of the last message
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+    last_sender = models.ForeignKey(CustomUser, on_delete=models.SET_NULL, null=True, blank=True, related_name="+")
+    last_activity = models.DateTimeField(default=timezone.now)    # time of the last message (or of the friendship/membership)
+    unread_count = models.PositiveIntegerField(default=0)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'friend'], name='unique_friend_conversation'),
+            models.UniqueConstraint(fields=['user', 'group'], name='unique_group_conversation'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'last_activity', 'id'], name='conversation_recency_idx'),
+            models.Index(fields=['conversation'], name='conversation_key_idx'),
+        ]
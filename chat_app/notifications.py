@@ -0,0 +1,86 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+from chat_app.models import Notification
+from chat_app.broadcast import make_event
+from chat_app.outbox import enqueue
+import datetime
+
+
+'''
+Notification inbox.
+
+notify() stores a notification in the inbox of every recipient and queues it for their notification sockets (outbox),
+so users that are offline find it on their next page load. The inbox is read with a cursor (get_notifications), and
+the notifications that stand for a pending friend/group request are deleted when the request is resolved.
+
+The table is kept bounded by "manage.py compact_notifications": read notifications older than
+NOTIFICATION_RETENTION_DAYS are deleted, and only the newest NOTIFICATION_MAX_PER_USER are kept per user.
+'''
+
+
+# Notifications of pending requests, they are not compacted (they go away with the request)
+PENDING_KINDS = ('received_friend_request', 'received_group_request')
+
+def friend_request_key(request_id):
+    return f'friend_request:{request_id}'
+
+def group_request_key(request_id):
+    return f'group_request:{request_id}'
+
+
+# "payload" is the notification sent to the WebSocket (without "type"), the same for every user
+def notify(user_ids, kind, payload, key=''):
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    Notification.objects.bulk_create([Notification(user_id=user_id, kind=kind, key=key, payload=payload) for user_id in user_ids])
+    event = make_event('send_notification', payload)
+    enqueue([(f'notifications_{user_id}', event) for user_id in user_ids])
+
+# Deletes the notification of a resolved request (accepted, rejected or deleted)
+def resolve(key):
+    Notification.objects.filter(key=key).delete()
+
+
+# Marks the user's notifications as read: the given ids, or all of them up to "up_to_id"
+def mark_read(user_id, ids=None, up_to_id=None):
+    notifications = Notification.objects.filter(user_id=user_id, is_read=False)
+    if ids is not None:
+        notifications = notifications.filter(id__in=ids)
+    elif up_to_id is not None:
+        notifications = notifications.filter(id__lte=up_to_id)
+    return notifications.update(is_read=True)
+
+
+# Retention, returns the number of deleted notifications
+def compact(retention_days=None, max_per_user=None, chunk_size=1000):
+    retention_days = settings.NOTIFICATION_RETENTION_DAYS if retention_days is None else retention_days
+    max_per_user = settings.NOTIFICATION_MAX_PER_USER if max_per_user is None else max_per_user
+    compactable = Notification.objects.exclude(kind__in=PENDING_KINDS)
+    deleted = 0
+
+    # Read notifications past the retention period
+    cutoff = timezone.now() - datetime.timedelta(days=retention_days)
+    deleted += delete_in_chunks(compactable.filter(is_read=True, created_at__lt=cutoff), chunk_size)
+
+    # Users over the limit keep their newest notifications
+    over_limit = (
+        compactable.values('user_id').annotate(count=Count('id')).filter(count__gt=max_per_user).values_list('user_id', flat=True)
+    )
+    for user_id in list(over_limit):
+        newest = compactable.filter(user_id=user_id).order_by('-id').values_list('id', flat=True)[max_per_user - 1:max_per_user]
+        deleted += delete_in_chunks(compactable.filter(user_id=user_id, id__lt=newest[0]), chunk_size)
+
+    return deleted
+
+def delete_in_chunks(queryset, chunk_size):
+    deleted = 0
+    while True:
+        with transaction.atomic():
+            ids = list(queryset.values_list('id', flat=True)[:chunk_size])
+            if not ids:
+                return deleted
+            Notification.objects.filter(id__in=ids).delete()
+        deleted += len(ids)
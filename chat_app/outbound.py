@@ -0,0 +1,258 @@
+from collections import deque, Counter
+from functools import partial
+from urllib.parse import parse_qs
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from daphne.server import Server as DaphneServer
+from daphne.ws_protocol import WebSocketProtocol as DaphneWebSocketProtocol
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+import asyncio
+import daphne
+import logging
+import time
+import weakref
+
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Bounded outbound queue of the WebSocket consumers.
+
+The consumers' handlers (chat_message, send_notification, ...) used to await the socket write, so a slow client held
+up its consumer and let its channel fill up in the channel layer, where the overflowing messages are dropped. With
+OutboundQueueMixin the text frames go to a per-connection queue and the handler returns at once; a writer task sends
+the queued frames in bursts (everything queued since its last wake-up, without going back to the event loop's queue).
+
+Each frame of a burst is its own websocket.send and its own write, unless the client connected with ?batch=1: the
+frames queued at the writer's turn are then sent as one text frame, a JSON array of up to OUTBOUND_BATCH_MAX of them
+(the frames are JSON objects, so a client tells the two apart by the first character). A single queued frame is
+always sent as is.
+
+A frame handed to the server isn't on the wire yet: daphne's websocket.send only appends it to the Twisted transport's
+write buffer, without waiting for the client. So the writer registers a push producer (TransportDrain) on the
+connection's daphne protocol, through autobahn's public registerProducer(): Twisted pauses it when more than
+OUTBOUND_TRANSPORT_BUFFER bytes are buffered (the transport's bufferSize) and resumes it once the buffer is written out.
+The writer doesn't send while paused, and the frames of a slow client pile up in the queue, where the limits below
+apply. The daphne classes are recognised by type and the daphne version is checked at startup (check_server(), called
+by apps.py): on a server where no producer can be registered, a warning is logged once and the queue only fills if the
+server's send waits for the client.
+
+Backpressure, per connection:
+  - OUTBOUND_QUEUE_HIGH frames queued: the connection is congested, until the queue drains below OUTBOUND_QUEUE_LOW
+  - congested for more than OUTBOUND_CONGESTION_TIMEOUT seconds, or OUTBOUND_QUEUE_MAX frames queued: the client is
+    too slow, the queue is dropped and the socket closed with SLOW_CONSUMER_CLOSE_CODE (the client reconnects with
+    ?last_id= and gets the missed messages replayed, see chat_app/replay.py)
+'''
+
+
+SLOW_CONSUMER_CLOSE_CODE = 4008
+SUPPORTED_DAPHNE = '4.1.'    # the daphne internals used below: send = partial(Server.handle_reply, WebSocketProtocol)
+
+# Connections with a queue in this process (for outbound_stats())
+connections = weakref.WeakSet()
+
+evicted_total = 0
+closed_frames_sent = Counter()    # consumer class name -> frames sent by the closed connections
+
+
+class OutboundQueueMixin:
+
+    outbound = None
+    outbound_writer = None
+    outbound_closed = False
+    transport_drain = None
+    congested_since = None
+    queue_peak = 0
+    frames_sent = 0
+
+    # Clients that connected with ?batch=1 take a JSON array of frames as one text frame
+    def outbound_batching(self):
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        return query.get('batch', [None])[0] == '1'
+
+    # Text frames are queued, the other messages (accept, close) are sent at once
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if text_data is None or close:
+            return await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+        if self.outbound_closed:
+            return
+
+        if self.outbound is None:
+            self.outbound = deque()
+            self.outbound_ready = asyncio.Event()
+            self.outbound_writer = asyncio.get_running_loop().create_task(self.write_outbound())
+            connections.add(self)
+
+        self.outbound.append(text_data)
+        depth = len(self.outbound)
+        self.queue_peak = max(self.queue_peak, depth)
+
+        if depth >= settings.OUTBOUND_QUEUE_MAX:
+            return await self.evict_slow_consumer(f'{depth} frames queued')
+        if depth >= settings.OUTBOUND_QUEUE_HIGH:
+            now = time.monotonic()
+            if self.congested_since is None:
+                self.congested_since = now
+            elif now - self.congested_since > settings.OUTBOUND_CONGESTION_TIMEOUT:
+                return await self.evict_slow_consumer(f'congested for {now - self.congested_since:.1f}s')
+
+        self.outbound_ready.set()
+
+    async def write_outbound(self):
+        self.transport_drain = watch_transport(getattr(self, 'base_send', None))
+        batching = self.outbound_batching()
+        try:
+            while True:
+                await self.outbound_ready.wait()
+                self.outbound_ready.clear()
+                while self.outbound:
+                    if self.transport_drain is not None:
+                        await self.transport_drain.writable.wait()
+                    if not self.outbound:    # dropped meanwhile (eviction)
+                        break
+                    if batching and len(self.outbound) > 1:
+                        frames = [self.outbound.popleft() for _ in range(min(len(self.outbound), settings.OUTBOUND_BATCH_MAX))]
+                        await super().send(text_data=f"[{','.join(frames)}]")
+                    else:
+                        frames = [self.outbound.popleft()]
+                        await super().send(text_data=frames[0])
+                    self.frames_sent += len(frames)
+                    if self.congested_since is not None and len(self.outbound) <= settings.OUTBOUND_QUEUE_LOW:
+                        self.congested_since = None
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.exception('Outbound writer of %s failed', getattr(self, 'channel_name', None))
+            self.outbound_closed = True
+
+    async def evict_slow_consumer(self, reason):
+        global evicted_total
+        evicted_total += 1
+        logger.warning('Closing slow WebSocket client %s (%s)', getattr(self, 'channel_name', None), reason)
+        self.stop_outbound()
+        await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+    def stop_outbound(self):
+        self.outbound_closed = True
+        if self.outbound is not None:
+            self.outbound.clear()
+        if self.outbound_writer is not None:
+            self.outbound_writer.cancel()
+        if self in connections:
+            closed_frames_sent[type(self).__name__] += self.frames_sent
+            connections.discard(self)
+
+    async def websocket_disconnect(self, message):
+        self.stop_outbound()
+        await super().websocket_disconnect(message)
+
+    def outbound_depth(self):
+        return len(self.outbound) if self.outbound is not None else 0
+
+
+# Refuses to start under a daphne version whose internals (server_protocol()) weren't checked, see requirements.txt
+def check_server():
+    if not daphne.__version__.startswith(SUPPORTED_DAPHNE):
+        raise ImproperlyConfigured(
+            f'daphne {daphne.__version__} is installed, the outbound backpressure (chat_app/outbound.py) supports {SUPPORTED_DAPHNE}x'
+        )
+
+
+# The daphne protocol of a connection: daphne gives the application partial(server.handle_reply, protocol) as "send".
+# None under other servers.
+def server_protocol(send):
+    if isinstance(send, partial) and isinstance(getattr(send.func, '__self__', None), DaphneServer):
+        protocol = send.args[0] if send.args else None
+        if isinstance(protocol, DaphneWebSocketProtocol):
+            return protocol
+        warn_no_backpressure(f'unexpected send arguments {send.args!r}')
+    return None
+
+
+# Push producer of a connection's transport: Twisted pauses it while its write buffer is full
+@implementer(IPushProducer)
+class TransportDrain:
+
+    def __init__(self):
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def pauseProducing(self):
+        self.writable.clear()
+
+    def resumeProducing(self):
+        self.writable.set()
+
+    # Connection lost: the writer mustn't wait forever (it's cancelled by websocket_disconnect)
+    def stopProducing(self):
+        self.writable.set()
+
+
+# Registers a TransportDrain on the connection's daphne protocol, None under other servers
+def watch_transport(send):
+    protocol = server_protocol(send)
+    if protocol is None:
+        return None
+    if hasattr(protocol.transport, 'bufferSize'):
+        protocol.transport.bufferSize = settings.OUTBOUND_TRANSPORT_BUFFER
+    drain = TransportDrain()
+    try:
+        try:
+            protocol.registerProducer(drain, True)
+        except RuntimeError:
+            # The HTTP channel of the upgrade request stays registered on the transport daphne handed over
+            protocol.unregisterProducer()
+            protocol.registerProducer(drain, True)
+    except Exception as error:
+        warn_no_backpressure(repr(error))
+        return None
+    return drain
+
+
+backpressure_warned = False
+
+# Logged once per process: a daphne upgrade that changed what server_protocol() and watch_transport() rely on
+def warn_no_backpressure(reason):
+    global backpressure_warned
+    if not backpressure_warned:
+        backpressure_warned = True
+        logger.warning('No outbound backpressure from daphne (%s), slow clients fill its write buffer', reason)
+
+
+# Queue depths of the open connections of this process
+def outbound_stats(top=10):
+    current = list(connections)
+    depths = sorted(
+        (
+            {
+                'consumer': type(connection).__name__,
+                'channel': getattr(connection, 'channel_name', None),
+                'user_id': getattr(getattr(connection, 'user', None), 'id', None),
+                'depth': connection.outbound_depth(),
+                'peak': connection.queue_peak,
+                'sent': connection.frames_sent,
+                'transport_paused': connection.transport_drain is not None and not connection.transport_drain.writable.is_set(),
+                'congested': connection.congested_since is not None,
+            }
+            for connection in current
+        ),
+        key=lambda stats: stats['depth'], reverse=True,
+    )
+    return {
+        'connections': len(current),
+        'queued': sum(stats['depth'] for stats in depths),
+        'max_depth': depths[0]['depth'] if depths else 0,
+        'congested': sum(stats['congested'] for stats in depths),
+        'evicted': evicted_total,
+        'deepest': depths[:top],
+    }
+
+
+# Frames sent by this process per consumer class, closed connections included
+def frames_sent():
+    totals = Counter(closed_frames_sent)
+    for connection in list(connections):
+        totals[type(connection).__name__] += connection.frames_sent
+    return dict(totals)
@@ -0,0 +1,151 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from channels.layers import get_channel_layer
+from chat_app.db import database_sync_to_async
+from chat_app.models import OutboxEvent
+from chat_app.broadcast import group_send_many
+import asyncio
+import datetime
+import logging
+import os
+import socket
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Transactional outbox of the notification events.
+
+The signal receivers don't talk to the channel layer anymore: enqueue() stores their events as OutboxEvent rows in
+the transaction of the change, so a rolled back change sends nothing and the write path never waits for the layer.
+After the commit the in-process publisher is woken up, it claims the pending rows in batches (OUTBOX_BATCH_SIZE),
+drops the repeated events of the batch, sends them with one group_send_many() call and deletes them.
+
+Delivery is at-least-once: a publisher that dies between the send and the delete leaves claimed rows behind, they are
+sent again when the claim expires (OUTBOX_CLAIM_TIMEOUT seconds). Every worker process runs a publisher (started by
+OutboxPublisherMiddleware in asgi.py), "manage.py publish_outbox" runs one on its own.
+'''
+
+
+# Stores the [(group, event)] pairs (events built with chat_app.broadcast.make_event) in the current transaction
+def enqueue(messages):
+    if not messages:
+        return
+    OutboxEvent.objects.bulk_create([
+        OutboxEvent(group=group, handler=event['type'], frame=event['frame']) for group, event in messages
+    ])
+    transaction.on_commit(wake_publisher)
+
+
+# Claims the next batch of events (the oldest unclaimed or expired ones)
+def claim_batch(publisher_id, batch_size, claim_timeout):
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            OutboxEvent.objects.select_for_update(skip_locked=True)
+            .filter(Q(claimed_until__isnull=True) | Q(claimed_until__lt=now))
+            .order_by('id').values_list('id', flat=True)[:batch_size]
+        )
+        if ids:
+            OutboxEvent.objects.filter(id__in=ids).update(claimed_by=publisher_id, claimed_until=now + datetime.timedelta(seconds=claim_timeout))
+    return list(OutboxEvent.objects.filter(id__in=ids, claimed_by=publisher_id).order_by('id').values_list('id', 'group', 'handler', 'frame'))
+
+def delete_events(ids):
+    OutboxEvent.objects.filter(id__in=ids).delete()
+
+
+# Runs of identical events in a batch (same group and frame, one right after the other) are sent once. Copies that are
+# not next to each other are all kept: "added, closed, added" has to leave the receiver with the last state.
+# "group" tells the consumers that are in several groups (MultiplexConsumer) where the event comes from.
+def coalesce(rows):
+    messages = []
+    previous = None
+    for _, group, handler, frame in rows:
+        if (group, frame) != previous:
+            previous = (group, frame)
+            messages.append((group, {'type': handler, 'frame': frame, 'group': group}))
+    return messages
+
+
+class OutboxPublisher:
+
+    def __init__(self, layer=None, batch_size=None, poll_interval=None, claim_timeout=None):
+        self.layer = layer or get_channel_layer()
+        self.batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+        self.poll_interval = poll_interval or settings.OUTBOX_POLL_INTERVAL
+        self.claim_timeout = claim_timeout or settings.OUTBOX_CLAIM_TIMEOUT
+        self.id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.loop = None
+        self.wakeup = None
+        self.published = 0
+        self.coalesced = 0
+
+    # Sends one batch, returns the number of claimed events (0 when the outbox is empty)
+    async def publish_batch(self):
+        rows = await database_sync_to_async(claim_batch)(self.id, self.batch_size, self.claim_timeout)
+        if not rows:
+            return 0
+        messages = coalesce(rows)
+        await group_send_many(self.layer, messages)
+        await database_sync_to_async(delete_events)([row[0] for row in rows])
+        self.published += len(messages)
+        self.coalesced += len(rows) - len(messages)
+        return len(rows)
+
+    async def run(self, once=False):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        while True:
+            self.wakeup.clear()
+            try:
+                claimed = await self.publish_batch()
+            except Exception:
+                logger.exception('Outbox publisher %s failed, retrying', self.id)
+                claimed = 0
+            if claimed:
+                continue
+            if once:
+                return
+            try:
+                # Woken up by the commits of this process, rows written by other processes are picked up by the polling
+                await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    # Thread-safe, called after the commits
+    def wake(self):
+        if self.wakeup is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+
+publisher = None
+
+def wake_publisher():
+    if publisher is not None:
+        publisher.wake()
+
+# Starts this process's publisher on the running event loop (once)
+def start_publisher():
+    global publisher
+    loop = asyncio.get_running_loop()
+    if publisher is None or publisher.loop is not loop:
+        publisher = OutboxPublisher()
+        publisher.loop = loop
+        publisher.task = loop.create_task(publisher.run())
+    return publisher
+
+
+# ASGI middleware starting the publisher with the first connection/request handled by the process
+class OutboxPublisherMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'lifespan':
+            start_publisher()
+        return await self.app(scope, receive, send)
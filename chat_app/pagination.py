@@ -0,0 +1,96 @@
+from django.conf import settings
+from django.db.models import Q
+from datetime import datetime, timezone
+
+
+# Reads the page size sent by the client, falling back to the default and never exceeding the maximum
+def parse_limit(value, default=None, maximum=None):
+    default = default or settings.CHAT_PAGE_SIZE
+    maximum = maximum or settings.CHAT_MAX_PAGE_SIZE
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(limit, maximum))
+
+
+# Reads an optional id cursor ("before_id" / "after_id"), returns None when missing or invalid
+def parse_cursor(value):
+    try:
+        cursor = int(value)
+    except (TypeError, ValueError):
+        return None
+    return cursor if cursor > 0 else None
+
+
+# Cursor of a row in a list ordered by a time that changes (the conversation list): "<UTC time>_<id>".
+# It carries the row's position itself, the row may have moved by the time the next page is read.
+def encode_time_cursor(value, id):
+    return f"{value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')}_{id}"
+
+# Reads a cursor made by encode_time_cursor(), returns (datetime, id) or None when missing or invalid
+def parse_time_cursor(value):
+    try:
+        stamp, _, id = value.rpartition('_')
+        value, id = datetime.fromisoformat(stamp), int(id)
+    except (AttributeError, TypeError, ValueError):
+        return None
+    if value.tzinfo is None or id <= 0:
+        return None
+    return value, id
+
+
+def keyset_page(queryset, limit, before_id=None, after_id=None, order_field='time_stamp', cursor_value=None):
+    '''
+    Keyset (cursor) pagination over (order_field, id).
+
+    - No cursor: the newest "limit" rows.
+    - before_id: the "limit" rows just older than the cursor row (scrolling back in history).
+    - after_id: the "limit" rows just newer than the cursor row (catching up).
+    - Both: ValueError, a page has one direction.
+
+    Rows are always returned oldest first. "next_cursor" is the id to pass as the same cursor
+    (before_id or after_id) to continue in that direction, or None when there is nothing left.
+    Only the cursor row and limit + 1 rows are read, so the cost does not grow with the history.
+
+    "cursor_value" is the cursor row's order_field value when the client sent it (see encode_time_cursor()),
+    the row isn't looked up then.
+
+    Async callers run it on the DB executor (chat_app.db.database_sync_to_async), inside their sync read helper.
+    '''
+    if before_id and after_id:
+        raise ValueError("before_id and after_id can't be used together")
+    cursor = before_id or after_id
+
+    if cursor and cursor_value is None:
+        # The cursor row is looked up inside the same queryset, so an id from another conversation gives an empty page
+        cursor_value = queryset.filter(id=cursor).values_list(order_field, flat=True).first()
+        if cursor_value is None:
+            return [], None
+
+    rows = list(_page_queryset(queryset, limit, cursor_value, before_id, after_id, order_field))
+    return _page_result(rows, limit, after_id)
+
+
+# The limit + 1 rows next to the cursor, in reading order (newest first unless after_id is given)
+def _page_queryset(queryset, limit, cursor_value, before_id, after_id, order_field):
+    if after_id:
+        queryset = queryset.filter(Q(**{f'{order_field}__gt': cursor_value}) | Q(**{order_field: cursor_value, 'id__gt': after_id}))
+        return queryset.order_by(order_field, 'id')[:limit + 1]
+    if before_id:
+        queryset = queryset.filter(Q(**{f'{order_field}__lt': cursor_value}) | Q(**{order_field: cursor_value, 'id__lt': before_id}))
+    return queryset.order_by(f'-{order_field}', '-id')[:limit + 1]
+
+
+def _page_result(rows, limit, after_id):
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not after_id:
+        rows.reverse()    # oldest first
+
+    next_cursor = None
+    if has_more and rows:
+        row = rows[-1] if after_id else rows[0]
+        next_cursor = row['id'] if isinstance(row, dict) else row.id
+
+    return rows, next_cursor
@@ -0,0 +1,98 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, Max, OuterRef
+from django.utils import timezone
+from chat_app.models import ChatMsg, GroupChat, HistoryPurge
+import datetime
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Deleting chat history in the background.
+
+Unfriending and leaving/removal from a group used to delete the whole history inside the HTTP request. The views now
+only insert a HistoryPurge row (one indexed write), which immediately hides the messages from the history endpoints,
+and the "purge_history" worker deletes them in chunks of PURGE_CHUNK_SIZE rows, one short transaction per chunk,
+sleeping PURGE_CHUNK_DELAY seconds between chunks so other writers get the database lock.
+'''
+
+
+# Queueing (called by the views)
+
+def schedule_chat_purge(conversation):
+    return HistoryPurge.objects.create(kind=HistoryPurge.CHAT, conversation=conversation, cutoff_at=timezone.now())
+
+def schedule_group_purge(group_id, sender_ids):
+    cutoff_at = timezone.now()
+    HistoryPurge.objects.bulk_create([
+        HistoryPurge(kind=HistoryPurge.GROUP, group_id=group_id, sender_id=sender_id, cutoff_at=cutoff_at)
+        for sender_id in sender_ids
+    ])
+
+
+# Hiding the queued messages (used by the history reads)
+
+def visible_chat_messages(queryset, conversation):
+    cutoff = HistoryPurge.objects.filter(conversation=conversation, finished_at__isnull=True).aggregate(cutoff_at=Max('cutoff_at'))
+    if cutoff['cutoff_at']:
+        queryset = queryset.filter(time_stamp__gt=cutoff['cutoff_at'])
+    return queryset
+
+# A subquery rather than one condition per unfinished purge: failed purges stay unfinished, and SQLite rejects
+# expressions of about a thousand terms
+def visible_group_messages(queryset, group_id):
+    return queryset.exclude(Exists(HistoryPurge.objects.filter(
+        group_id=group_id, sender_id=OuterRef('sender_id'), cutoff_at__gte=OuterRef('time_stamp'), finished_at__isnull=True,
+    )))
+
+
+# The worker
+
+def job_messages(job):
+    if job.kind == HistoryPurge.CHAT:
+        return ChatMsg.objects.filter(conversation=job.conversation, time_stamp__lte=job.cutoff_at)
+    return GroupChat.objects.filter(group_id=job.group_id, sender_id=job.sender_id, time_stamp__lte=job.cutoff_at)
+
+# Deletes one chunk of the job's messages, returns the number of deleted messages (0 when the job is done)
+def purge_chunk(job, chunk_size):
+    messages = job_messages(job)
+    with transaction.atomic():
+        ids = list(messages.values_list('id', flat=True)[:chunk_size])
+        if ids:
+            messages.model.objects.filter(id__in=ids).delete()
+            HistoryPurge.objects.filter(id=job.id).update(deleted=job.deleted + len(ids))
+        else:
+            HistoryPurge.objects.filter(id=job.id).update(finished_at=timezone.now())
+    job.deleted += len(ids)
+    return len(ids)
+
+# Runs one job to completion, or schedules a retry (exponential backoff) when a chunk fails
+def run_job(job, chunk_size=None, delay=None, progress=None):
+    chunk_size = chunk_size or settings.PURGE_CHUNK_SIZE
+    delay = settings.PURGE_CHUNK_DELAY if delay is None else delay
+
+    try:
+        while purge_chunk(job, chunk_size):
+            if progress:
+                progress(job)
+            time.sleep(delay)
+    except Exception as error:
+        logger.exception('History purge %s failed', job.id)
+        attempts = job.attempts + 1
+        HistoryPurge.objects.filter(id=job.id).update(
+            attempts=attempts,
+            last_error=repr(error),
+            next_attempt_at=timezone.now() + datetime.timedelta(seconds=2 ** attempts),
+            failed=attempts >= settings.PURGE_MAX_ATTEMPTS,
+        )
+        return False
+    return True
+
+def next_job():
+    return HistoryPurge.objects.filter(
+        finished_at__isnull=True, failed=False, next_attempt_at__lte=timezone.now(),
+    ).order_by('next_attempt_at', 'id').first()
@@ -0,0 +1,178 @@
+from collections import OrderedDict
+from django.conf import settings
+from urllib.parse import parse_qs
+from chat_app.broadcast import encode
+from chat_app.db import database_sync_to_async
+from chat_app.pagination import parse_cursor
+from chat_app.messaging import write_behind_enabled, flush_pending_messages
+from chat_app.layers import layer_is_shared
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Replaying the messages a chat socket missed while it was reconnecting.
+
+Every process keeps the last REPLAY_BUFFER_SIZE message frames of the chat rooms its sockets are in, recorded by the
+chat_message handlers (keyed by message id, in delivery order). A client reconnecting with "?last_id=<id>" gets the
+frames after that id from the buffer, or from an indexed range read of the history when the id is no longer in the
+buffer (at most REPLAY_MAX_MESSAGES messages, then a "replay_incomplete" frame tells it to load the rest with get_chats).
+
+The history read first flushes this process's write-behind queues (chat_app/messaging.py). With write_behind and
+several workers (a shared channel layer) the history can't be trusted for a replay: the other processes' queued
+messages aren't in it yet, and their ids aren't in sending order. The replays the buffer can't serve then only get a
+"replay_incomplete" frame, as do the replays whose "last_id" isn't in the history ("next_cursor" is null then: the
+client reloads the latest page).
+
+The buffer of a room is dropped when the last socket of the process leaves the room: from then on this process doesn't
+see the room's messages anymore, so the buffer couldn't tell whether it missed some.
+'''
+
+
+class RoomBuffer:
+
+    def __init__(self, size):
+        self.size = size
+        self.frames = OrderedDict()    # message id -> frame, in delivery order
+        self.subscribers = 0
+
+    def record(self, id, frame):
+        if id not in self.frames:
+            self.frames[id] = frame
+            if len(self.frames) > self.size:
+                self.frames.popitem(last=False)
+
+    # [(id, frame)] delivered after "last_id", or None when "last_id" isn't in the buffer
+    def since(self, last_id):
+        missed = []
+        for id in reversed(self.frames):
+            if id == last_id:
+                missed.reverse()
+                return missed
+            missed.append((id, self.frames[id]))
+        return None
+
+
+# The buffers of this process. Used by the consumers (event loop) and by the signal receivers (ORM threads).
+class ReplayBuffers:
+
+    def __init__(self, size=None):
+        self.size = size
+        self._rooms = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, room):
+        with self._lock:
+            buffer = self._rooms.get(room)
+            if buffer is None:
+                buffer = self._rooms[room] = RoomBuffer(self.size or settings.REPLAY_BUFFER_SIZE)
+            buffer.subscribers += 1
+
+    def unsubscribe(self, room):
+        with self._lock:
+            buffer = self._rooms.get(room)
+            if buffer is not None:
+                buffer.subscribers -= 1
+                if buffer.subscribers <= 0:
+                    del self._rooms[room]
+
+    def record(self, room, id, frame):
+        with self._lock:
+            buffer = self._rooms.get(room)
+            if buffer is not None:
+                buffer.record(id, frame)
+
+    def since(self, room, last_id):
+        with self._lock:
+            buffer = self._rooms.get(room)
+            return buffer.since(last_id) if buffer is not None else None
+
+    # Forgetting the recorded messages (e.g. the messages of a removed group member are being purged)
+    def clear(self, room):
+        with self._lock:
+            buffer = self._rooms.get(room)
+            if buffer is not None:
+                buffer.frames.clear()
+
+
+replay_buffers = ReplayBuffers()
+
+
+# "?last_id=" of the socket's URL
+def query_last_id(scope):
+    query = parse_qs(scope.get('query_string', b'').decode())
+    return parse_cursor(query.get('last_id', [None])[0])
+
+
+# Whether the history has every message sent so far (see above)
+def history_replay_reliable():
+    return not (write_behind_enabled() and layer_is_shared())
+
+# The messages after "last_id" read from the history by "missed_messages", None when the history can't tell
+async def read_history(last_id, missed_messages):
+    if not history_replay_reliable():
+        return None
+    try:
+        await flush_pending_messages()
+    except Exception:
+        logger.exception('Could not flush the pending messages before a replay')
+        return None
+    return await database_sync_to_async(missed_messages)(last_id, settings.REPLAY_MAX_MESSAGES)
+
+
+# Mixin of the chat consumers, for the rooms they're in. "missed_messages(last_id, limit)" (sync) reads the room's history after
+# "last_id" and returns ([(id, frame)], next_cursor), or None when "last_id" isn't in the history, for the replays the
+# buffer can't serve.
+class RoomReplayMixin:
+
+    replay_rooms = None    # room -> ids of the replayed messages, not yet seen live
+
+    # Called once the socket is accepted and in the room's group
+    async def start_replay(self, room, last_id, missed_messages):
+        if self.replay_rooms is None:
+            self.replay_rooms = {}
+        replay_buffers.subscribe(room)
+        self.replay_rooms[room] = set()
+        if last_id is None:
+            return
+
+        missed, next_cursor = replay_buffers.since(room, last_id), None
+        incomplete = False
+        if missed is None:
+            history = await read_history(last_id, missed_messages)
+            if history is None:
+                missed, incomplete = [], True
+            else:
+                missed, next_cursor = history
+                incomplete = next_cursor is not None
+
+        for _, frame in missed:
+            await self.send_replay_frame(room, frame)
+        if incomplete:
+            await self.send_replay_frame(room, encode({'type': 'replay_incomplete', 'next_cursor': next_cursor}))
+
+        # Messages delivered to the group while replaying are already queued for this consumer, they're skipped once
+        self.replay_rooms[room] = {id for id, _ in missed}
+
+    async def send_replay_frame(self, room, frame):
+        await self.send(text_data=frame)
+
+    # Called by the chat_message handler, returns False when the client already got the event from the replay
+    def record_event(self, room, event):
+        id = event.get('id')
+        if id is None or room not in (self.replay_rooms or {}):    # not a message (group_closed, ...), or not replayed room
+            return True
+        replay_buffers.record(room, id, event['frame'])
+        replayed = self.replay_rooms[room]
+        if replayed:
+            if id in replayed:
+                return False
+            replayed.clear()    # past the replay, the next events are all new
+        return True
+
+    def stop_replay(self, room):
+        if self.replay_rooms and self.replay_rooms.pop(room, None) is not None:
+            replay_buffers.unsubscribe(room)
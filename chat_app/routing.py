@@ -5,4 +5,5 @@ websocket_urlpatterns = [
     path('ws/user/<int:id>/', consumers.UserChatConsumer.as_asgi()), 
     path('ws/group/<int:id>/', consumers.GroupChatConsumer.as_asgi()),
     path('ws/notifications/', consumers.NotificationConsumer.as_asgi()),
+    path('ws/multiplex/', consumers.MultiplexConsumer.as_asgi()),
 ]
\ No newline at end of file
@@ -0,0 +1,94 @@
+from django.db import connection
+from django.db.models import Q
+from chat_app.models import CustomUser as User, Group
+import re
+
+
+'''
+Full-text search of users (username, first name) and groups (name).
+
+On SQLite the names are indexed in two FTS5 tables (created by migration 0005, rowid = user/group id) that the
+signal receivers keep up to date. Queries are ranked (bm25) and every word is matched as a prefix, so "shiv ku"
+finds "Shivakumar". Other databases fall back to icontains filters.
+'''
+
+
+USER_SEARCH_TABLE = 'chat_app_user_search'
+GROUP_SEARCH_TABLE = 'chat_app_group_search'
+
+
+def fts_enabled():
+    return connection.vendor == 'sqlite'
+
+
+# Turns the user's text into an FTS5 query: every word becomes a quoted prefix term, all of them must match
+def match_expression(query):
+    words = re.findall(r'\w+', query.lower())
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+# Index maintenance (called by the signal receivers)
+
+def index_user(user):
+    if fts_enabled():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT OR REPLACE INTO {USER_SEARCH_TABLE} (rowid, username, name) VALUES (%s, %s, %s)',
+                [user.id, user.username, user.first_name],
+            )
+
+def unindex_user(user_id):
+    if fts_enabled():
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {USER_SEARCH_TABLE} WHERE rowid = %s', [user_id])
+
+def index_group(group):
+    if fts_enabled():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT OR REPLACE INTO {GROUP_SEARCH_TABLE} (rowid, name) VALUES (%s, %s)',
+                [group.id, group.name],
+            )
+
+def unindex_group(group_id):
+    if fts_enabled():
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {GROUP_SEARCH_TABLE} WHERE rowid = %s', [group_id])
+
+
+# Queries, both return a page of ids in rank order
+
+def search_user_ids(query, limit, offset=0, exclude_id=None):
+    expression = match_expression(query)
+    if expression is None:
+        return []
+
+    if fts_enabled():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {USER_SEARCH_TABLE} WHERE {USER_SEARCH_TABLE} MATCH %s AND rowid != %s '
+                f'ORDER BY rank LIMIT %s OFFSET %s',
+                [expression, exclude_id or 0, limit, offset],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    users = User.objects.filter(Q(username__icontains=query) | Q(first_name__icontains=query)).exclude(id=exclude_id)
+    return list(users.order_by('id').values_list('id', flat=True)[offset:offset + limit])
+
+def search_group_ids(query, limit, offset=0):
+    expression = match_expression(query)
+    if expression is None:
+        return []
+
+    if fts_enabled():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {GROUP_SEARCH_TABLE} WHERE {GROUP_SEARCH_TABLE} MATCH %s ORDER BY rank LIMIT %s OFFSET %s',
+                [expression, limit, offset],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    groups = Group.objects.filter(name__icontains=query)
+    return list(groups.order_by('id').values_list('id', flat=True)[offset:offset + limit])
@@ -1,93 +1,160 @@
-from django.db.models.signals import post_save, pre_delete, m2m_changed
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
 from django.dispatch import receiver
-from chat_app.models import Group, GroupRequests, FriendRequest, CustomUser as User
-from asgiref.sync import sync_to_async
-from channels.layers import get_channel_layer
+from chat_app.models import Group, GroupRequests, FriendRequest, CustomUser as User, conversation_key
+from chat_app.cache import friendship_key, membership_key
+from chat_app.invalidation import invalidate_authz, invalidate_group_members, invalidate_user_groups, invalidate_user
+from chat_app.search import index_user, unindex_user, index_group, unindex_group
+from chat_app.broadcast import make_event
+from chat_app.outbox import enqueue
+from chat_app.notifications import notify, resolve, friend_request_key, group_request_key
+from chat_app import conversations
+from chat_app.replay import replay_buffers
+from chat_app.metrics import instrumented_receiver
 
 
-channel_layer = get_channel_layer()
+# The notification receivers below don't send anything themselves, their events are written to the outbox in the
+# transaction of the change and sent after the commit (see chat_app/outbox.py). The notifications of the users are
+# also stored in their inbox (see chat_app/notifications.py).
+
+
+# Dropping the cached user principal and verified tokens (see chat_app/auth.py) when the user row changes or is deleted
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+@instrumented_receiver
+def user_cache_invalidation(sender, instance, **kwargs):
+    invalidate_user(instance.id)
+
+
+# Keeping the search index (see chat_app/search.py) in sync with the users and groups
+@receiver(post_save, sender=User)
+@instrumented_receiver
+def user_search_index(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or {'username', 'first_name'} & set(update_fields):
+        index_user(instance)
+
+@receiver(post_delete, sender=User)
+@instrumented_receiver
+def user_search_unindex(sender, instance, **kwargs):
+    unindex_user(instance.id)
+
+@receiver(post_save, sender=Group)
+@instrumented_receiver
+def group_search_index(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or 'name' in update_fields:
+        index_group(instance)
+
+@receiver(post_delete, sender=Group)
+@instrumented_receiver
+def group_search_unindex(sender, instance, **kwargs):
+    unindex_group(instance.id)
+
+
+# Invalidating the cached membership checks (see chat_app/cache.py) of the users added to or removed from a group.
+# "reverse" is True when the change is made from the user side (user.group_members.add(group)), then pk_set holds group ids.
+@receiver(m2m_changed, sender=Group.members.through)
+@instrumented_receiver
+def group_members_cache_invalidation(sender, instance, action, pk_set, reverse, **kwargs):
+    if action in ("post_add", "post_remove"):
+        if reverse:
+            invalidate_authz(*(membership_key(group_id, instance.id) for group_id in pk_set))
+        else:
+            invalidate_authz(*(membership_key(instance.id, user_id) for user_id in pk_set))
+
+    elif action == "post_clear":
+        if reverse:
+            invalidate_user_groups(instance.id)
+        else:
+            invalidate_group_members(instance.id)
+
+
+# Conversation list rows (see chat_app/conversations.py) of the users added to or removed from a group
+@receiver(m2m_changed, sender=Group.members.through)
+@instrumented_receiver
+def group_members_conversations(sender, instance, action, pk_set, reverse, **kwargs):
+    if reverse:
+        return
+    if action == "post_add":
+        conversations.open_group(instance.id, pk_set)
+    elif action == "post_remove":
+        conversations.close_group(instance.id, pk_set)
+    elif action == "post_clear":
+        conversations.close_group(instance.id)
 
 
 # Sending notifications to the user when they are added to or removed from a group.
 @receiver(m2m_changed, sender=Group.members.through)
-async def group_members_update_notification(sender, instance, action, pk_set, **kwargs):
+@instrumented_receiver
+def group_members_update_notification(sender, instance, action, pk_set, reverse, **kwargs):
 
-    admin = await sync_to_async(lambda: instance.admin)() 
+    if reverse:    # changes made from the user side (user.group_members.add(group)) aren't used by the app
+        return
 
     if action == "post_add":
-        for i in pk_set:
-            if admin.id != int(i):  # The admin is automatically added as a member when the group is created, so no notification is sent to the admin.
-                
-                # Sending group details via notification WebSocket when the user is added.
-                await channel_layer.group_send(
-                    f"notifications_{i}", 
-                    {
-                        "type": "send_notification",
-                        "id": instance.id,
-                        "name": instance.name,
-                        "image": instance.group_image.url,
-                        "added_to_group": True,
-                    }
-                )
+        # Sending group details via notification WebSocket to the added users (the same notification for all of them).
+        # The admin is automatically added as a member when the group is created, so no notification is sent to the admin.
+        notify([i for i in pk_set if instance.admin_id != int(i)], "added_to_group", {
+            "id": instance.id,
+            "name": instance.name,
+            "image": instance.avatar_url,
+            "added_to_group": True,
+        })
 
     elif action == "post_remove":
-        removed_members = await sync_to_async(lambda: list(User.objects.filter(id__in=pk_set)))()
-        for i in removed_members:
-            # Sending group id via notification WS to remove the group from user connections
-            await channel_layer.group_send(
-                f"notifications_{i.id}",
-                {
-                    "type": "send_notification",
-                    "id": instance.id,
-                    "group_closed": True,
-                    "msg": f"You are no longer a member of the {instance.name} group",
-                }
-            )
-
-            # If the user is connected to the group, send a message to the group WebSocket to disconnect the user from the group WebSocket on the frontend (when the user is on the group's chat page).
-            await channel_layer.group_send(
-                f"chat_group_{instance.id}",
-                {
-                    "type": "chat_message",
-                    "username": i.username,
-                    "group_closed": True,
-                    "msg": f"You are no longer a member of the {instance.name} group",
-                }
-            )
+        removed_usernames = list(User.objects.filter(id__in=pk_set).values_list('id', 'username'))
+
+        # Sending group id via notification WS to remove the group from user connections
+        notify([user_id for user_id, _ in removed_usernames], "group_closed", {
+            "id": instance.id,
+            "group_closed": True,
+            "msg": f"You are no longer a member of the {instance.name} group",
+        })
+
+        # If the user is connected to the group, send a message to the group WebSocket to disconnect the user from the group WebSocket on the frontend (when the user is on the group's chat page).
+        # The removed users' messages are being purged, they shouldn't be replayed to reconnecting members (see chat_app/replay.py)
+        replay_buffers.clear(f"chat_group_{instance.id}")
+
+        enqueue([
+            (f"chat_group_{instance.id}", make_event("chat_message", {
+                "username": username,
+                "group_closed": True,
+                "msg": f"You are no longer a member of the {instance.name} group",
+            }))
+            for _, username in removed_usernames
+        ])
 
            
 
+# Invalidating the cached membership checks of a deleted group
+@receiver(pre_delete, sender=Group)
+@instrumented_receiver
+def group_deletion_cache_invalidation(sender, instance, **kwargs):
+    invalidate_group_members(instance.id)
+
+
 # Sending notification to all group members when group is deleted
 @receiver(pre_delete, sender=Group)
-async def group_deletion_notification(sender, instance, **kwargs):
-
-    members = await sync_to_async(lambda: list(instance.members.all()))()
-    for i in members:
-        await channel_layer.group_send(
-            f"notifications_{i.id}",
-            {
-                "type": "send_notification",
-                "id": instance.id,
-                "group_deleted": True,
-                "msg": f"The group {instance.name} has been deleted",
-            }
-        )
+@instrumented_receiver
+def group_deletion_notification(sender, instance, **kwargs):
+
+    member_ids = list(instance.members.values_list('id', flat=True))
+    notify(member_ids, "group_deleted", {
+        "id": instance.id,
+        "group_deleted": True,
+        "msg": f"The group {instance.name} has been deleted",
+    })
     
     # If the user is connected to the group, send a message to the group WebSocket to disconnect the user from the group WebSocket on the frontend (when the user is on the group's chat page).
-    await channel_layer.group_send(
-        f"chat_group_{instance.id}",
-        {
-            "type": "chat_message",
-            "group_deleted": True,
-            "msg": f"The group {instance.name} has been deleted",
-        }
-    )
+    enqueue([(f"chat_group_{instance.id}", make_event("chat_message", {
+        "group_deleted": True,
+        "msg": f"The group {instance.name} has been deleted",
+    }))])
 
 
 
 # Notifies the group admin when a new group join request is received.
 @receiver(post_save, sender=GroupRequests)
-async def received_group_request_notification(sender, instance, created, **kwargs):
+@instrumented_receiver
+def received_group_request_notification(sender, instance, created, **kwargs):
     
     if created:
         ''' 
@@ -95,29 +162,58 @@ async def received_group_request_notification(sender, instance, created, **kwarg
         '''
 
         if instance.accepted == False:
-            requested_user = await sync_to_async(lambda: instance.requested_user)()
-            admin = await sync_to_async(lambda: instance.group.admin)()
-            group = await sync_to_async(lambda: instance.group)()
+            requested_user = instance.requested_user
+            group = instance.group
             
-            await channel_layer.group_send(
-                f"notifications_{admin.id}",
-                {
-                    "type": "send_notification",
-                    "group_id": group.id,
-                    "group_name": group.name,
-                    "group_image": group.group_image.url,
-                    "group_req_id": instance.id,
-                    "username": requested_user.username,
-                    "user_id": requested_user.id,
-                    "received_group_request": True,
-                }
-            )
+            notify([group.admin_id], "received_group_request", {
+                "group_id": group.id,
+                "group_name": group.name,
+                "group_image": group.avatar_url,
+                "group_req_id": instance.id,
+                "username": requested_user.username,
+                "user_id": requested_user.id,
+                "received_group_request": True,
+            }, key=group_request_key(instance.id))
+
+    # The admin accepted the request, it is no longer pending in the admin's inbox
+    elif instance.accepted:
+        resolve(group_request_key(instance.id))
+
+
+# Rejected requests, members leaving and deleted groups
+@receiver(post_delete, sender=GroupRequests)
+@instrumented_receiver
+def group_request_resolved(sender, instance, **kwargs):
+    if not instance.accepted:
+        resolve(group_request_key(instance.id))
+
+
+# Invalidating the cached friendship check when a request is made or accepted. The FriendRequest row is the friendship
+# itself (a second request between the same two users violates its unique pair constraint, which aborts the save and
+# its notification). Change "accepted" with save(): update() sends no post_save, the cached checks and the
+# notifications would miss the change.
+@receiver(post_save, sender=FriendRequest)
+@instrumented_receiver
+def friendship_changed(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    invalidate_authz(friendship_key(instance.from_user_id, instance.to_user_id))
+
+
+
+# Conversation list rows of two users becoming friends (deleted in unfriend_notification)
+@receiver(post_save, sender=FriendRequest)
+@instrumented_receiver
+def friendship_conversations(sender, instance, created, raw=False, **kwargs):
+    if instance.accepted and not raw:
+        conversations.open_chat(instance.from_user_id, instance.to_user_id)
 
 
 
 # Send a notification to the user when they receive a new friend request or when their friend request is accepted by another user.
 @receiver(post_save, sender=FriendRequest)
-async def friend_request_notification(sender, instance, created, **kwargs):
+@instrumented_receiver
+def friend_request_notification(sender, instance, created, **kwargs):
 
     if 'from_user' in instance._state.fields_cache and 'to_user' in instance._state.fields_cache:
         # Using preloaded values
@@ -125,47 +221,50 @@ async def friend_request_notification(sender, instance, created, **kwargs):
         to_user = instance.to_user
     else: 
         # if values are not preloaded, querying the db
-        req = await sync_to_async(FriendRequest.objects.select_related('from_user', 'to_user').filter(id=instance.id).first)()
+        req = FriendRequest.objects.select_related('from_user', 'to_user').filter(id=instance.id).first()
+        if req is None:    # one of the users doesn't exist, the request will be rolled back
+            return
         from_user = req.from_user
         to_user = req.to_user
     
     # When a friend request is created, send a notification to the "to_user" to inform them that they have received a friend request.
     if created:
-        await channel_layer.group_send(
-            f"notifications_{to_user.id}",
-            {
-                "type": "send_notification",
-                "msg": f"You have received friend request from {from_user.username}",
-                "id": from_user.id,  
-                "name": from_user.first_name,
-                "email": from_user.username,
-                "image": from_user.image.url,
-                "received_friend_request": True,
-            }
-        )
+        notify([to_user.id], "received_friend_request", {
+            "msg": f"You have received friend request from {from_user.username}",
+            "id": from_user.id,  
+            "name": from_user.first_name,
+            "email": from_user.username,
+            "image": from_user.avatar_url,
+            "received_friend_request": True,
+        }, key=friend_request_key(instance.id))
 
     else: 
         # When "to_user" accepts friend request, send notification to the "from_user" and update the "from_user's" connections on the frontend
         if instance.accepted:
-            await channel_layer.group_send(
-                f"notifications_{from_user.id}",
-                {
-                    "type": "send_notification",
-                    "msg": f"{to_user.username} accepted your friend request",
-                    "id": to_user.id,  
-                    "name": to_user.first_name,
-                    "email": to_user.username,
-                    "image": to_user.image.url,
-                    "accepted_friend_request": True,
-                }
-            )
+            resolve(friend_request_key(instance.id))
+            notify([from_user.id], "accepted_friend_request", {
+                "msg": f"{to_user.username} accepted your friend request",
+                "id": to_user.id,  
+                "name": to_user.first_name,
+                "email": to_user.username,
+                "image": to_user.avatar_url,
+                "accepted_friend_request": True,
+            })
         
 
 
   
+# Invalidating the cached friendship check when a friend request is rejected or the users unfriend each other
+@receiver(pre_delete, sender=FriendRequest)
+@instrumented_receiver
+def friendship_cache_invalidation(sender, instance, **kwargs):
+    invalidate_authz(friendship_key(instance.from_user_id, instance.to_user_id))
+
+
 # Triggered when a user unfriends another user.
 @receiver(pre_delete, sender=FriendRequest)
-async def unfriend_notification(sender, instance, **kwargs):
+@instrumented_receiver
+def unfriend_notification(sender, instance, **kwargs):
 
     if 'from_user' in instance._state.fields_cache and 'to_user' in instance._state.fields_cache:
         # Using preloaded values
@@ -173,7 +272,7 @@ async def unfriend_notification(sender, instance, **kwargs):
         to_user = instance.to_user
     else:
         # if values are not preloaded, querying the db
-        req = await sync_to_async(FriendRequest.objects.select_related('from_user', 'to_user').filter(id=instance.id).first)()
+        req = FriendRequest.objects.select_related('from_user', 'to_user').filter(id=instance.id).first()
         from_user = req.from_user
         to_user = req.to_user
 
@@ -181,48 +280,33 @@ async def unfriend_notification(sender, instance, **kwargs):
     if instance.accepted == True:
 
         # Sending a notification to both the "from_user" and "to_user" when the friend connection is deleted.
-        await channel_layer.group_send(
-            f"notifications_{from_user.id}",
-            {
-                "type": "send_notification",
-                "msg": f"You are no longer friends with {to_user.username}.",
-                "id": to_user.id,  
-                "friend_connection_deleted": True,
-            }
-        )
-
-        await channel_layer.group_send(
-            f"notifications_{to_user.id}",
-            {
-                "type": "send_notification",
-                "msg": f"You are no longer friends with {from_user.username}.",
-                "id": from_user.id,  
-                "friend_connection_deleted": True,
-            }
-        )
+        notify([from_user.id], "friend_connection_deleted", {
+            "msg": f"You are no longer friends with {to_user.username}.",
+            "id": to_user.id,  
+            "friend_connection_deleted": True,
+        })
+        notify([to_user.id], "friend_connection_deleted", {
+            "msg": f"You are no longer friends with {from_user.username}.",
+            "id": from_user.id,  
+            "friend_connection_deleted": True,
+        })
 
         # Sending a friend connection deleted notification to the chat_room WebSocket so that if either user is on the chat page, the frontend (React) will close the chat WebSocket connection.
-        users_id = f"{from_user.id}_{to_user.id}" if int(from_user.id) < int(to_user.id) else f"{to_user.id}_{from_user.id}"
-        room_name = 'chat_%s' % users_id
-
-        await channel_layer.group_send(
-            room_name,
-            {
-                "type": "chat_message",
-                "msg": f"You are no longer friends with {from_user.username}.",
-                "id": from_user.id,  
-                "friend_connection_deleted": True,
-            }
-        )
+        room_name = 'chat_%s' % conversation_key(from_user.id, to_user.id)
+
+        enqueue([(room_name, make_event("chat_message", {
+            "msg": f"You are no longer friends with {from_user.username}.",
+            "id": from_user.id,  
+            "friend_connection_deleted": True,
+        }))])
+
+        conversations.close_chat(from_user.id, to_user.id)
 
     # If the friend request object is deleted without accepted=True, it means the "to_user" rejected the friend request from the "from_user," and a notification is sent to the "from_user."
     else:
-        await channel_layer.group_send(
-            f"notifications_{from_user.id}",
-            {
-                "type": "send_notification",
-                "msg": f"{to_user.username} rejected your friend request",
-                "rejected_friend_request": True,
-            }
-        )
+        resolve(friend_request_key(instance.id))
+        notify([from_user.id], "rejected_friend_request", {
+            "msg": f"{to_user.username} rejected your friend request",
+            "rejected_friend_request": True,
+        })
 
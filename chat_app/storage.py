@@ -0,0 +1,144 @@
+from django.apps import apps
+from django.conf import settings
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.db import models
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+
+
+'''
+Content-addressed media storage (the default storage, see STORAGES in settings.py).
+
+A saved file is named after the SHA-256 of its content, "blobs/<2 hex>/<sha256><ext>", whatever name or upload_to it
+was given: uploading the same picture again (or the same thumbnail) stores nothing new, and the URL of a blob never
+changes content, so chat_app/media.py serves blobs as immutable and clients cache them for good.
+
+Blobs are never overwritten nor deleted on save. collect_blobs() (the collect_blobs command) deletes the blobs no
+FileField references anymore, nor any JSONField (the notification payloads keep the URLs of the pictures), once they're
+older than BLOB_GC_GRACE seconds (a blob may be saved a moment before the row referencing it is committed).
+'''
+
+
+BLOB_DIR = 'blobs'
+TMP_DIR = 'blobs/tmp'
+HASH_BLOCK_SIZE = 1024 * 1024
+
+_extension = re.compile(r'^\.[a-z0-9]{1,10}$')
+_blob_name = re.compile(r'blobs/[0-9a-f]{2}/[0-9a-f]{64}(?:\.[a-z0-9]{1,10})?')    # in a URL or a name
+
+
+def is_blob(name):
+    return name.startswith(BLOB_DIR + '/') and not name.startswith(TMP_DIR + '/')
+
+# The hash part of a blob name (the ETag of the blob)
+def blob_hash(name):
+    return os.path.splitext(os.path.basename(name))[0]
+
+
+class ContentAddressedStorage(FileSystemStorage):
+
+    # The name is only a hint for the extension, and a saved name is never taken (see _save)
+    def get_available_name(self, name, max_length=None):
+        return name
+
+    def _save(self, name, content):
+        extension = os.path.splitext(name)[1].lower()
+        if not _extension.match(extension):
+            extension = ''
+
+        if hasattr(content, 'temporary_file_path'):
+            # Already a file on disk (large uploads, attachments): hashed where it is, then moved instead of copied
+            tmp_path = content.temporary_file_path()
+            hexdigest = file_hash(tmp_path)
+        else:
+            tmp_path, hexdigest = self._spool(content)
+
+        try:
+            name = f'{BLOB_DIR}/{hexdigest[:2]}/{hexdigest}{extension}'
+            path = self.path(name)
+            if os.path.exists(path):
+                # Already stored: refreshing its mtime keeps a concurrent collect_blobs() from deleting it
+                os.utime(path)
+                return name
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if self.file_permissions_mode is not None:
+                os.chmod(tmp_path, self.file_permissions_mode)
+            file_move_safe(tmp_path, path, allow_overwrite=True)    # same content if it was stored concurrently
+            tmp_path = None
+            return name
+        finally:
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except FileNotFoundError:
+                    pass
+
+    # Hashes the content while copying it to a temporary file of the storage (same filesystem: the move is a rename)
+    def _spool(self, content):
+        tmp_dir = self.path(TMP_DIR)
+        os.makedirs(tmp_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    tmp.write(chunk)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return tmp_path, digest.hexdigest()
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_BLOCK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Names stored in the FileFields of all the models, and blob names found in their JSONFields (URLs in payloads)
+def referenced_names():
+    names = set()
+    for model in apps.get_models():
+        for field in model._meta.concrete_fields:
+            if isinstance(field, models.FileField):
+                names.update(
+                    name.lstrip('/') for name in
+                    model._default_manager.exclude(**{field.name: ''}).values_list(field.name, flat=True).distinct()
+                )
+            elif isinstance(field, models.JSONField):
+                for value in model._default_manager.values_list(field.name, flat=True).iterator(chunk_size=2000):
+                    names.update(_blob_name.findall(json.dumps(value)))
+    return names
+
+# Deletes the unreferenced blobs (and leftover temporary files) older than "grace" seconds, returns their names
+def collect_blobs(storage, grace=None, dry_run=False):
+    grace = settings.BLOB_GC_GRACE if grace is None else grace
+    cutoff = time.time() - grace
+    referenced = referenced_names()
+    root = storage.path(BLOB_DIR)
+
+    deleted = []
+    for directory, _, files in os.walk(root):
+        for file in files:
+            path = os.path.join(directory, file)
+            name = os.path.relpath(path, storage.location).replace(os.sep, '/')
+            if name in referenced:
+                continue
+            try:
+                if os.stat(path).st_mtime > cutoff:
+                    continue
+                if not dry_run:
+                    os.unlink(path)
+            except FileNotFoundError:
+                continue
+            deleted.append(name)
+    return deleted
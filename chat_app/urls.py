@@ -10,9 +10,15 @@ urlpatterns = [
 
     path('get-connections/', views.get_connections, name="get_connections"),
     path('get-chats/', views.get_chats, name="get_chats"),
+    path('get-inbox/', views.get_inbox, name="get_inbox"),
     path('create-group/', views.create_group, name="create_group"),
 
+    path('create-upload/', views.create_upload, name="create_upload"),
+    path('upload-chunk/<int:id>/', views.upload_chunk, name="upload_chunk"),
+    path('upload-status/<int:id>/', views.upload_status, name="upload_status"),
+
     path('get-notifications/', views.get_notifications, name="get_notifications"),
+    path('mark-notifications-read/', views.mark_notifications_read, name="mark_notifications_read"),
 
     path('handle-group-request/', views.handle_group_request, name="handle_group_request"),
     
@@ -30,4 +36,6 @@ urlpatterns = [
 
     path('login/', views.login, name="login"),
     path('signup/', views.signup, name="signup"),
+
+    path('metrics/', views.metrics, name="metrics"),
 ]
@@ -1,16 +1,25 @@
 from django.http import JsonResponse
-from django.contrib.auth import authenticate
-from asgiref.sync import sync_to_async
+from chat_app.db import database_sync_to_async
 from django.db.models import Q
+from django.db import transaction, IntegrityError
 
-from chat_app.models import FriendRequest, ChatMsg, Group, GroupRequests, GroupChat
+from chat_app.models import FriendRequest, ChatMsg, Group, GroupRequests, GroupChat, Notification, ConversationSummary, Attachment, conversation_key, avatar_url
 from chat_app.models import CustomUser as User
+from chat_app.pagination import keyset_page, parse_limit, parse_cursor, encode_time_cursor, parse_time_cursor
+from chat_app.auth import generate_jwt_token, verify_jwt_token, get_cached_user
+from chat_app.search import search_user_ids, search_group_ids
+from chat_app.hashing import authenticate_user, hash_password, HashingBusy
+from chat_app.purge import schedule_chat_purge, schedule_group_purge, visible_chat_messages, visible_group_messages
+from chat_app.notifications import PENDING_KINDS, mark_read
+from chat_app.images import make_thumbnail, ImageRejected
+from chat_app.metrics import default_registry
+from chat_app.attachments import MESSAGE_ATTACHMENT_FIELDS, message_attachment, upload_state, create_upload as start_upload, upload_chunk as append_chunk, UploadRejected, OffsetMismatch
 
 from django.middleware.csrf import get_token
+from django.utils.crypto import constant_time_compare
+from django.http import HttpResponse
 
 import json
-import jwt
-import datetime
 from django.conf import settings
 
 
@@ -24,116 +33,117 @@ async def set_csrf_cookie(request):
     return JsonResponse({'set': True})
 
 
-def generate_jwt_token(userid, username):
-    payload = {
-        'user_id': userid,
-        'username': username,
-        'exp': datetime.datetime.now(datetime.UTC) + datetime.timedelta(days=30)
+def search_user(query, user_id, limit, offset):
+    users_list = []
+    groups_list = []
+    user_id = int(user_id)
+
+    # Ranked ids of the matching users and groups (one extra row to know if there is a next page)
+    user_ids = search_user_ids(query or '', limit + 1, offset, exclude_id=user_id)
+    group_ids = search_group_ids(query or '', limit + 1, offset)
+    has_more = len(user_ids) > limit or len(group_ids) > limit
+    user_ids, group_ids = user_ids[:limit], group_ids[:limit]
+
+    users = User.objects.only('id', 'username', 'first_name', 'image', 'thumbnail').in_bulk(user_ids) if user_ids else {}
+    groups = Group.objects.only('id', 'name', 'group_image', 'thumbnail').in_bulk(group_ids) if group_ids else {}
+
+    # Friend requests between the current user and the users of this page only
+    friendships = FriendRequest.objects.filter(
+        Q(user_low__id=user_id, user_high__id__in=user_ids) | Q(user_high__id=user_id, user_low__id__in=user_ids)
+    ).values_list('user_low__id', 'user_high__id', 'from_user__id', 'accepted') if user_ids else []
+    friend_request_map = {
+        (low if high == user_id else high): (from_user_id, accepted) for low, high, from_user_id, accepted in friendships
     }
-    token = jwt.encode(payload, settings.JWT_SECRET_KEY, algorithm='HS256')
-    return token
 
-def verify_jwt_token(token):
-    try:
-        payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=['HS256'])
-        return payload
-    except jwt.ExpiredSignatureError:   # Expired token
-        return None
-    except:     # Invalid token
-        return None
+    # Loop through the users (in rank order) and append details to users_list
+    for id in user_ids:
+        user = users.get(id)
+        if user is None:
+            continue
 
+        user_details = {
+            'id': user.id,
+            'email': user.username,
+            'name': user.first_name,
+            'image': user.avatar_url,
+            'request_send': False,
+            # 'request_received': False,
+            # 'request_accepted': False
+        }
 
-def search_user(query, user_id):
-    if query:
-        users_list = []
-        groups_list = []
+        # Check if there's a friend request between the current user and this search_user
+        friend_request_status = friend_request_map.get(user.id)
+        if friend_request_status:
+            from_user_id, accepted = friend_request_status
+            if from_user_id == user_id:
+                user_details['request_send'] = True
+            else:
+                user_details['request_received'] = True
+            user_details['request_accepted'] = accepted
 
-        # Fetch all users that match the query (username or first name)
-        users = User.objects.filter(Q(username__icontains=query) | Q(first_name__icontains=query))
+        users_list.append(user_details)
 
-        # Fetch all groups that match the query (group name)
-        groups = Group.objects.filter(name__icontains=query)
+    # Group requests of the user for the groups of this page only
+    group_requests = GroupRequests.objects.filter(group__id__in=group_ids, requested_user__id=user_id) if group_ids else []
+    group_request_map = {req.group_id: req for req in group_requests}
 
-        # Fetch all friend requests related to the current user
-        friend_requests = FriendRequest.objects.filter(Q(from_user__id=user_id) | Q(to_user__id=user_id)).select_related('from_user', 'to_user')
+    # Loop through the groups (in rank order) and append details to groups_list
+    for id in group_ids:
+        group = groups.get(id)
+        if group is None:
+            continue
 
-        # Create a dictionary with friend_requests objects
-        friend_request_map = {
-            (req.from_user.id, req.to_user.id): req for req in friend_requests
+        group_details = {
+            'id': group.id,
+            'name': group.name,
+            'image': group.avatar_url,
+            'request_send': False,
+            # 'request_accepted': False
         }
 
-        # Loop through the users and append details to users_list
-        for user in users:
-            if user.id == int(user_id):
-                continue  # Skip the current user
-
-            user_details = {
-                'id': user.id,
-                'email': user.username,
-                'name': user.first_name,
-                'image': user.image.url,
-                'request_send': False,
-                # 'request_received': False,
-                # 'request_accepted': False
-            }
+        # Check if there's a group request for this user in the group
+        group_request_status = group_request_map.get(group.id)
+        if group_request_status:
+            group_details['request_send'] = True
+            group_details['request_accepted'] = group_request_status.accepted
 
-            # Check if there's a friend request between the current user and this search_user
-            friend_request_status = friend_request_map.get((user_id, user.id)) or friend_request_map.get((user.id, user_id))
-            if friend_request_status:
-                if friend_request_status.from_user.id == int(user_id):
-                    user_details['request_send'] = True
-                else:
-                    user_details['request_received'] = True
-                user_details['request_accepted'] = friend_request_status.accepted
-
-            users_list.append(user_details)
-
-        # Fetch all group requests related to the user 
-        group_requests = GroupRequests.objects.filter(group__in=groups, requested_user__id=user_id)
-        group_request_map = {req.group.id: req for req in group_requests}
-
-        # Loop through the groups and append details to groups_list
-        for group in groups:
-            group_details = {
-                'id': group.id,
-                'name': group.name,
-                'image': group.group_image.url,
-                'request_send': False,
-                # 'request_accepted': False
-            }
-
-            # Check if there's a group request for this user in the group
-            group_request_status = group_request_map.get(group.id)
-            if group_request_status:
-                group_details['request_send'] = True
-                group_details['request_accepted'] = group_request_status.accepted
-
-            groups_list.append(group_details)
+        groups_list.append(group_details)
 
-        # Return the lists of users and groups
-        return {'users_list': users_list, 'groups_list': groups_list}
+    # Return the lists of users and groups, "next_offset" is the offset of the next page (None on the last page)
+    return {'users_list': users_list, 'groups_list': groups_list, 'next_offset': offset + limit if has_more else None}
 
 # Search function
+# Returns up to "limit" users and groups ranked by relevance, starting at "offset"
 async def search(request):
     if request.method == "POST":
         query = request.POST.get('search')
         tk = request.POST.get('tk')
+        limit = parse_limit(request.POST.get('limit'), settings.SEARCH_PAGE_SIZE, settings.SEARCH_MAX_PAGE_SIZE)
+        offset = parse_cursor(request.POST.get('offset')) or 0
 
-        verify_token = await sync_to_async(verify_jwt_token)(tk)
+        verify_token = verify_jwt_token(tk)
 
         if verify_token:
             user_id = verify_token.get('user_id')
-            search_query = sync_to_async(search_user)
-            data = await search_query(query, user_id)  
+            search_query = database_sync_to_async(search_user)
+            data = await search_query(query, user_id, limit, offset)  
             return JsonResponse(data)
 
 
-# Checking if current user already made a request to another user
+# Checking if current user already made a request to another user (or received one from them)
+# Returns the FriendRequest object between the two users, or None
 def is_requested_user(from_user_id, to_user_id):
-    user_requested = FriendRequest.objects.select_related('from_user', 'to_user').filter( (Q(from_user__id=from_user_id) & Q(to_user__id=to_user_id)) | (Q(from_user__id=to_user_id) & Q(to_user__id=from_user_id)) )
-    if user_requested:
-        return user_requested
-    return None
+    return FriendRequest.between(from_user_id, to_user_id).first()
+
+# Creates the friend request unless there already is a request/friendship between the two users.
+# The unique FriendRequest pair makes this a single INSERT that is safe against concurrent requests.
+def create_friend_request(from_user_id, to_user_id):
+    try:
+        with transaction.atomic():
+            FriendRequest.objects.create(from_user_id=from_user_id, to_user_id=to_user_id)
+    except IntegrityError:
+        return False
+    return True
 
 # Checking if the current user already made a request to the group
 def is_requested_group(from_user_id, group_id):
@@ -150,28 +160,23 @@ async def friend_request(request):
         id = request.POST.get('id')
         tk = request.POST.get('tk')
 
-        verify_token = await sync_to_async(verify_jwt_token)(tk)
+        verify_token = verify_jwt_token(tk)
         if verify_token:
             user_id = verify_token.get('user_id')
-            from_user = await sync_to_async(User.objects.get)(id=user_id)
 
             # For friend request
             if request_type == 'user':
-                request_to_user = await sync_to_async(User.objects.get)(id=id)
-
-                # Checking if current user already made a request to the user
-                user_request_exists = await sync_to_async(is_requested_user)(from_user.id, request_to_user.id)
-
-                if not user_request_exists:
-                    make_user_request = await FriendRequest.objects.acreate(from_user=from_user, to_user=request_to_user)
+                # Creating the request only if the users don't already have a request/friendship between them
+                await database_sync_to_async(create_friend_request)(user_id, id)
                 return JsonResponse({'send': True})
                 
             # For group joining request
             else:
-                request_to_group = await sync_to_async(Group.objects.select_related('admin').get)(id=id)
+                from_user = await get_cached_user(user_id)
+                request_to_group = await database_sync_to_async(Group.objects.select_related('admin').get)(id=id)
 
                 # Checking if user already made a request to the group
-                user_request_exist = await sync_to_async(is_requested_group)(from_user.id, request_to_group.id)
+                user_request_exist = await database_sync_to_async(is_requested_group)(from_user.id, request_to_group.id)
 
                 if not user_request_exist:
                     make_group_request = await GroupRequests.objects.acreate(group=request_to_group, requested_user=from_user)
@@ -185,49 +190,56 @@ async def handle_request(request):
         tk = request.POST.get('tk')
         id = request.POST.get('id')
 
-        verify_token = await sync_to_async(verify_jwt_token)(tk)
+        verify_token = verify_jwt_token(tk)
 
         if verify_token:
             user_id = verify_token.get('user_id')
 
-            friend_req = await sync_to_async(FriendRequest.objects.select_related('from_user', 'to_user').get)( Q(from_user__id=user_id, to_user__id=id) | Q(from_user__id=id, to_user__id=user_id))
+            friend_req = await database_sync_to_async(FriendRequest.between(user_id, id).select_related('from_user', 'to_user').get)()
 
             # Accepting friend request
             if req_type == 'accept':
                 friend_req.accepted = True
-                await sync_to_async(friend_req.save)()
+                await database_sync_to_async(friend_req.save)()
 
             # Rejecting request or Deleting friend
             else:
-                await sync_to_async(friend_req.delete)()
-                # if unfriend the user, deleting all the previous chat's
+                await database_sync_to_async(friend_req.delete)()
+                # if unfriend the user, deleting all the previous chat's (hidden at once, deleted by the purge_history worker)
                 if req_type == 'unfriend':
-                    await sync_to_async(ChatMsg.objects.filter( Q(sender__id=user_id, receiver__id=id) | Q(sender__id=id, receiver__id=user_id)).delete)()
+                    await database_sync_to_async(schedule_chat_purge)(conversation_key(user_id, id))
 
             return JsonResponse({'status': True})
         
 
 
 def get_user_connections(user_id):
+    user_id = int(user_id)
     friends_list = []
     groups_list = []
-    for req in FriendRequest.objects.select_related('from_user', 'to_user').filter(Q(from_user__id=user_id) | Q(to_user__id=user_id), accepted=True):
 
-        friend = req.to_user if req.from_user.id == user_id else req.from_user
+    friendships = FriendRequest.objects.filter(Q(user_low__id=user_id) | Q(user_high__id=user_id), accepted=True).values(
+        'user_low_id', 'user_low__first_name', 'user_low__username', 'user_low__image', 'user_low__thumbnail',
+        'user_high_id', 'user_high__first_name', 'user_high__username', 'user_high__image', 'user_high__thumbnail',
+    )
+    for friendship in friendships.iterator():
+
+        # The friend is the other side of the friendship
+        side = 'user_high' if friendship['user_low_id'] == user_id else 'user_low'
         user_details = {
-            'id': friend.id,
-            'name': friend.first_name,
-            'email': friend.username,
-            'image': friend.image.url,
+            'id': friendship[f'{side}_id'],
+            'name': friendship[f'{side}__first_name'],
+            'email': friendship[f'{side}__username'],
+            'image': avatar_url(friendship[f'{side}__thumbnail'], friendship[f'{side}__image']),
         }
 
         friends_list.append(user_details)
 
-    for group in Group.objects.filter(members__id=user_id):
+    for group in Group.objects.filter(members__id=user_id).values('id', 'name', 'group_image', 'thumbnail').iterator():
         group_details = {
-            'id': group.id,
-            'name': group.name,
-            'image': group.group_image.url
+            'id': group['id'],
+            'name': group['name'],
+            'image': avatar_url(group['thumbnail'], group['group_image'])
         }
         groups_list.append(group_details)
 
@@ -237,34 +249,100 @@ def get_user_connections(user_id):
 async def get_connections(request):
     if request.method == "POST":
         tk = request.POST.get('tk')
-        verify_token = await sync_to_async(verify_jwt_token)(tk)
+        verify_token = verify_jwt_token(tk)
         
         if verify_token:
             user_id = verify_token.get('user_id')
-            data = await sync_to_async(get_user_connections)(user_id)
+            data = await database_sync_to_async(get_user_connections)(user_id)
 
             return JsonResponse(data)
 
 
 
-def get_all_chats(request_type, user_id, id):    # id = friend id (or) group id
+# Conversation list of the user, most recent first, read from the summaries kept by the consumers (see chat_app/conversations.py)
+# "before" is the (last_activity, id) of the last conversation of the previous page (parse_time_cursor())
+def get_user_inbox(user_id, limit, before=None):
+    conversations = []
+
+    summaries = ConversationSummary.objects.filter(user_id=user_id).values(
+        'id', 'friend_id', 'friend__first_name', 'friend__username', 'friend__image', 'friend__thumbnail',
+        'group_id', 'group__name', 'group__group_image', 'group__thumbnail',
+        'last_message', 'last_message_id', 'last_sender_id', 'last_activity', 'unread_count',
+    )
+    before_value, before_id = before or (None, None)
+    page, next_id = keyset_page(summaries, limit, before_id, order_field='last_activity', cursor_value=before_value)
+    next_cursor = encode_time_cursor(page[0]['last_activity'], next_id) if next_id else None
+
+    for summary in reversed(page):    # newest first
+        if summary['friend_id']:
+            conversation = {
+                'type': 'user',
+                'id': summary['friend_id'],
+                'name': summary['friend__first_name'],
+                'email': summary['friend__username'],
+                'image': avatar_url(summary['friend__thumbnail'], summary['friend__image']),
+            }
+        else:
+            conversation = {
+                'type': 'group',
+                'id': summary['group_id'],
+                'name': summary['group__name'],
+                'image': avatar_url(summary['group__thumbnail'], summary['group__group_image']),
+            }
+        conversation.update({
+            'last_message': summary['last_message'],
+            'last_message_id': summary['last_message_id'],
+            'last_sender_id': summary['last_sender_id'],
+            'time_stamp': summary['last_activity'],
+            'unread_count': summary['unread_count'],
+        })
+        conversations.append(conversation)
+
+    return conversations, next_cursor
+
+# Friends and groups of the current user with their last message and unread count.
+# "next_cursor" is passed back as "before_id" to load the next (less recent) page. It's an opaque string holding the
+# position of the page's last conversation, which new messages don't move.
+async def get_inbox(request):
+    if request.method == "POST":
+        tk = request.POST.get('tk')
+        verify_token = verify_jwt_token(tk)
+
+        if verify_token:
+            user_id = verify_token.get('user_id')
+            limit = parse_limit(request.POST.get('limit'), settings.INBOX_PAGE_SIZE, settings.INBOX_MAX_PAGE_SIZE)
+            before = parse_time_cursor(request.POST.get('before_id'))
+
+            conversations, next_cursor = await database_sync_to_async(get_user_inbox)(user_id, limit, before)
+            return JsonResponse({'conversations': conversations, 'next_cursor': next_cursor})
+
+
+
+def get_all_chats(request_type, user_id, id, limit, before_id=None, after_id=None):    # id = friend id (or) group id
+    user_id = int(user_id)
     messages = []
+    next_cursor = None
     
     # Getting the chats between current user and selected user(friend)
     if request_type == "user":
 
         # Checking if the current user and selected user are actually friends
-        user_connection_status = FriendRequest.objects.filter( (Q(from_user__id=user_id) & Q(to_user__id=id)) | (Q(from_user__id=id) & Q(to_user__id=user_id)), accepted=True)
+        user_connection_status = FriendRequest.between(user_id, id).filter(accepted=True).exists()
 
         if user_connection_status:
-            user_messages = ChatMsg.objects.select_related('sender', 'receiver').filter( (Q(sender__id=user_id) & Q(receiver__id=id)) | (Q(sender__id=id) & Q(receiver__id=user_id)) ).order_by('time_stamp')
-            for message in user_messages:
+            conversation = conversation_key(user_id, id)
+            user_messages = ChatMsg.objects.filter(conversation=conversation).values('id', 'message', 'time_stamp', 'sender_id', *MESSAGE_ATTACHMENT_FIELDS)
+            user_messages = visible_chat_messages(user_messages, conversation)
+            page, next_cursor = keyset_page(user_messages, limit, before_id, after_id)
+            for message in page:
                 msg = {
-                    'id': message.id,
-                    'message': message.message,
-                    'time_stamp': message.time_stamp,
+                    'id': message['id'],
+                    'message': message['message'],
+                    'time_stamp': message['time_stamp'],
                 }
-                if message.sender.id == int(user_id):
+                if message['attachment__id'] is not None:
+                    msg['attachment'] = message_attachment(message)
+                if message['sender_id'] == user_id:
                     msg['type'] = 'send-msg'
                 else:
                     msg['type'] = 'received-msg'
@@ -273,39 +351,103 @@ def get_all_chats(request_type, user_id, id):    # id = friend id (or) group id
     # If user selected group getting that group chats
     else:
         # Getting the selected group chats where the current user is a member 
-        group_messages = GroupChat.objects.filter(group__id=id, group__members__id=user_id).select_related('sender').order_by('time_stamp')
-        for message in group_messages:
+        group_messages = GroupChat.objects.filter(group__id=id, group__members__id=user_id).values(
+            'id', 'message', 'time_stamp', 'sender_id', 'sender__first_name', 'sender__last_name', 'sender__image', 'sender__thumbnail',
+            *MESSAGE_ATTACHMENT_FIELDS,
+        )
+        group_messages = visible_group_messages(group_messages, id)
+        page, next_cursor = keyset_page(group_messages, limit, before_id, after_id)
+        for message in page:
 
             msg = {
-                'id': message.id,
-                'message': message.message,
-                'time_stamp': message.time_stamp,
-                'user_id': message.sender.id,
-                'name': message.sender.first_name + f' {message.sender.last_name}' 
+                'id': message['id'],
+                'message': message['message'],
+                'time_stamp': message['time_stamp'],
+                'user_id': message['sender_id'],
+                'name': message['sender__first_name'] + f" {message['sender__last_name']}" 
             }
-            if message.sender.id == int(user_id):
+            if message['attachment__id'] is not None:
+                msg['attachment'] = message_attachment(message)
+            if message['sender_id'] == user_id:
                 msg['type'] = 'send-msg'
             else:
-                msg['user_img'] = message.sender.image.url     # user image url
+                msg['user_img'] = avatar_url(message['sender__thumbnail'], message['sender__image'])     # user image url
                 msg['type'] = 'received-msg'
             messages.append(msg)
         
-    return messages
+    return messages, next_cursor
 
 # For getting previous chat's with a friend/group 
+# Returns one page of messages (oldest first), the newest page when no cursor is given.
+# "before_id" loads older messages, "after_id" loads newer ones, and "next_cursor" continues in the same direction.
 async def get_chats(request):
     if request.method == "POST":
         request_type = request.POST.get('type')     # will be user/group
         id = request.POST.get('id')
         tk = request.POST.get('tk')
+        limit = parse_limit(request.POST.get('limit'))
+        before_id = parse_cursor(request.POST.get('before_id'))
+        after_id = parse_cursor(request.POST.get('after_id'))
 
-        verify_token = await sync_to_async(verify_jwt_token)(tk)
+        verify_token = verify_jwt_token(tk)
         if verify_token:
+            if before_id and after_id:
+                return JsonResponse({'error': 'Send either before_id or after_id'}, status=400)
             user_id = verify_token.get('user_id')
             username = verify_token.get('username')
-            chat_func = sync_to_async(get_all_chats)
-            chats = await chat_func(request_type, user_id, id)
-            return JsonResponse({'username': username, 'chats': chats})
+            chats, next_cursor = await database_sync_to_async(get_all_chats)(request_type, user_id, id, limit, before_id, after_id)
+            return JsonResponse({'username': username, 'chats': chats, 'next_cursor': next_cursor})
+
+
+# Attachment uploads (see chat_app/attachments.py): create-upload, then the file in chunks with upload-chunk.
+# upload-status tells where to resume an interrupted upload. Every response is the upload_state().
+async def create_upload(request):
+    if request.method == "POST":
+        tk = request.POST.get('tk')
+        verify_token = verify_jwt_token(tk)
+
+        if verify_token:
+            try:
+                attachment = await start_upload(
+                    verify_token.get('user_id'), request.POST.get('name'), request.POST.get('size'), request.POST.get('content_type'),
+                )
+            except UploadRejected as error:
+                return JsonResponse({'error': str(error)}, status=400)
+            return JsonResponse({**upload_state(attachment), 'chunk_size': settings.ATTACHMENT_CHUNK_SIZE})
+
+# The request body is the chunk (raw bytes), "tk" and "offset" (bytes already sent) are in the query string.
+# A wrong offset gets a 409 with the offset to resume from.
+async def upload_chunk(request, id):
+    if request.method == "POST":
+        verify_token = verify_jwt_token(request.GET.get('tk'))
+
+        if verify_token:
+            attachment = await Attachment.objects.filter(id=id, uploader_id=verify_token.get('user_id')).afirst()
+            if attachment is None:
+                return JsonResponse({'error': 'Unknown upload'}, status=404)
+            try:
+                offset = int(request.GET.get('offset'))
+            except (TypeError, ValueError):
+                return JsonResponse({'error': 'Invalid offset'}, status=400)
+
+            try:
+                await append_chunk(attachment, offset, request)
+            except OffsetMismatch as error:
+                return JsonResponse({**upload_state(attachment), 'offset': error.offset}, status=409)
+            except UploadRejected as error:
+                return JsonResponse({'error': str(error)}, status=400)
+            return JsonResponse(upload_state(attachment))
+
+async def upload_status(request, id):
+    if request.method == "POST":
+        tk = request.POST.get('tk')
+        verify_token = verify_jwt_token(tk)
+
+        if verify_token:
+            attachment = await Attachment.objects.filter(id=id, uploader_id=verify_token.get('user_id')).afirst()
+            if attachment is None:
+                return JsonResponse({'error': 'Unknown upload'}, status=404)
+            return JsonResponse(upload_state(attachment))
 
 
 # Handle's group creation
@@ -314,63 +456,89 @@ async def create_group(request):
         group_name = request.POST.get('group_name')
         img = request.FILES.get('image')
         tk = request.POST.get('tk')
-        verify_token = await sync_to_async(verify_jwt_token)(tk)
+        verify_token = verify_jwt_token(tk)
 
         if verify_token:
             user_id = verify_token.get('user_id')
-            user = await sync_to_async(User.objects.get)(id=user_id)
+            user = await get_cached_user(user_id)
             
             if img:
-                group = await Group.objects.acreate(name=group_name, group_image=img, admin=user)
+                try:
+                    thumbnail = await make_thumbnail(img)
+                except ImageRejected as error:
+                    return JsonResponse({'created': False, 'error': str(error)}, status=400)
+                group = await Group.objects.acreate(name=group_name, group_image=img, thumbnail=thumbnail, admin=user)
             else: 
                 group = await Group.objects.acreate(name=group_name, admin=user)
                 
-            await sync_to_async(group.members.add)(user)    # add admin(current user) to members field of the newly created group
+            await database_sync_to_async(group.members.add)(user)    # add admin(current user) to members field of the newly created group
 
             # Creating GroupRequest object and passing admin as requested user with accepted field to True, as the "search" function results are based on "GroupRequests"
             await GroupRequests.objects.acreate(group=group, requested_user=user, accepted=True)  
 
-            return JsonResponse({'created': True, 'id': group.id, 'name': group.name, 'image': group.group_image.url})
+            return JsonResponse({'created': True, 'id': group.id, 'name': group.name, 'image': group.avatar_url})
 
 
+# Pending friend/group requests of the user, read from the notification inbox (see chat_app/notifications.py)
 def get_notify(user_id):
     friend_requests = []
     group_requests = []
 
-    for req in FriendRequest.objects.select_related('from_user', 'to_user').filter(to_user__id=user_id, accepted=False):
-        friend = req.from_user
-        user_details = {
-            'id': friend.id,
-            'name': friend.first_name,
-            'email': friend.username,
-            'image': friend.image.url,
-        }
-        friend_requests.append(user_details)
-
-    for req in  GroupRequests.objects.filter(group__admin__id=user_id, accepted=False).select_related('requested_user', 'group').order_by('group__id'):
-        group_request = {
-            'group_id': req.group.id,
-            'group_name': req.group.name,
-            'group_image': req.group.group_image.url,
-            'group_req_id': req.id,
-            'username': req.requested_user.username,
-            'user_id': req.requested_user.id,
-        }
-        group_requests.append(group_request)
+    pending = Notification.objects.filter(user_id=user_id, kind__in=PENDING_KINDS).order_by('id').values('kind', 'payload')
+    for notification in pending.iterator():
+        payload = notification['payload']
+        if notification['kind'] == 'received_friend_request':
+            friend_requests.append({key: payload[key] for key in ('id', 'name', 'email', 'image')})
+        else:
+            group_requests.append({key: payload[key] for key in ('group_id', 'group_name', 'group_image', 'group_req_id', 'username', 'user_id')})
 
+    group_requests.sort(key=lambda group_request: group_request['group_id'])
     return {'friend_requests': friend_requests, 'group_requests': group_requests}
 
-# To send all notifications of the current user when page loads
+# The pending requests, a page of the notification inbox and the unread count, read in one DB executor call
+def get_user_notifications(user_id, limit, before_id=None):
+    data = get_notify(user_id)
+    inbox = Notification.objects.filter(user_id=user_id).values('id', 'kind', 'payload', 'is_read', 'created_at')
+    data['notifications'], data['next_cursor'] = keyset_page(inbox, limit, before_id, order_field='id')
+    data['unread_count'] = Notification.objects.filter(user_id=user_id, is_read=False).count()
+    return data
+
+# To send all notifications of the current user when page loads.
+# "notifications" is a page of the inbox (newest last), "before_id" with "next_cursor" loads older notifications.
 async def get_notifications(request):
     if request.method == "POST":
         tk = request.POST.get('tk')
-        verify_token = await sync_to_async(verify_jwt_token)(tk)
+        verify_token = verify_jwt_token(tk)
 
         if verify_token:
             user_id = verify_token.get('user_id')
-            # friend_requests, group_requests
-            data = await sync_to_async(get_notify)(user_id)
+            limit = parse_limit(request.POST.get('limit'), settings.NOTIFICATION_PAGE_SIZE, settings.NOTIFICATION_MAX_PAGE_SIZE)
+            before_id = parse_cursor(request.POST.get('before_id'))
+
+            data = await database_sync_to_async(get_user_notifications)(user_id, limit, before_id)
             return JsonResponse(data)
+
+
+# Marks notifications as read: "ids" (JSON list) or everything up to "up_to_id"
+async def mark_notifications_read(request):
+    if request.method == "POST":
+        tk = request.POST.get('tk')
+        verify_token = verify_jwt_token(tk)
+
+        if verify_token:
+            user_id = verify_token.get('user_id')
+            ids = request.POST.get('ids')
+            try:
+                ids = list(map(int, json.loads(ids))) if ids else None
+            except (TypeError, ValueError):
+                return JsonResponse({'updated': 0, 'error': 'ids must be a JSON list of notification ids'}, status=400)
+            up_to_id = parse_cursor(request.POST.get('up_to_id'))
+
+            if ids is None and up_to_id is None:
+                return JsonResponse({'updated': 0})
+
+            updated = await database_sync_to_async(mark_read)(user_id, ids, up_to_id)
+            return JsonResponse({'updated': updated})
             
 
 
@@ -381,11 +549,11 @@ async def handle_group_request(request):
         req_id = request.POST.get('id')
         tk = request.POST.get('tk')
 
-        verify_token = await sync_to_async(verify_jwt_token)(tk)
+        verify_token = verify_jwt_token(tk)
         if verify_token:
             user_id = verify_token.get('user_id')
 
-            group_request = await sync_to_async(GroupRequests.objects.select_related('group__admin', 'requested_user').get)(id=req_id)
+            group_request = await database_sync_to_async(GroupRequests.objects.select_related('group__admin', 'requested_user').get)(id=req_id)
 
             group = group_request.group
 
@@ -398,7 +566,7 @@ async def handle_group_request(request):
                     await group_request.asave()    # saving the group request object
 
                     # Adding the user to members field of the group
-                    await sync_to_async(group.members.add)(requested_user)
+                    await database_sync_to_async(group.members.add)(requested_user)
 
                 # for rejecting request
                 else:
@@ -410,17 +578,17 @@ async def handle_group_request(request):
 # Get group members, only if request made by group admin
 async def get_members(request, group_id):
     tk = request.COOKIES.get('tk')
-    verify_token = await sync_to_async(verify_jwt_token)(tk)
+    verify_token = verify_jwt_token(tk)
 
     if verify_token:
         user_id = verify_token.get('user_id')
 
-        group = await sync_to_async(Group.objects.select_related('admin').prefetch_related('members').get)(id=group_id)
+        group = await database_sync_to_async(Group.objects.select_related('admin').prefetch_related('members').get)(id=group_id)
 
         if int(group.admin.id) == int(user_id):  # verify the request made by group admin
             members = group.members.all()
             members_data = [
-                {'id': i.id, 'name': i.first_name, 'email': i.username, 'image': i.image.url} 
+                {'id': i.id, 'name': i.first_name, 'email': i.username, 'image': i.avatar_url} 
                 for i in members if i.id != int(user_id)     # not including admin as member
                 ]  
             
@@ -435,12 +603,12 @@ async def remove_members(request, group_id):
         members = json.loads(request.POST.get('members'))   # will be ["1", "2", "3"]
         members_id = set(map(int, members))       # converting id's to integers
         tk = request.POST.get('tk')
-        verify_token = await sync_to_async(verify_jwt_token)(tk)
+        verify_token = verify_jwt_token(tk)
 
         if verify_token:
             user_id = verify_token.get('user_id')   # admin id
 
-            group = await sync_to_async(Group.objects.select_related('admin').get)(id=group_id, admin__id=user_id)
+            group = await database_sync_to_async(Group.objects.select_related('admin').get)(id=group_id, admin__id=user_id)
 
             if int(group.admin.id) == int(user_id):     # Check if request is made by admin
 
@@ -448,23 +616,23 @@ async def remove_members(request, group_id):
 
                 await group.members.aremove(*members_id)  # Remove members from the group
                 
-                group_requests = await sync_to_async(GroupRequests.objects.filter)(requested_user__id__in=members_id, accepted=True)
+                group_requests = GroupRequests.objects.filter(requested_user__id__in=members_id, accepted=True)
                 await group_requests.adelete()    # Removing Group requests as well
 
-                chat = await sync_to_async(GroupChat.objects.filter)(group__id=group_id, sender__id__in=members_id)
-                await chat.adelete()    # Removing all the chat messages send by the removed members from the group
+                # Removing all the chat messages send by the removed members from the group (hidden at once, deleted by the purge_history worker)
+                await database_sync_to_async(schedule_group_purge)(group_id, members_id)
 
                 return JsonResponse({'status': True})
 
 
 
 def get_friends_object(user_id, members_id):
-    # Returns the FriendRequest objects where admin(user_id) and user's(members_id) are already have friend connection
-    friend_req = FriendRequest.objects.select_related('from_user', 'to_user').filter( 
-        Q(from_user__id__in=members_id, to_user__id=user_id) | Q(from_user__id=user_id, to_user__id__in=members_id), accepted=True
+    # Returns the accepted FriendRequest objects where admin(user_id) and user's(members_id) are already have friend connection
+    friendships = FriendRequest.objects.select_related('user_low', 'user_high').filter( 
+        Q(user_low__id__in=members_id, user_high__id=user_id) | Q(user_low__id=user_id, user_high__id__in=members_id), accepted=True
         )
     # Return user objects
-    friends = [i.from_user if i.from_user.id != int(user_id) else i.to_user for i in friend_req]    
+    friends = [i.user_low if i.user_low_id != int(user_id) else i.user_high for i in friendships]    
     return friends
 
 # For adding members to group, request should made by admin
@@ -475,19 +643,19 @@ async def add_members(request, group_id):
         members_id = set(map(int, members))
 
         tk = request.POST.get('tk')
-        verify_token = await sync_to_async(verify_jwt_token)(tk)
+        verify_token = verify_jwt_token(tk)
 
         if verify_token:
             user_id = verify_token.get('user_id')
 
-            group = await sync_to_async(Group.objects.select_related('admin').get)(id=group_id, admin__id=user_id)
+            group = await database_sync_to_async(Group.objects.select_related('admin').get)(id=group_id, admin__id=user_id)
 
             if int(group.admin.id) == int(user_id):
 
-                friends = await sync_to_async(get_friends_object)(user_id, members_id)    # Calls "get_friends_object" function
+                friends = await database_sync_to_async(get_friends_object)(user_id, members_id)    # Calls "get_friends_object" function
 
                 # Deleting the old request's made by friends to join the group as the admin adding those friends to the group directly
-                prev_group_requests = await sync_to_async(GroupRequests.objects.filter)(group__id=group_id, requested_user__in=friends)
+                prev_group_requests = GroupRequests.objects.filter(group__id=group_id, requested_user__in=friends)
                 await prev_group_requests.adelete()
 
                 # Creating "GroupRequests" object's for all the users that are going to be added to the group 
@@ -495,7 +663,7 @@ async def add_members(request, group_id):
                 await GroupRequests.objects.abulk_create(group_req)
 
                 # Adding user's to members field of the Group
-                await sync_to_async(group.members.add)(*friends)
+                await database_sync_to_async(group.members.add)(*friends)
 
                 return JsonResponse({'status': True})
 
@@ -504,21 +672,22 @@ async def add_members(request, group_id):
 # Returns the details of a specific user
 async def get_user_details(request, id):
     tk = request.COOKIES.get('tk')
-    verify_token = await sync_to_async(verify_jwt_token)(tk)
+    verify_token = verify_jwt_token(tk)
 
     if verify_token:
         user_id = verify_token.get('user_id')
-        searched_user = await sync_to_async(User.objects.get)(id=id)
-        friend_request = await sync_to_async(is_requested_user)(user_id, id)
+        searched_user = await database_sync_to_async(User.objects.get)(id=id)
+        friend_request = await database_sync_to_async(is_requested_user)(user_id, id)
         data = {
             'first_name': searched_user.first_name,
             'last_name': searched_user.last_name,
             'email': searched_user.username,
-            'image': searched_user.image.url,
+            'image': searched_user.avatar_url,
+            'image_original': searched_user.image.url,
         }
         if friend_request:
-            data['is_friend'] = friend_request[0].accepted
-            if int(friend_request[0].from_user.id) == int(user_id):
+            data['is_friend'] = friend_request.accepted
+            if int(friend_request.from_user_id) == int(user_id):
                 data['request_sent'] = True
             else:
                 data['received_request'] = True
@@ -530,21 +699,22 @@ async def get_user_details(request, id):
 # Returns the details of a specific group
 async def get_group_details(request, id):
     tk = request.COOKIES.get('tk')
-    verify_token = await sync_to_async(verify_jwt_token)(tk)
+    verify_token = verify_jwt_token(tk)
 
     if verify_token:
         user_id = verify_token.get('user_id')
-        group = await sync_to_async(Group.objects.select_related('admin').get)(id=id)
+        group = await database_sync_to_async(Group.objects.select_related('admin').get)(id=id)
         data = {
             'name': group.name,
             'group_admin': group.admin.username,
-            'image': group.group_image.url,
+            'image': group.avatar_url,
+            'image_original': group.group_image.url,
             'request_sent': False
         }
         if group.admin.id == user_id:
             data['is_admin'] = True
         else:
-            group_request = await sync_to_async(GroupRequests.objects.filter(requested_user__id=user_id, group__id=id).first)()
+            group_request = await database_sync_to_async(GroupRequests.objects.filter(requested_user__id=user_id, group__id=id).first)()
             if group_request:
                 data['is_member'] = group_request.accepted
                 data['request_sent'] = True
@@ -564,9 +734,8 @@ def rm_connection(id, user_id):
         group_request.delete()      # Delete group request of the member
         group[0].members.remove(user_id)    # Removes user from members
 
-        # Delete the chat messages made by the user from group
-        chat = GroupChat.objects.filter(group__id=id, sender__id=user_id)    
-        chat.delete()
+        # Delete the chat messages made by the user from group (hidden at once, deleted by the purge_history worker)
+        schedule_group_purge(id, [user_id])
 
     return True
 
@@ -577,10 +746,10 @@ async def remove_connection(request):
         id = request.POST.get('id')    # will be group ID
         tk = request.POST.get('tk')
 
-        verify_token = await sync_to_async(verify_jwt_token)(tk)
+        verify_token = verify_jwt_token(tk)
         if verify_token:
             user_id = verify_token.get('user_id')
-            rm_conn = await sync_to_async(rm_connection)(id, user_id)
+            rm_conn = await database_sync_to_async(rm_connection)(id, user_id)
             if rm_conn:
                 return JsonResponse({'status': True}) 
 
@@ -590,13 +759,13 @@ async def remove_connection(request):
 async def get_account_details(request):
     if request.method == "POST":
         tk = request.POST.get('tk')
-        verify_token = await sync_to_async(verify_jwt_token)(tk)
+        verify_token = verify_jwt_token(tk)
         
         if verify_token:
             user_id = verify_token.get('user_id')
-            user = await sync_to_async(User.objects.get)(id=user_id)
+            user = await get_cached_user(user_id)
 
-            return JsonResponse({'first_name': user.first_name, 'last_name': user.last_name, 'email': user.username, 'image': user.image.url})
+            return JsonResponse({'first_name': user.first_name, 'last_name': user.last_name, 'email': user.username, 'image': user.avatar_url, 'image_original': user.image.url})
 
 
 
@@ -607,16 +776,20 @@ async def update_account_details(request):
         first_name = request.POST.get('first_name')
         last_name = request.POST.get('last_name')
         tk = request.POST.get('tk')
-        verify_token = await sync_to_async(verify_jwt_token)(tk)
+        verify_token = verify_jwt_token(tk)
 
         if verify_token:
             user_id = verify_token.get('user_id')
-            user = await sync_to_async(User.objects.get)(id=user_id)
+            user = await database_sync_to_async(User.objects.get)(id=user_id)
 
             user.first_name = first_name
             user.last_name = last_name
             
             if img:
+                try:
+                    user.thumbnail = await make_thumbnail(img)
+                except ImageRejected as error:
+                    return JsonResponse({'updated': False, 'error': str(error)}, status=400)
                 user.image = img 
 
             await user.asave()
@@ -632,12 +805,14 @@ async def login(request):
         username = request.POST.get('email').lower()
         password = request.POST.get('password')
 
-        user = await sync_to_async(authenticate)(username=username, password=password)
+        try:
+            user = await authenticate_user(username, password)
+        except HashingBusy:
+            return JsonResponse({'authenticated': False, 'error': 'Too many login attempts, please try again.'}, status=503)
 
         if user is not None:
             # Generating token
-            generate_token = sync_to_async(generate_jwt_token)
-            token = await generate_token(user.id, user.username)
+            token = generate_jwt_token(user.id, user.username)
 
             return JsonResponse({'token': token, 'authenticated': True})
 
@@ -651,8 +826,10 @@ def get_user(username):
         return user_exist
     return None
 
+# "password" is already hashed (see chat_app/hashing.py)
 def create_user(first_name, username, password):
-    user = User.objects.create_user(username=username, first_name=first_name, password=password)
+    user = User(username=User.normalize_username(username), first_name=first_name, password=password)
+    user.save()
     return user
 
 # Signup User
@@ -669,20 +846,33 @@ async def signup(request):
         if len(password1) < 8:
             return JsonResponse({'authenticated': False, 'error': 'Password must be at least 8 characters long.'})
         
-        getuser = sync_to_async(get_user)
+        getuser = database_sync_to_async(get_user)
         user_exist = await getuser(email)
 
         if user_exist:
             return JsonResponse({'authenticated': False, 'error': 'The email already exists. Please try to log in.'})
 
+        try:
+            password = await hash_password(password1)
+        except HashingBusy:
+            return JsonResponse({'authenticated': False, 'error': 'Too many signups, please try again.'}, status=503)
+
         # Creating user
-        user_create = sync_to_async(create_user)
-        user = await user_create(first_name=first_name, username=email, password=password1)
+        user_create = database_sync_to_async(create_user)
+        user = await user_create(first_name=first_name, username=email, password=password)
 
         # Generates token
-        generate_token = sync_to_async(generate_jwt_token)
-        token = await generate_token(user.id, user.username)
+        token = generate_jwt_token(user.id, user.username)
         return JsonResponse({'authenticated': True, 'token': token})
         
 
 
+# Prometheus scrape endpoint (chat_app/metrics.py), "Authorization: Bearer <METRICS_TOKEN>" unless DEBUG is on.
+# Rendered on an ORM thread: the collectors read the outbox size from the database.
+async def metrics(request):
+    if not settings.DEBUG:
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        if not settings.METRICS_TOKEN or scheme.lower() != 'bearer' or not constant_time_compare(token.strip(), settings.METRICS_TOKEN):
+            return HttpResponse(status=403)
+    body = await database_sync_to_async(default_registry.exposition)()
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -14,10 +14,14 @@ from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 import chat_app.routing
 from chat_app.middleware import JWTAuthMiddleware
+from chat_app.outbox import OutboxPublisherMiddleware
+from chat_app.invalidation import CacheInvalidationMiddleware
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_proj.settings')
 
-application = ProtocolTypeRouter({
+# OutboxPublisherMiddleware starts the process's notification publisher (see chat_app/outbox.py),
+# CacheInvalidationMiddleware its listener of the other processes' cache invalidations (see chat_app/invalidation.py)
+application = OutboxPublisherMiddleware(CacheInvalidationMiddleware(ProtocolTypeRouter({
     'http': get_asgi_application(),
 
     'websocket': JWTAuthMiddleware(
@@ -25,5 +29,5 @@ application = ProtocolTypeRouter({
             chat_app.routing.websocket_urlpatterns
         )
     ), 
-}) 
+})))
 
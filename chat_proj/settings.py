@@ -49,6 +49,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'chat_app.middleware.QueryCountMiddleware',    # query counts per view (chat_app/instrumentation.py)
     'django.contrib.sessions.middleware.SessionMiddleware',
     
     "corsheaders.middleware.CorsMiddleware",    # cors middleware
@@ -86,9 +87,36 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Connections are kept by the DB executor threads (chat_app/db.py) instead of being opened for every query
+        'CONN_MAX_AGE': 600,
+        'OPTIONS': {
+            # WAL lets the executor threads read while another thread writes, writers wait for the lock up to "timeout"
+            # seconds, and IMMEDIATE transactions take the write lock upfront (no deadlocked lock upgrades)
+            'timeout': 20,
+            'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;',
+            'transaction_mode': 'IMMEDIATE',
+        },
     }
 }
 
+# Threads running the ORM calls of the async views and consumers (chat_app/db.py)
+DB_EXECUTOR_THREADS = config('DB_EXECUTOR_THREADS', default=8, cast=int)
+
+# Password hashing for login/signup runs in worker processes (chat_app/hashing.py)
+PASSWORD_HASHING_PROCESSES = config('PASSWORD_HASHING_PROCESSES', default=2, cast=int)
+PASSWORD_HASHING_CONCURRENCY = 4     # hashes submitted to the pool at a time, the other requests wait for a slot
+PASSWORD_HASHING_TIMEOUT = 5         # seconds a request waits for a slot before getting a 503
+
+# Background deletion of chat history (chat_app/purge.py, "manage.py purge_history")
+PURGE_CHUNK_SIZE = 500       # messages deleted per transaction
+PURGE_CHUNK_DELAY = 0.05     # seconds between two chunks
+PURGE_MAX_ATTEMPTS = 5       # failed purges are retried with a growing delay, then left for "purge_history --retry-failed"
+
+# Notification outbox (chat_app/outbox.py)
+OUTBOX_BATCH_SIZE = 500      # events sent per channel layer call
+OUTBOX_POLL_INTERVAL = 1     # seconds between checks for events written by other processes
+OUTBOX_CLAIM_TIMEOUT = 30    # seconds before the events claimed by a publisher that died are sent again
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -139,6 +167,35 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
+# Uploads are stored by content hash (chat_app/storage.py) and served by chat_app/media.py
+STORAGES = {
+    'default': {'BACKEND': 'chat_app.storage.ContentAddressedStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+BLOB_GC_GRACE = 3600               # seconds an unreferenced blob is kept (see the collect_blobs command)
+MEDIA_CHUNK_SIZE = 256 * 1024
+MEDIA_ACCEL_REDIRECT = None        # e.g. '/protected-media/': nginx internal location sending the files (X-Accel-Redirect)
+
+# Profile and group pictures (chat_app/images.py)
+IMAGE_MAX_UPLOAD_BYTES = 5 * 1024 * 1024
+IMAGE_MAX_PIXELS = 40_000_000
+THUMBNAIL_SIZE = 128       # px, square
+THUMBNAIL_QUALITY = 80     # WebP quality
+IMAGE_THREADS = 2
+
+# Chat attachments (chat_app/attachments.py)
+ATTACHMENT_MAX_BYTES = 200 * 1024 * 1024
+ATTACHMENT_CHUNK_SIZE = 8 * 1024 * 1024    # largest upload-chunk request body
+ATTACHMENT_PREVIEW_SIZE = 320              # px, square WebP preview of the images
+ATTACHMENT_UPLOAD_EXPIRY = 24 * 3600       # seconds before unfinished or unsent uploads are deleted
+
+# Queries run this many times in one request / WebSocket event are logged as N+1 patterns (chat_app/instrumentation.py)
+QUERY_REPEAT_THRESHOLD = 5
+
+# Bearer token of the Prometheus scrape endpoint (metrics/, chat_app/metrics.py), open to anyone only when DEBUG is on
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+METRICS_OUTBOX_COUNT_TTL = 30    # seconds a count of the outbox rows is reported before the next scrape counts again
+
 # WSGI_APPLICATION = 'chat_proj.wsgi.application'
 ASGI_APPLICATION = 'chat_proj.asgi.application'
 
@@ -169,6 +226,17 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Set CHANNEL_LAYER=sqlite to run several daphne workers on one host, they exchange messages through a shared SQLite file
+if config('CHANNEL_LAYER', default='memory') == 'sqlite':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'chat_app.layers.SQLiteChannelLayer',
+            'CONFIG': {
+                'path': BASE_DIR / 'channels.sqlite3',
+            },
+        },
+    }
+
 # JWT secret key
 JWT_SECRET_KEY = config('JWT_SECRET_KEY')
 
@@ -177,3 +245,54 @@ AUTH_USER_MODEL = 'chat_app.CustomUser'
 
 
 
+# Chat history pagination (get_chats)
+CHAT_PAGE_SIZE = 50
+CHAT_MAX_PAGE_SIZE = 200
+
+# Replay of the messages missed by a reconnecting chat socket (chat_app/replay.py)
+REPLAY_BUFFER_SIZE = 100      # recent messages kept per room by every process
+REPLAY_MAX_MESSAGES = 200     # messages read from the history when the buffer can't serve the replay
+
+# Outbound frame queue of every WebSocket connection (chat_app/outbound.py)
+OUTBOUND_QUEUE_HIGH = 200              # queued frames from which the connection is congested
+OUTBOUND_QUEUE_LOW = 50                # ... until the queue drains below this
+OUTBOUND_QUEUE_MAX = 1000              # queued frames that close the connection at once (code 4008)
+OUTBOUND_CONGESTION_TIMEOUT = 10       # seconds a connection may stay congested before it's closed (code 4008)
+OUTBOUND_BATCH_MAX = 100               # frames per batched text frame (clients connected with ?batch=1)
+OUTBOUND_TRANSPORT_BUFFER = 256 * 1024 # bytes in the server's write buffer (daphne) from which frames stay queued, until it's written out
+
+# Chats a multiplexed socket (ws/multiplex/) can subscribe to
+MULTIPLEX_MAX_STREAMS = 100
+
+# Conversation list pagination (get_inbox)
+INBOX_PAGE_SIZE = 30
+INBOX_MAX_PAGE_SIZE = 100
+
+# In-process cache of friendship / group membership checks made by the WebSocket consumers (chat_app/cache.py)
+AUTHZ_CACHE_SIZE = 10000
+AUTHZ_CACHE_TTL = 300    # seconds
+
+# Verified JWT tokens and user principals shared by JWTAuthMiddleware and the views (chat_app/auth.py)
+TOKEN_CACHE_SIZE = 10000
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300    # seconds
+
+# Chat message persistence (chat_app/messaging.py): 'direct' inserts every message before broadcasting it,
+# 'write_behind' broadcasts at once and inserts the messages in batches
+MESSAGE_WRITE_MODE = config('MESSAGE_WRITE_MODE', default='direct')
+MESSAGE_BATCH_SIZE = 200
+MESSAGE_FLUSH_INTERVAL = 0.05    # seconds
+MESSAGE_ID_BLOCK_SIZE = 1000
+MESSAGE_FLUSH_RETRIES = 5       # failed flushes before a batch is dropped
+MESSAGE_QUEUE_MAX = 10000       # messages waiting to be inserted before the senders wait
+
+# Search results per page (search view)
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 50
+
+# Notification inbox (chat_app/notifications.py): page size of get_notifications, and the retention applied by
+# "manage.py compact_notifications" (pending friend/group requests are always kept)
+NOTIFICATION_PAGE_SIZE = 30
+NOTIFICATION_MAX_PAGE_SIZE = 100
+NOTIFICATION_RETENTION_DAYS = 30     # read notifications older than this are deleted
+NOTIFICATION_MAX_PER_USER = 200      # newest notifications kept per user